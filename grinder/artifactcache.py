@@ -0,0 +1,230 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import base64
+import hashlib
+import os
+import shutil
+import socket
+import time
+import urllib
+import urllib2
+import urlparse
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from fcntl import flock, LOCK_EX, LOCK_UN
+from tempfile import gettempdir
+from threading import Thread, Lock
+
+from . logger import log
+from . config import default_config
+
+# Packages don't change under a given name; repository metadata does.
+IMMUTABLE_SUFFIXES = ('.rpm', '.deb', '.msi', '.exe', '.tar.gz', '.tgz')
+METADATA_TTL = 300
+
+class ArtifactCache(object):
+    '''
+    A caching HTTP proxy for the agent repositories, run on the test runner.
+    Guests are pointed at http://<address>:<port>/<scheme>/<host>/<path>,
+    which the cache fetches from <scheme>://<host>/<path> on first use and
+    serves locally from then on. The cache directory is shared by every
+    grinder process on the runner, so each artifact is downloaded once.
+    Only origins that went through rewrite() are served, and the server
+    only listens on address, so it can't be used as an open proxy.
+    '''
+
+    def __init__(self, address, port=None, cache_dir=None):
+        self.address = address
+        self.cache_dir = cache_dir or os.path.join(gettempdir(),
+                                                   'grinder-artifacts')
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                if not os.path.isdir(self.cache_dir):
+                    raise
+        # (scheme, netloc) -> (user, password), or None without credentials.
+        self.origins = {}
+        self.lock = Lock()
+        cache = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                cache.serve(self, body=True)
+
+            def do_HEAD(self):
+                cache.serve(self, body=False)
+
+            def log_message(self, format, *args):
+                log.debug('Artifact cache: ' + format, *args)
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self.server = Server((address, port or 0), Handler)
+        self.port = self.server.server_address[1]
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        log.info('Serving cached artifacts from %s on %s:%d',
+                 self.cache_dir, self.address, self.port)
+
+    def rewrite(self, url, user=None, password=None):
+        '''Returns the url guests should use instead of url.'''
+        parts = urlparse.urlsplit(url)
+        if parts.scheme not in ['http', 'https']:
+            return url
+        with self.lock:
+            if user is not None:
+                self.origins[(parts.scheme, parts.netloc)] = (user, password)
+            else:
+                self.origins.setdefault((parts.scheme, parts.netloc), None)
+        rewritten = 'http://%s:%d/%s/%s%s' % (self.address, self.port,
+                                              parts.scheme, parts.netloc,
+                                              parts.path or '/')
+        if parts.query:
+            rewritten += '?' + parts.query
+        return rewritten
+
+    def origin(self, path):
+        # /<scheme>/<netloc>/<path>[?query]
+        path = urllib.unquote(path)
+        try:
+            _, scheme, netloc, rest = path.split('/', 3)
+        except ValueError:
+            return None
+        with self.lock:
+            if (scheme, netloc) not in self.origins:
+                return None
+        return '%s://%s/%s' % (scheme, netloc, rest)
+
+    def cache_path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def fresh(self, url, path):
+        if not os.path.exists(path):
+            return False
+        if urlparse.urlsplit(url).path.endswith(IMMUTABLE_SUFFIXES):
+            return True
+        return time.time() - os.path.getmtime(path) < METADATA_TTL
+
+    def fetch(self, url, path):
+        request = urllib2.Request(url)
+        parts = urlparse.urlsplit(url)
+        with self.lock:
+            credentials = self.origins.get((parts.scheme, parts.netloc))
+        if credentials is not None:
+            request.add_header('Authorization', 'Basic %s' %
+                               base64.b64encode('%s:%s' % credentials))
+        log.debug('Artifact cache fetching %s', url)
+        response = urllib2.urlopen(request, timeout=60)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as tmp:
+                shutil.copyfileobj(response, tmp)
+            os.rename(tmp_path, path)
+        finally:
+            response.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+    def serve(self, handler, body):
+        url = self.origin(handler.path)
+        if url is None:
+            handler.send_error(403)
+            return
+        path = self.cache_path(url)
+        # Whoever holds the lock downloads; everyone else then hits.
+        lock_fp = open(path + '.lock', 'a')
+        try:
+            flock(lock_fp, LOCK_EX)
+            if not self.fresh(url, path):
+                self.fetch(url, path)
+        except urllib2.HTTPError, e:
+            # Repository clients probe for optional files; pass misses on.
+            handler.send_error(e.code)
+            return
+        except Exception, e:
+            log.warn('Artifact cache failed to fetch %s: %s', url, str(e))
+            handler.send_error(502)
+            return
+        finally:
+            flock(lock_fp, LOCK_UN)
+            lock_fp.close()
+
+        with open(path, 'rb') as artifact:
+            handler.send_response(200)
+            handler.send_header('Content-Length',
+                                str(os.fstat(artifact.fileno()).st_size))
+            handler.send_header('Content-Type', 'application/octet-stream')
+            handler.end_headers()
+            if body:
+                shutil.copyfileobj(artifact, handler.wfile)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+def guess_address(config):
+    '''The runner's address on the route to the cloud, which guests are
+    most likely to reach it at.'''
+    target = urlparse.urlsplit(config.os_auth_url or '').hostname
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((target or '8.8.8.8', 80))
+        return sock.getsockname()[0]
+    finally:
+        sock.close()
+
+_cache = None
+_cache_lock = Lock()
+
+def get_artifact_cache(config=default_config):
+    '''Returns the process's ArtifactCache, or None if it is disabled.'''
+    global _cache
+    if not config.artifact_cache:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            address = config.artifact_cache_address or guess_address(config)
+            port = config.artifact_cache_port
+            _cache = ArtifactCache(address, port and int(port),
+                                   config.artifact_cache_dir)
+        return _cache
+
+def close_artifact_cache():
+    '''Stops the process's ArtifactCache, if it was started.'''
+    global _cache
+    with _cache_lock:
+        if _cache is not None:
+            _cache.close()
+            _cache = None
+
+def cached_location(config, location):
+    '''
+    Rewrites an agent location to go through the artifact cache, if
+    enabled. Locations may carry credentials as "url user password"; those
+    are kept for the guest and used by the cache to fetch from the origin.
+    '''
+    cache = get_artifact_cache(config)
+    if cache is None or location is None:
+        return location
+    parts = location.split()
+    if len(parts) == 3:
+        url, user, password = parts
+        return ' '.join([cache.rewrite(url, user, password), user, password])
+    return cache.rewrite(location)
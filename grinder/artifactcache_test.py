@@ -0,0 +1,90 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import urllib2
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+import artifactcache
+import util
+
+def origin_server(requests):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append((self.path, self.headers.get('Authorization')))
+            if not self.path.startswith('/repo/'):
+                self.send_error(404)
+                return
+            body = 'contents of %s' % self.path
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+def test_artifact_cache(tmpdir):
+    requests = []
+    origin = origin_server(requests)
+    cache = artifactcache.ArtifactCache('127.0.0.1', cache_dir=str(tmpdir))
+    try:
+        base = 'http://127.0.0.1:%d/repo' % origin.server_address[1]
+        url = cache.rewrite(base + '/agent,1.0.rpm', 'user', 'secret')
+        assert url.startswith('http://127.0.0.1:%d/http/' % cache.port)
+
+        # Fetched from the origin once, with the credentials, then local.
+        for location in [url, util.fix_url_for_yum(url)]:
+            assert urllib2.urlopen(location).read() == \
+                'contents of /repo/agent,1.0.rpm'
+        assert len(requests) == 1
+        assert requests[0][1].startswith('Basic ')
+
+        # Misses are passed on, not cached.
+        for i in range(2):
+            try:
+                urllib2.urlopen(cache.rewrite(base[:-len('/repo')] + '/nope'))
+                assert False
+            except urllib2.HTTPError, e:
+                assert e.code == 404
+        assert len(requests) == 3
+
+        # Only origins handed out by rewrite() are proxied.
+        for path in ['/http/example.com/', '/https/127.0.0.1:%d/repo/x' %
+                     origin.server_address[1]]:
+            try:
+                urllib2.urlopen('http://127.0.0.1:%d%s' % (cache.port, path))
+                assert False
+            except urllib2.HTTPError, e:
+                assert e.code == 403
+        assert len(requests) == 3
+    finally:
+        cache.close()
+        origin.shutdown()
+
+def test_cached_location():
+    class FakeConfig(object):
+        artifact_cache = False
+    config = FakeConfig()
+    location = 'http://example.com/agent.msi user secret'
+    assert artifactcache.cached_location(config, location) == location
+    assert artifactcache.cached_location(config, None) is None
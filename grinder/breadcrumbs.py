@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
 import random
 
 from . logger import log
@@ -23,39 +24,109 @@ class Breadcrumbs(object):
         self.instance = instance
         self.trail = []
         self.data = None
+        # Running hash of the trail, in chained and deferred modes.
+        self.chain = ''
+        # Breadcrumbs (at the end of trail) not yet written, in deferred
+        # mode.
+        self.pending = []
 
     class Snapshot(object):
         def __init__(self, breadcrumbs):
+            # Clones get the trail the guest held, which must be all of it.
+            assert len(breadcrumbs.pending) == 0
             self.trail = list(breadcrumbs.trail)
             self.data = breadcrumbs.data
+            self.chain = breadcrumbs.chain
             self.constructor = breadcrumbs.__class__
 
         def instantiate(self, server):
             result = self.constructor(server)
             result.trail = list(self.trail)
             result.data = self.data
+            result.chain = self.chain
             return result
 
     def snapshot(self):
         return Breadcrumbs.Snapshot(self)
 
+    def mode(self):
+        return self.instance.harness.config.breadcrumbs_mode
+
+    def written(self):
+        return self.trail[:len(self.trail) - len(self.pending)]
+
     def add(self, breadcrumb):
-        self.assert_trail()
         breadcrumb = '%d: %s' % (len(self.trail), breadcrumb)
+        mode = self.mode()
+        if mode in ['chained', 'deferred']:
+            # The hash covers every breadcrumb so far, so the last line
+            # stands for the whole trail. No '#' or brackets: breadcrumbs
+            # go through an unquoted echo.
+            self.chain = hashlib.sha1(self.chain + breadcrumb).hexdigest()[:16]
+            breadcrumb = '%s h:%s' % (breadcrumb, self.chain)
+            log.debug('Adding breadcrumb "%s"', breadcrumb)
+            if mode == 'deferred':
+                # Written and checked at the next checkpoint().
+                self.pending.append(breadcrumb)
+            else:
+                self._put_after(self.trail and self.trail[-1] or None,
+                                [breadcrumb])
+            self.trail.append(breadcrumb)
+            return
+        self.assert_trail()
         log.debug('Adding breadcrumb "%s"', breadcrumb)
         self._put(breadcrumb)
         self.trail.append(breadcrumb)
         self.assert_trail()
 
-    def assert_trail(self):
-        if len(self.trail) == 0:
+    def checkpoint(self):
+        '''
+        In deferred mode, writes the breadcrumbs added since the last
+        checkpoint in one go, provided the trail in the guest still ends
+        where the last checkpoint left it; with nothing to write, checks
+        that it does. Either way that's a single remote call. The other
+        modes check as breadcrumbs are added, so this does nothing.
+        '''
+        if self.mode() != 'deferred':
+            return
+        if len(self.pending) == 0:
+            self.assert_trail(full=False)
+            return
+        written = self.written()
+        log.debug('Writing %d breadcrumbs', len(self.pending))
+        self._put_after(written and written[-1] or None, self.pending)
+        self.pending = []
+
+    def assert_trail(self, full=True):
+        '''Checks the trail in the guest matches what we wrote of ours: every
+        line, or only the last one (which, in chained and deferred modes,
+        hashes all of them).'''
+        written = self.written()
+        if len(written) == 0:
             assert self._emptyp()
+        elif not full:
+            last = self._last()
+            log.debug('Got last breadcrumb: %s', last)
+            assert last == written[-1]
         else:
             # Strip trailing newline, we don't want an empty line at the end of
             # the list.
             contents = self._get().strip()
             log.debug('Got breadcrumbs: %s', contents.split('\n'))
-            assert [x.strip('\r') for x in contents.split('\n')] == list(self.trail)
+            assert [x.strip('\r') for x in contents.split('\n')] == written
+
+    def _put_after(self, last, bufs):
+        '''Appends each of bufs, provided the trail ends with last (or is
+        empty, if last is None).'''
+        if last is None:
+            assert self._emptyp()
+        else:
+            assert self._last() == last
+        for buf in bufs:
+            self._put(buf)
+
+    def _last(self):
+        return self._get().strip().split('\n')[-1].strip('\r')
 
     def _put(self, buf):
         raise NotImplementedError()
@@ -79,6 +150,19 @@ class SSHBreadcrumbs(Breadcrumbs):
         stdout, stderr = self.instance.root_command('cat %s' % self.data)
         return stdout
 
+    def _put_after(self, last, bufs):
+        # Check and append in one go.
+        if last is None:
+            check = 'test ! -e %s' % self.data
+        else:
+            check = 'test "$(tail -n 1 %s)" = "%s"' % (self.data, last)
+        self.instance.root_command(' && '.join(
+            [check] + ['echo %s >> %s' % (buf, self.data) for buf in bufs]))
+
+    def _last(self):
+        stdout, stderr = self.instance.root_command('tail -n 1 %s' % self.data)
+        return stdout
+
     def _emptyp(self):
         try:
             self.instance.root_command('test ! -e %s' % self.data)
@@ -0,0 +1,109 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pytest
+import subprocess
+
+import breadcrumbs
+
+class FakeConfig(object):
+    breadcrumbs_mode = 'full'
+
+class FakeHarness(object):
+    def __init__(self, mode):
+        self.config = FakeConfig()
+        self.config.breadcrumbs_mode = mode
+
+class FakeInstance(object):
+    '''Runs root commands in a local shell, counting them.'''
+
+    def __init__(self, mode):
+        self.harness = FakeHarness(mode)
+        self.commands = []
+
+    def root_command(self, command, **kwargs):
+        self.commands.append(command)
+        shell = subprocess.Popen(['sh', '-c', command],
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
+        stdout, stderr = shell.communicate()
+        assert shell.returncode == 0
+        return stdout.strip(), stderr.strip()
+
+def make(tmpdir, mode):
+    instance = FakeInstance(mode)
+    crumbs = breadcrumbs.SSHBreadcrumbs(instance)
+    crumbs.data = str(tmpdir.join('trail'))
+    return instance, crumbs
+
+def test_full(tmpdir):
+    instance, crumbs = make(tmpdir, 'full')
+    crumbs.add('Pre bless')
+    crumbs.add('alive on host a')
+    assert crumbs.trail == ['0: Pre bless', '1: alive on host a']
+    # Checked before and after each append.
+    assert len(instance.commands) == 6
+    crumbs.assert_trail()
+
+def test_chained(tmpdir):
+    instance, crumbs = make(tmpdir, 'chained')
+    for i in range(10):
+        crumbs.add('crumb %d' % i)
+    # One call per breadcrumb, however long the trail.
+    assert len(instance.commands) == 10
+    assert crumbs.trail[1].startswith('1: crumb 1 h:')
+    assert open(crumbs.data).read().split('\n')[:-1] == crumbs.trail
+    crumbs.assert_trail(full=False)
+    crumbs.assert_trail()
+
+    # Clones carry on from the blessed trail, chain included.
+    clone = crumbs.snapshot().instantiate(FakeInstance('chained'))
+    clone.add('launched')
+    assert clone.chain != crumbs.chain
+    clone.assert_trail(full=False)
+
+def test_chained_detects_divergence(tmpdir):
+    instance, crumbs = make(tmpdir, 'chained')
+    crumbs.add('one')
+    crumbs.add('two')
+    with open(crumbs.data, 'a') as trail:
+        trail.write('2: unexpected\n')
+    with pytest.raises(AssertionError):
+        crumbs.add('three')
+    with pytest.raises(AssertionError):
+        crumbs.assert_trail(full=False)
+
+def test_deferred(tmpdir):
+    instance, crumbs = make(tmpdir, 'deferred')
+    for i in range(10):
+        crumbs.add('crumb %d' % i)
+    # Nothing reaches the guest until a checkpoint, which writes them all.
+    assert len(instance.commands) == 0
+    crumbs.checkpoint()
+    assert len(instance.commands) == 1
+    assert open(crumbs.data).read().split('\n')[:-1] == crumbs.trail
+    crumbs.add('crumb 10')
+    crumbs.assert_trail()
+    crumbs.checkpoint()
+    crumbs.checkpoint()
+    assert len(instance.commands) == 4
+    crumbs.assert_trail()
+
+    # A trail changed behind our back fails the next checkpoint.
+    with open(crumbs.data, 'a') as trail:
+        trail.write('11: unexpected\n')
+    crumbs.add('crumb 11')
+    with pytest.raises(AssertionError):
+        crumbs.checkpoint()
@@ -13,7 +13,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import calendar
+import hashlib
+import json
 import os
+import time
+
+from datetime import datetime
+from tempfile import gettempdir
+from threading import Lock, RLock
 
 from . logger import log
 
@@ -154,9 +162,141 @@ def create_network_client(config):
                  "service for this OpenStack cloud.")
         return None
 
+def parse_expiry(expires):
+    '''Keystone token expiry (ISO 8601, UTC) to seconds since the epoch.'''
+    for fmt in ['%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S.%fZ']:
+        try:
+            return calendar.timegm(datetime.strptime(expires, fmt).timetuple())
+        except ValueError:
+            continue
+    return None
+
+def serialize_requests(http_client):
+    '''
+    Has a nova or cinder HTTPClient make one request at a time. Pooled
+    clients are used from the reaper, teardown and pool threads alike, and
+    neither the client (its token and endpoint, refreshed on
+    re-authentication) nor its requests session is thread-safe. The lock is
+    held over the whole request, retries and re-authentication included;
+    waiting on OpenStack happens between requests, so it still overlaps.
+    '''
+    lock = RLock()
+    def locked(method):
+        def wrapped(*args, **kwargs):
+            with lock:
+                return method(*args, **kwargs)
+        return wrapped
+    http_client._cs_request = locked(http_client._cs_request)
+    http_client.authenticate = locked(http_client.authenticate)
+
+class ClientPool(object):
+    '''
+    Hands out one set of clients per process and set of credentials, so
+    that tests don't each authenticate anew and the nova client's HTTP
+    connections stay alive between tests. Cinder gets nova's token and
+    volume endpoint rather than authenticating itself. With
+    share_auth_tokens, the token is also kept in a file that other
+    processes (e.g. distributed workers) pick up until shortly before it
+    expires. Both clients re-authenticate by themselves if the token is
+    revoked early. Requests are serialized per client (see
+    serialize_requests).
+    '''
+    EXPIRY_MARGIN = 300
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clients = {}
+
+    def key(self, config):
+        return (config.os_auth_url, config.os_username,
+                config.os_tenant_name, config.os_region_name)
+
+    def get(self, config):
+        key = self.key(config)
+        with self.lock:
+            if key not in self.clients:
+                self.clients[key] = self.create(config)
+            return self.clients[key]
+
+    def token_path(self, config):
+        digest = hashlib.sha1(repr(self.key(config))).hexdigest()[:12]
+        return os.path.join(gettempdir(), 'grinder-token.%s' % digest)
+
+    def load_token(self, config):
+        try:
+            with open(self.token_path(config)) as token_file:
+                token = json.load(token_file)
+        except (IOError, ValueError):
+            return None
+        if token.get('expires', 0) - time.time() < self.EXPIRY_MARGIN:
+            return None
+        return token
+
+    def save_token(self, config, token):
+        path = self.token_path(config)
+        tmp_path = '%s.%d' % (path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as token_file:
+            json.dump(token, token_file)
+        os.rename(tmp_path, path)
+
+    def authenticate(self, config, nova):
+        nova.authenticate()
+        token = {'token': nova.client.auth_token,
+                 'compute_url': nova.client.management_url,
+                 'volume_url': None,
+                 'expires': None}
+        catalog = getattr(nova.client, 'service_catalog', None)
+        if catalog is None:
+            return token
+        try:
+            token['expires'] = parse_expiry(
+                catalog.catalog['access']['token']['expires'])
+        except KeyError:
+            pass
+        try:
+            kwargs = {}
+            if config.os_region_name:
+                kwargs = {'attr': 'region',
+                          'filter_value': config.os_region_name}
+            token['volume_url'] = catalog.url_for(service_type='volume',
+                                                  **kwargs).rstrip('/')
+        except Exception:
+            log.debug('No volume endpoint in the service catalog.')
+        return token
+
+    def create(self, config):
+        nova = create_nova_client(config)
+        cinder = create_cinder_client(config)
+        token = None
+        if config.share_auth_tokens:
+            token = self.load_token(config)
+            if token is not None:
+                log.debug('Using shared auth token for %s', config.os_username)
+        if token is None:
+            try:
+                token = self.authenticate(config, nova)
+            except Exception, e:
+                # Leave it to the first request to authenticate (and fail).
+                log.warn('Failed to authenticate %s: %s',
+                         config.os_username, str(e))
+            else:
+                if config.share_auth_tokens and token['expires'] is not None:
+                    self.save_token(config, token)
+        if token is not None:
+            nova.client.auth_token = token['token']
+            nova.client.management_url = token['compute_url']
+            if token['volume_url'] is not None:
+                cinder.client.auth_token = token['token']
+                cinder.client.management_url = token['volume_url']
+        serialize_requests(nova.client)
+        serialize_requests(cinder.client)
+        network = create_network_client(config)
+        return (nova, GcApi(nova), cinder, network)
+
+client_pool = ClientPool()
+
 def create_client(config):
-    '''Creates a nova Client with a gcapi client embeded.'''
-    nova = create_nova_client(config)
-    cinder = create_cinder_client(config)
-    network = create_network_client(config)
-    return (nova, GcApi(nova), cinder, network)
+    '''Creates a nova Client with a gcapi client embeded. Clients are
+    shared within the process, see ClientPool.'''
+    return client_pool.get(config)
@@ -0,0 +1,87 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import time
+
+from threading import Thread
+
+import client
+
+class FakeConfig(object):
+    os_auth_url = 'http://keystone:5000/v2.0'
+    os_username = 'grinder'
+    os_tenant_name = 'test'
+    os_region_name = 'RegionOne'
+
+def test_parse_expiry():
+    assert client.parse_expiry('1970-01-01T00:01:00Z') == 60
+    assert client.parse_expiry('1970-01-01T00:01:00.123456Z') == 60
+    assert client.parse_expiry('bogus') is None
+
+def test_token_cache(tmpdir):
+    pool = client.ClientPool()
+    config = FakeConfig()
+    path = str(tmpdir.join('token'))
+    pool.token_path = lambda config: path
+
+    assert pool.load_token(config) is None
+    token = {'token': 'abc', 'compute_url': 'http://nova:8774/v2/test',
+             'volume_url': 'http://cinder:8776/v1/test',
+             'expires': time.time() + 3600}
+    pool.save_token(config, token)
+    assert os.stat(path).st_mode & 0777 == 0600
+    assert pool.load_token(config) == token
+
+    # Tokens about to expire aren't handed out.
+    token['expires'] = time.time() + pool.EXPIRY_MARGIN / 2
+    pool.save_token(config, token)
+    assert pool.load_token(config) is None
+
+    # Different credentials, different token files.
+    other = FakeConfig()
+    other.os_username = 'other'
+    assert client.ClientPool().token_path(config) != \
+           client.ClientPool().token_path(other)
+
+def test_serialize_requests():
+    class FakeHTTPClient(object):
+        def __init__(self):
+            self.running = 0
+            self.most = 0
+
+        def _cs_request(self, url, method):
+            self.running += 1
+            self.most = max(self.most, self.running)
+            time.sleep(0.01)
+            if url == 'reauth':
+                # Re-authentication from within a request.
+                self.authenticate()
+            self.running -= 1
+            return url
+
+        def authenticate(self):
+            pass
+
+    http_client = FakeHTTPClient()
+    client.serialize_requests(http_client)
+    threads = [Thread(target=http_client._cs_request, args=(url, 'GET'))
+               for url in ['a', 'reauth', 'b', 'c'] * 5]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert http_client.running == 0
+    assert http_client.most == 1
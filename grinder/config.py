@@ -32,6 +32,7 @@ DEFAULT_COW_SLACK           = 1500
 DEFAULT_SSH_PORT            = 22
 DEFAULT_WINDOWS_LINK_PORT   = 9845
 DEFAULT_LIMIT_HEADROOM_PAGES = 256
+BREADCRUMBS_MODES = ['full', 'chained', 'deferred']
 
 class Image(object):
     '''Add an image.
@@ -62,6 +63,10 @@ e.g. --image 11.10-a1-64,distro=ubuntu,user=ubuntu,arch=64
         self.cloudinit = cloudinit
         self.agent_skip = agent_skip
 
+    # Set on copies naming a derived image with the agent already installed
+    # (see imagecache.py).
+    agent_cached = False
+
     def check(self):
         assert self.distro
         assert self.arch
@@ -119,6 +124,23 @@ class Config(object):
         # etc. In seconds.
         self.ops_timeout = 600
 
+        # Total time budget, in seconds, for a compound harness operation
+        # (boot, launch, migrate, delete). The waits, ssh commands and link
+        # commands making up an operation share this budget instead of each
+        # getting a full ops_timeout. Defaults to twice ops_timeout.
+        self.operation_budget = None
+
+        # Time budget, in seconds, for each test as a whole. Operations run by
+        # the test can only shorten it, except for cleanup (delete and
+        # discard), which always gets its own operation_budget. Unlimited by
+        # default.
+        self.test_budget = None
+
+        # How many teardown steps (deleting clones, detaching volumes,
+        # deleting snapshots, discarding blessed instances) may run at once.
+        # Steps only wait for the steps they depend on.
+        self.teardown_concurrency = 8
+
         # The port to use to initiate ssh connections.
         self.ssh_port = DEFAULT_SSH_PORT
 
@@ -134,6 +156,37 @@ class Config(object):
         self.windows_agent_location = \
             "http://downloads.gridcentric.com/packages/agent/windows/"
 
+        # Whether to boot every image once on every host before tests start,
+        # so that no test pays for the host fetching the image from glance.
+        # Warm times are logged, and kept per image and host in a
+        # grinder-prewarm file in the temporary directory.
+        self.prewarm_images = False
+        # How many of those boots run at once.
+        self.prewarm_workers = 4
+
+        # Whether to serve the agent locations above to guests through an
+        # HTTP cache on the test runner, which fetches each package from the
+        # origin once. Guests must be able to reach the runner at
+        # artifact_cache_address (by default, the runner's address on the
+        # route to os_auth_url) and artifact_cache_port (by default, any
+        # free port; distributed workers each run their own cache and always
+        # use a free port). Downloads are kept in artifact_cache_dir (by
+        # default, grinder-artifacts in the temporary directory). Linux guests
+        # only go through the cache when agent_location is set: by default
+        # the install command picks the origin itself, which grinder never
+        # sees.
+        self.artifact_cache = False
+        self.artifact_cache_address = None
+        self.artifact_cache_port = None
+        self.artifact_cache_dir = None
+
+        # Whether to boot from derived images that have the agent installed
+        # already, instead of installing it after every boot. The first boot
+        # of an image builds its derived image (a snapshot in glance); agent
+        # location or version changes make it build a new one. Note that an
+        # agent_version of 'latest' won't notice new agent releases.
+        self.agent_image_cache = False
+
         # The arch to use for non-arch tests (i.e., tests that aren't sensitive
         # to the arch).
         self.default_archs = []
@@ -169,6 +222,58 @@ class Config(object):
         # Whether to leave the VMs around on failure.
         self.leave_on_failure = False
 
+        # When a test is done with a booted instance, its debug data (state
+        # of the guest, dmesg and vmsagent logs) is saved as a tarball in
+        # debug_bundle_dir/<test name> (by default, grinder-debug in the
+        # temporary directory), and the log says where. Unless
+        # skip_debug_on_pass, that's whether the test passed or not.
+        self.debug_bundle_dir = None
+        self.skip_debug_on_pass = False
+
+        # Whether to tear instances, volumes, security groups and keypairs
+        # down in the background once a test is done with them, rather than
+        # having the test wait for the deletions. Failed deletions are
+        # reported as leaks at the end of the session. reaper_workers bounds
+        # how many teardowns run at once.
+        self.background_teardown = False
+        self.reaper_workers = 4
+
+        # How many booted (and, for harness.blessed, blessed) instances to
+        # keep ready per image, flavor and host. Once a test has asked for a
+        # kind of instance, the pool boots its replacements in the
+        # background so that later tests can check one out. Disabled unless
+        # set.
+        self.warm_pool_size = None
+
+        # Volume sizes (in GB) to keep created ahead of time for
+        # harness.volume, volume_pool_depth of each. Volumes are created
+        # in parallel and replaced in the background as tests use them up.
+        self.volume_pool_sizes = []
+        self.volume_pool_depth = 2
+
+        # Whether prime_volume writes seeded data straight to the block
+        # device with O_DIRECT (hashed during the transfer, no mkfs, no
+        # cache flushing) instead of to a file on a fresh ext3 filesystem
+        # (which guests without python still use), and how many MB it
+        # writes either way.
+        self.volume_raw_io = False
+        self.volume_io_mb = 1
+
+        # How many seconds assert_guest_stable runs each of its workloads
+        # (memory, filesystem metadata, block I/O, CPU and loopback
+        # network) for, and how many times slower than a baseline taken
+        # earlier any of them may get before the guest is deemed unstable.
+        self.stability_budget = 0.5
+        self.stability_max_slowdown = 5.0
+
+        # How breadcrumbs are checked as they are added. 'full' reads back
+        # the whole trail before and after each one. 'chained' tags each
+        # breadcrumb with a running hash of the trail and only checks the
+        # last line, in the same call that appends. 'deferred' chains too,
+        # but keeps breadcrumbs until a checkpoint (after bless, launch and
+        # migrate, and at teardown) writes and checks them in one call.
+        self.breadcrumbs_mode = 'full'
+
         # Parameters for reading test configuration from a Tempest configuration file:
         #   tempest_config is the path of the configuration file
         #   tc_distro is the distro for the default guest image
@@ -180,6 +285,11 @@ class Config(object):
         self.tc_distro = None
         self.tc_arch = None
 
+        # Whether to share keystone tokens between grinder processes (e.g.
+        # distributed workers) through a file in the temporary directory,
+        # rather than having each process authenticate.
+        self.share_auth_tokens = False
+
         # Authentication parameters
         self.os_username = os.environ.get('OS_USERNAME')
         self.os_password = os.environ.get('OS_PASSWORD')
@@ -312,6 +422,56 @@ unmanaged = true
                                  int, "policy limit headroom pages",
                                  DEFAULT_LIMIT_HEADROOM_PAGES, 0, 16 * 256)
 
+        default_budget = 2 * float(self.ops_timeout)
+        if self.operation_budget is None:
+            self.operation_budget = default_budget
+        self.operation_budget =\
+            handle_number_option(self.operation_budget,
+                                 float, "operation budget",
+                                 default_budget, 1, 24 * 3600)
+        if self.test_budget is not None:
+            self.test_budget =\
+                handle_number_option(self.test_budget,
+                                     float, "test budget",
+                                     None, 1, 24 * 3600)
+        self.teardown_concurrency =\
+            handle_number_option(self.teardown_concurrency,
+                                 int, "teardown concurrency",
+                                 8, 1, 64)
+        self.reaper_workers =\
+            handle_number_option(self.reaper_workers,
+                                 int, "reaper workers",
+                                 4, 1, 64)
+        self.prewarm_workers =\
+            handle_number_option(self.prewarm_workers,
+                                 int, "prewarm workers",
+                                 4, 1, 64)
+        self.volume_pool_depth =\
+            handle_number_option(self.volume_pool_depth,
+                                 int, "volume pool depth",
+                                 2, 1, 16)
+        self.volume_io_mb =\
+            handle_number_option(self.volume_io_mb,
+                                 int, "volume io MB",
+                                 1, 1, 1024 * 1024)
+        self.stability_budget =\
+            handle_number_option(self.stability_budget,
+                                 float, "stability budget",
+                                 0.5, 0.1, 60)
+        self.stability_max_slowdown =\
+            handle_number_option(self.stability_max_slowdown,
+                                 float, "stability max slowdown",
+                                 5.0, 1, 1000)
+        if self.warm_pool_size is not None:
+            self.warm_pool_size =\
+                handle_number_option(self.warm_pool_size,
+                                     int, "warm pool size",
+                                     None, 1, 16)
+        if self.breadcrumbs_mode not in BREADCRUMBS_MODES:
+            log.warn("Bad breadcrumbs mode %s, back to default full." %
+                     self.breadcrumbs_mode)
+            self.breadcrumbs_mode = 'full'
+
     def get_images(self, distro, arch, platform):
         return filter(lambda i: i.distro == distro and \
                           i.arch == arch and \
@@ -27,11 +27,16 @@ from urlparse import urlparse
 
 from . config import default_config, Image
 from . harness import ImageFinder, get_test_distros, get_test_archs, get_test_platforms
-from . client import create_nova_client
+from . client import create_client
 from . client import GcApi
 from . logger import log
 from . requirements import INSTALL_POLICY
 from . util import install_policy
+from . reaper import drain_reaper
+from . pool import drain_pool
+from . shared import shared_resources
+from . prewarm import prewarm_images
+from . artifactcache import close_artifact_cache
 
 def parse_option(value, argspec):
     '''Parses an option value qemu style: comma-separated, optional keys.
@@ -122,6 +127,12 @@ def pytest_configure(config):
                 else:
                     setattr(default_config, name, new_value)
 
+    # Each distributed worker runs its own artifact cache, and only one of
+    # them could bind a fixed port, so workers take any free one.
+    if (hasattr(config, 'slaveinput') or hasattr(config, 'workerinput')) and \
+       default_config.artifact_cache_port:
+        default_config.artifact_cache_port = None
+
     level = {'DEBUG': logging.DEBUG,
              'INFO': logging.INFO,
              'WARNING': logging.WARNING,
@@ -175,7 +186,7 @@ def pytest_configure(config):
         # Create an instance of Image for the parameters obtained from
         # tempest.conf. Try to find an image by ID or name.
         image_details = None
-        client = create_nova_client(default_config)
+        client = create_client(default_config)[0]
         try:
             image_details = client.images.find(id=default_config.tc_image_ref)
         except novaclient.exceptions.NotFound:
@@ -215,7 +226,7 @@ def pytest_configure(config):
     # Gather list of hosts: either as defined in pytest.ini or all hosts
     # available.
     try:
-        client = create_nova_client(default_config)
+        client = create_client(default_config)[0]
         all_hosts = client.hosts.list_all()
         if len(default_config.hosts) == 0:
             hosts = [x.host_name for x in all_hosts]
@@ -265,6 +276,7 @@ def pytest_configure(config):
     # false contention between multiple grinder runs targetting different
     # clusters. Don't do pointless work. This could be a run just to do
     # --collectonly.
+    prewarm_marker_path = None
     if (default_config.os_auth_url is not None and
         default_config.hosts != []):
         authurl = urlparse(default_config.os_auth_url)
@@ -275,10 +287,13 @@ def pytest_configure(config):
                                            "grinder-policy-lock." +
                                             normalized_authurl)
         default_config.policy_lock_fp = open(default_config.policy_lock_path, 'a')
+        prewarm_marker_path = os.path.join(gettempdir(),
+                                           "grinder-prewarm." +
+                                           normalized_authurl)
         os.chmod(default_config.policy_lock_path, 0666)
         # Install the default policy on the test machine(s). The default value
         # for the default policy causes policyd to ignore all VMs on the host.
-        client = create_nova_client(default_config)
+        client = create_client(default_config)[0]
         if INSTALL_POLICY.check(client):
             install_policy(GcApi(client), default_config.default_policy,
                            timeout=default_config.ops_timeout)
@@ -287,6 +302,12 @@ def pytest_configure(config):
 
     default_config.post_config()
 
+    # Have every host fetch every image before tests start, rather than
+    # during whichever test first boots it there.
+    if default_config.prewarm_images and prewarm_marker_path is not None:
+        nova, _, _, network = create_client(default_config)
+        prewarm_images(nova, network, default_config, prewarm_marker_path)
+
 def pytest_generate_tests(metafunc):
     if "image_finder" in metafunc.funcargnames:
         ImageFinder.parametrize(metafunc, 'image_finder',
@@ -294,7 +315,23 @@ def pytest_generate_tests(metafunc):
                                 get_test_archs(metafunc.function),
                                 get_test_platforms(metafunc.function))
 
+def pytest_terminal_summary(terminalreporter):
+    # Wait for background teardown to finish, and own up to what it leaked.
+    drain_pool()
+    leaks = drain_reaper()
+    shared_resources.drain()
+    if len(leaks) > 0:
+        terminalreporter.write_sep('=', 'leaked resources')
+        for description, reason in leaks:
+            terminalreporter.write_line('%s: %s' %
+                                        (description, reason.splitlines()[-1]))
+
 def pytest_unconfigure(config):
+    # Distributed workers don't get a terminal summary; their leaks are logged.
+    drain_pool()
+    drain_reaper()
+    shared_resources.drain()
+    close_artifact_cache()
     if default_config.policy_lock_path is None:
         return
     try:
@@ -0,0 +1,757 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''
+Guest-side helpers, run inside Linux guests by Instance.guest_tool() as
+
+    python - <command> [options]
+
+with this file on stdin. It must stay a single file that only uses the
+standard library, and run under both python 2 and python 3, since that's
+all we can count on finding in a guest.
+'''
+
+import binascii
+import bisect
+import glob
+import hashlib
+import io
+import json
+import mmap
+import optparse
+import os
+import random
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import zlib
+
+PAGE_SIZE = 4096
+# Pages are written and read in 2MiB chunks.
+CHUNK_PAGES = 512
+# Seeded bytes that unique pages are cut from.
+POOL_SIZE = 1 << 16
+# How many distinct pages a dedup fill cycles through.
+DEDUP_PAGES = 16
+
+STRATEGIES = ['random', 'zero', 'dedup']
+PATTERNS = ['sequential', 'random', 'zipf']
+# Touches between rate checks.
+BATCH = 256
+# Block I/O is done in 1MiB transfers.
+TRANSFER_PAGES = 256
+# How often waits check their condition; everything checked is local.
+WAIT_INTERVAL = 0.05
+# Exit status of a wait that timed out.
+TIMEOUT = 3
+
+BOOT_FINISHED = '/var/lib/cloud/instance/boot-finished'
+USER_DATA = '/var/lib/cloud/instance/user-data.txt'
+
+# What goes in a debug bundle: the output of these commands, under the
+# given names, and these files (or files matching these patterns) under
+# their paths.
+DEBUG_COMMANDS = [
+    ('ls.txt', 'ls -la /'),
+    ('df.txt', 'df -h'),
+    ('ps.txt', 'ps aux'),
+    ('ifconfig.txt', 'ifconfig -a'),
+    ('route.txt', 'route -n'),
+    ('iptables.txt', 'iptables -L -n'),
+    ('netstat.txt', 'netstat -nap'),
+    ('dmesg.txt', 'dmesg'),
+]
+DEBUG_FILES = [
+    '/proc/mounts',
+    '/proc/modules',
+    '/etc/resolv.conf',
+    '/var/log/vmsagent*',
+]
+
+class PageSource(object):
+    '''
+    The content of every page of a fill, computable for any page on its
+    own, so verification can regenerate what was written from the seed.
+    Random pages start with their seed and index, which makes each one
+    unique (nothing for the hypervisor to share), followed by bytes from a
+    seeded pool. Zero pages are all zero; dedup pages cycle through a few
+    random ones, so nearly all of them can be shared.
+    '''
+
+    def __init__(self, strategy, seed):
+        assert strategy in STRATEGIES
+        self.strategy = strategy
+        self.seed = seed
+        rng = random.Random(seed)
+        size = POOL_SIZE + PAGE_SIZE
+        self.pool = binascii.unhexlify('%0*x' % (size * 2,
+                                                 rng.getrandbits(size * 8)))
+        self.zero = b'\0' * PAGE_SIZE
+
+    def unique(self, index):
+        offset = (index * 2053) % POOL_SIZE
+        return struct.pack('<QQ', self.seed, index) + \
+               self.pool[offset:offset + PAGE_SIZE - 16]
+
+    def page(self, index):
+        if self.strategy == 'zero':
+            return self.zero
+        if self.strategy == 'dedup':
+            return self.unique(index % DEDUP_PAGES)
+        return self.unique(index)
+
+    def chunk(self, first, count):
+        return b''.join([self.page(i) for i in range(first, first + count)])
+
+def chunks(pages):
+    for first in range(0, pages, CHUNK_PAGES):
+        yield first, min(CHUNK_PAGES, pages - first)
+
+def page_digests(data):
+    return [hashlib.md5(data[i:i + PAGE_SIZE]).digest()
+            for i in range(0, len(data), PAGE_SIZE)]
+
+def tree_levels(leaves):
+    '''
+    Builds a Merkle tree over page digests: levels[0] are the leaves and
+    levels[-1] is [root]. A node at level l covers pages
+    [i << l, (i + 1) << l); an odd node out is carried up as is.
+    '''
+    levels = [leaves]
+    while len(levels[-1]) > 1:
+        below = levels[-1]
+        levels.append([hashlib.md5(below[i] + below[i + 1]).digest()
+                       if i + 1 < len(below) else below[i]
+                       for i in range(0, len(below), 2)])
+    return levels
+
+def hexlify(digest):
+    return binascii.hexlify(digest).decode('ascii')
+
+def fill(path, pages, strategy, seed):
+    '''Writes pages to path in one pass, returning the Merkle root of what
+    was written.'''
+    source = PageSource(strategy, seed)
+    leaves = []
+    out = open(path, 'wb')
+    try:
+        for first, count in chunks(pages):
+            data = source.chunk(first, count)
+            leaves.extend(page_digests(data))
+            out.write(data)
+    finally:
+        out.close()
+    return hexlify(tree_levels(leaves)[-1][0])
+
+def frontier(levels, width):
+    '''The lowest level of at most width nodes, as (level, nodes).'''
+    for level, nodes in enumerate(levels):
+        if len(nodes) <= width:
+            return level, nodes
+
+def merkle(path, pages, width):
+    '''Reads path in one pass. Returns the root, and the level and hashes
+    of the frontier of at most width nodes, to narrow down mismatches.'''
+    leaves = []
+    infile = open(path, 'rb')
+    try:
+        for first, count in chunks(pages):
+            leaves.extend(page_digests(infile.read(count * PAGE_SIZE)))
+    finally:
+        infile.close()
+    # A short file has fewer leaves, and mismatches from where it ends.
+    levels = tree_levels(leaves or [b''])
+    level, nodes = frontier(levels, width)
+    return {'root': hexlify(levels[-1][0]),
+            'level': level,
+            'nodes': [hexlify(n) for n in nodes]}
+
+def leaves(path, page_ranges):
+    '''Hashes only the pages in page_ranges, as {index: hash}.'''
+    result = {}
+    infile = open(path, 'rb')
+    try:
+        for first, last in page_ranges:
+            infile.seek(first * PAGE_SIZE)
+            data = infile.read((last - first + 1) * PAGE_SIZE)
+            for i, digest in enumerate(page_digests(data)):
+                result[first + i] = hexlify(digest)
+    finally:
+        infile.close()
+    return result
+
+class AccessPattern(object):
+    '''
+    Which page of a working set each touch goes to: in order, uniformly at
+    random, or zipfian, where page k (in a seeded shuffled order) is hit in
+    proportion to 1 / k ** skew, so a small hot set takes most touches.
+    '''
+
+    def __init__(self, pattern, pages, seed, skew=1.1):
+        assert pattern in PATTERNS
+        self.pattern = pattern
+        self.pages = pages
+        self.rng = random.Random(seed)
+        self.next = 0
+        if pattern == 'zipf':
+            total = 0.0
+            self.cdf = []
+            for k in range(1, pages + 1):
+                total += 1.0 / k ** skew
+                self.cdf.append(total)
+            self.order = list(range(pages))
+            self.rng.shuffle(self.order)
+
+    def batch(self, count):
+        if self.pattern == 'sequential':
+            first = self.next
+            self.next = (first + count) % self.pages
+            return [(first + i) % self.pages for i in range(count)]
+        if self.pattern == 'random':
+            return [self.rng.randrange(self.pages) for i in range(count)]
+        total = self.cdf[-1]
+        return [self.order[min(bisect.bisect(self.cdf,
+                                             self.rng.random() * total),
+                               self.pages - 1)]
+                for i in range(count)]
+
+def workload(pages, pattern, dirty, duration, rate=None, seed=0):
+    '''
+    Touches pages of a private working set of the given size for duration
+    seconds, writing to each touched page if dirty, and at most rate pages
+    per second if set. The working set is populated with unique pages
+    first. Returns the touches made and the rate achieved.
+    '''
+    memory = mmap.mmap(-1, pages * PAGE_SIZE)
+    try:
+        start = time.time()
+        for page in range(pages):
+            memory[page * PAGE_SIZE:page * PAGE_SIZE + 16] = \
+                struct.pack('<QQ', seed, page)
+        populated = time.time()
+        access = AccessPattern(pattern, pages, seed)
+        touched = 0
+        marker = b'\xa5'
+        end = populated + duration
+        now = populated
+        while now < end:
+            for page in access.batch(BATCH):
+                offset = page * PAGE_SIZE + 16 + touched % (PAGE_SIZE - 16)
+                if dirty:
+                    memory[offset:offset + 1] = marker
+                else:
+                    memory[offset]
+                touched += 1
+            now = time.time()
+            if rate:
+                ahead = populated + float(touched) / rate - now
+                if ahead > 0 and now < end:
+                    time.sleep(min(ahead, end - now))
+                    now = time.time()
+        elapsed = now - populated
+    finally:
+        memory.close()
+    return {'populate_seconds': populated - start,
+            'seconds': elapsed,
+            'touched': touched,
+            'pages_per_sec': touched / elapsed}
+
+def open_block(path, write, direct=True):
+    '''Opens a device (or file) for unbuffered I/O. O_DIRECT needs aligned
+    buffers, offsets and sizes: transfers go through page-aligned mmaps,
+    and offsets and sizes are whole pages.'''
+    flags = os.O_RDWR if write else os.O_RDONLY
+    if direct:
+        flags |= os.O_DIRECT
+    if write:
+        flags |= os.O_SYNC
+    return io.FileIO(os.open(path, flags), 'r+' if write else 'r')
+
+def transfers(offset, size):
+    assert offset % PAGE_SIZE == 0 and size % PAGE_SIZE == 0
+    first = offset // PAGE_SIZE
+    last = first + size // PAGE_SIZE
+    for page in range(first, last, TRANSFER_PAGES):
+        yield page, min(TRANSFER_PAGES, last - page)
+
+def throughput(size, elapsed):
+    return float(size) / (1 << 20) / max(elapsed, 1e-6)
+
+def block_write(path, offset, size, strategy, seed, direct=True):
+    '''
+    Writes seeded pages at offset through O_DIRECT, so nothing is left in
+    the page cache to read back. Pages are generated by their index on the
+    device, so different ranges get different content. Returns the md5 of
+    what was written and the throughput.
+    '''
+    source = PageSource(strategy, seed)
+    digest = hashlib.md5()
+    buffers = {}
+    start = time.time()
+    device = open_block(path, True, direct)
+    try:
+        device.seek(offset)
+        for page, count in transfers(offset, size):
+            data = source.chunk(page, count)
+            digest.update(data)
+            buf = buffers.get(count)
+            if buf is None:
+                buf = buffers[count] = mmap.mmap(-1, count * PAGE_SIZE)
+            buf[:] = data
+            device.write(buf)
+    finally:
+        device.close()
+    elapsed = time.time() - start
+    return {'md5': digest.hexdigest(),
+            'seconds': elapsed,
+            'mb_per_sec': throughput(size, elapsed)}
+
+def block_read(path, offset, size, strategy, seed, direct=True):
+    '''Reads back what block_write() wrote through O_DIRECT, comparing it
+    with the regenerated pages as it goes. Returns the md5 of what was
+    read, the throughput and the (first, last) ranges of corrupt pages.'''
+    source = PageSource(strategy, seed)
+    digest = hashlib.md5()
+    buffers = {}
+    corrupt = []
+    start = time.time()
+    device = open_block(path, False, direct)
+    try:
+        device.seek(offset)
+        for page, count in transfers(offset, size):
+            buf = buffers.get(count)
+            if buf is None:
+                buf = buffers[count] = mmap.mmap(-1, count * PAGE_SIZE)
+            got = device.readinto(buf)
+            data = buf[:got]
+            digest.update(data)
+            if data == source.chunk(page, count):
+                continue
+            for i in range(count):
+                if data[i * PAGE_SIZE:(i + 1) * PAGE_SIZE] != \
+                   source.page(page + i):
+                    corrupt.append(page + i)
+    finally:
+        device.close()
+    elapsed = time.time() - start
+    return {'md5': digest.hexdigest(),
+            'seconds': elapsed,
+            'mb_per_sec': throughput(size, elapsed),
+            'corrupt': ranges(corrupt)}
+
+def timed(budget, step):
+    '''Runs step() until budget seconds are up, returning the units of
+    work per second (step() returns how many it did).'''
+    start = time.time()
+    done = 0
+    while True:
+        done += step()
+        elapsed = time.time() - start
+        if elapsed >= budget:
+            return done / elapsed
+
+def stress_memory(budget, pages=2048):
+    '''Pages checksummed per second, walking a working set over and over
+    and checking every page still has the checksum it was written with.'''
+    memory = mmap.mmap(-1, pages * PAGE_SIZE)
+    try:
+        source = PageSource('random', pages)
+        memory[:] = source.chunk(0, pages)
+        sums = [zlib.crc32(source.page(i)) for i in range(pages)]
+        def walk():
+            for i in range(pages):
+                offset = i * PAGE_SIZE
+                if zlib.crc32(memory[offset:offset + PAGE_SIZE]) != sums[i]:
+                    raise Exception('Memory page %d corrupt' % i)
+            return pages
+        return timed(budget, walk)
+    finally:
+        memory.close()
+
+def stress_metadata(budget, directory):
+    '''File creates, stats, renames and unlinks per second.'''
+    def step():
+        for i in range(64):
+            path = os.path.join(directory, 'f%d' % i)
+            open(path, 'w').close()
+            os.stat(path)
+            os.rename(path, path + '.renamed')
+            os.unlink(path + '.renamed')
+        return 4 * 64
+    return timed(budget, step)
+
+def stress_block(budget, directory):
+    '''MB/s written and read back through O_DIRECT, or with fsync where the
+    filesystem can't do O_DIRECT (tmpfs).'''
+    path = os.path.join(directory, 'block')
+    open(path, 'w').close()
+    direct = True
+    try:
+        open_block(path, True).close()
+    except OSError:
+        direct = False
+    size = TRANSFER_PAGES * PAGE_SIZE
+    state = {'seed': 0}
+    def step():
+        state['seed'] += 1
+        written = block_write(path, 0, size, 'random', state['seed'], direct)
+        if not direct:
+            fd = os.open(path, os.O_RDONLY)
+            os.fsync(fd)
+            os.close(fd)
+        read = block_read(path, 0, size, 'random', state['seed'], direct)
+        if read['corrupt']:
+            raise Exception('Block I/O corrupt in pages %s' %
+                            format_ranges(read['corrupt']))
+        return 2.0
+    return timed(budget, step)
+
+def stress_cpu(budget):
+    '''MB/s hashed.'''
+    data = PageSource('random', 0).chunk(0, 16)
+    def step():
+        for i in range(16):
+            hashlib.sha1(data).digest()
+        return 16 * len(data) / float(1 << 20)
+    return timed(budget, step)
+
+def stress_network(budget):
+    '''MB/s through a TCP connection over loopback.'''
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    received = []
+    def receive():
+        connection, _ = server.accept()
+        total = 0
+        while True:
+            data = connection.recv(1 << 16)
+            if not data:
+                break
+            total += len(data)
+        connection.close()
+        received.append(total)
+    receiver = threading.Thread(target=receive)
+    receiver.daemon = True
+    receiver.start()
+    client = socket.create_connection(server.getsockname())
+    data = b'\x5a' * (1 << 16)
+    def step():
+        for i in range(16):
+            client.sendall(data)
+        return 16 * len(data) / float(1 << 20)
+    try:
+        rate = timed(budget, step)
+    finally:
+        client.close()
+        receiver.join(budget + 10)
+        server.close()
+    if not received:
+        raise Exception('Loopback receiver did not finish')
+    return rate
+
+def stability(budget):
+    '''
+    Runs each stress workload for budget seconds and returns their rates,
+    failing if any of them sees corruption. Units are pages/s for memory,
+    operations/s for metadata, and MB/s for block, cpu and network.
+    '''
+    # /tmp may well be tmpfs; /var/tmp is usually on a disk.
+    directory = tempfile.mkdtemp(prefix='grinder-stability.',
+                                 dir=os.path.isdir('/var/tmp') and
+                                     '/var/tmp' or None)
+    try:
+        return {'memory': stress_memory(budget),
+                'metadata': stress_metadata(budget, directory),
+                'block': stress_block(budget, directory),
+                'cpu': stress_cpu(budget),
+                'network': stress_network(budget)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+class Timeout(Exception):
+    pass
+
+def wait_until(condition, timeout):
+    '''Checks condition() until it returns True, returning the seconds
+    waited. Raises Timeout after timeout seconds.'''
+    start = time.time()
+    while not condition():
+        if time.time() - start >= timeout:
+            raise Timeout()
+        time.sleep(WAIT_INTERVAL)
+    return time.time() - start
+
+def read(path):
+    try:
+        infile = open(path)
+        try:
+            return infile.read()
+        finally:
+            infile.close()
+    except (IOError, OSError):
+        return None
+
+def cloudinit_done(userdata=None, host_key=None, copied_key=None):
+    '''
+    Whether cloud-init is done with the instance. On a clone, that's when
+    the clone.d hook has copied the regenerated host key; otherwise it's
+    when boot-finished exists (and, given userdata, the user data holds
+    it).
+    '''
+    if host_key is not None:
+        key = read(host_key)
+        return key is not None and key == read(copied_key)
+    if read(BOOT_FINISHED) is None:
+        return False
+    return userdata is None or userdata in (read(USER_DATA) or '')
+
+def boot_finished_uptime():
+    '''The guest uptime cloud-init recorded when it finished, if any.'''
+    try:
+        return float(read(BOOT_FINISHED).split()[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def path_exists(path):
+    return os.path.exists(path)
+
+def device_listed(device):
+    '''Whether the kernel lists device (e.g. /dev/vdb) as a partition.'''
+    partitions = (read('/proc/partitions') or '').split('\n')[2:]
+    names = [line.split()[-1] for line in partitions if line.strip()]
+    return os.path.basename(device) in names
+
+def process_running(name):
+    '''Whether a process named name runs, as pidof would find it.'''
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        stat = read('/proc/%s/stat' % pid)
+        # The kernel keeps 15 characters of the name, in parentheses.
+        if stat is not None and \
+           stat[stat.find('(') + 1:stat.rfind(')')] == name[:15]:
+            return True
+    return False
+
+def read_bytes(path):
+    try:
+        infile = open(path, 'rb')
+        try:
+            return infile.read()
+        finally:
+            infile.close()
+    except (IOError, OSError):
+        return None
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    info.mode = 420
+    tar.addfile(info, io.BytesIO(data))
+
+def debug_bundle(out, commands=DEBUG_COMMANDS, files=DEBUG_FILES):
+    '''
+    Writes a gzipped tarball of the output of commands (stdout and stderr,
+    whatever their exit status) and of files to out, as it goes. Files are
+    read rather than added, since /proc files claim to be empty.
+    '''
+    tar = tarfile.open(fileobj=out, mode='w|gz')
+    try:
+        for name, command in commands:
+            process = subprocess.Popen(command, shell=True,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.STDOUT)
+            add_bytes(tar, name, process.communicate()[0])
+        for pattern in files:
+            for path in sorted(glob.glob(pattern)):
+                data = read_bytes(path)
+                if data is not None:
+                    add_bytes(tar, path.lstrip('/'), data)
+    finally:
+        tar.close()
+
+def ranges(indices):
+    '''Collapses sorted page indices into (first, last) ranges.'''
+    result = []
+    for index in indices:
+        if result and result[-1][1] == index - 1:
+            result[-1] = (result[-1][0], index)
+        else:
+            result.append((index, index))
+    return result
+
+def format_ranges(page_ranges):
+    return ','.join(['%d-%d' % r for r in page_ranges])
+
+def parse_ranges(text):
+    result = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        result.append((int(first), int(last or first)))
+    return result
+
+def balloon_options(parser):
+    parser.add_option('--pages', type='int')
+    parser.add_option('--strategy', default='random', choices=STRATEGIES)
+    parser.add_option('--seed', type='int', default=0)
+
+def cmd_fill(args):
+    parser = optparse.OptionParser(usage='fill PATH --pages N')
+    balloon_options(parser)
+    options, args = parser.parse_args(args)
+    sys.stdout.write('%s\n' % fill(args[0], options.pages, options.strategy,
+                                   options.seed))
+    return 0
+
+def cmd_merkle(args):
+    parser = optparse.OptionParser(usage='merkle PATH --pages N')
+    parser.add_option('--pages', type='int')
+    parser.add_option('--width', type='int', default=256)
+    options, args = parser.parse_args(args)
+    json.dump(merkle(args[0], options.pages, options.width), sys.stdout)
+    return 0
+
+def cmd_leaves(args):
+    parser = optparse.OptionParser(usage='leaves PATH --ranges A-B,C,...')
+    parser.add_option('--ranges')
+    options, args = parser.parse_args(args)
+    json.dump(leaves(args[0], parse_ranges(options.ranges)), sys.stdout)
+    return 0
+
+def cmd_workload(args):
+    parser = optparse.OptionParser(usage='workload --pages N')
+    parser.add_option('--pages', type='int')
+    parser.add_option('--pattern', default='sequential', choices=PATTERNS)
+    parser.add_option('--read-only', action='store_true', default=False)
+    parser.add_option('--duration', type='float', default=10)
+    parser.add_option('--rate', type='int')
+    parser.add_option('--seed', type='int', default=0)
+    options, args = parser.parse_args(args)
+    json.dump(workload(options.pages, options.pattern, not options.read_only,
+                       options.duration, options.rate, options.seed),
+              sys.stdout)
+    return 0
+
+def block_options(parser):
+    parser.add_option('--offset', type='int', default=0)
+    parser.add_option('--size', type='int')
+    parser.add_option('--strategy', default='random', choices=STRATEGIES)
+    parser.add_option('--seed', type='int', default=0)
+
+def cmd_blockwrite(args):
+    parser = optparse.OptionParser(usage='blockwrite DEVICE --size BYTES')
+    block_options(parser)
+    options, args = parser.parse_args(args)
+    json.dump(block_write(args[0], options.offset, options.size,
+                          options.strategy, options.seed), sys.stdout)
+    return 0
+
+def cmd_blockread(args):
+    parser = optparse.OptionParser(usage='blockread DEVICE --size BYTES')
+    block_options(parser)
+    options, args = parser.parse_args(args)
+    json.dump(block_read(args[0], options.offset, options.size,
+                         options.strategy, options.seed), sys.stdout)
+    return 0
+
+def cmd_stability(args):
+    parser = optparse.OptionParser(usage='stability --budget SECONDS')
+    parser.add_option('--budget', type='float', default=0.5)
+    options, args = parser.parse_args(args)
+    json.dump(stability(options.budget), sys.stdout)
+    return 0
+
+def cmd_cloudinit(args):
+    parser = optparse.OptionParser(usage='cloudinit [--userdata TEXT | '
+                                         '--host-key PATH --copied-key PATH]')
+    parser.add_option('--userdata')
+    parser.add_option('--host-key')
+    parser.add_option('--copied-key')
+    parser.add_option('--timeout', type='float', default=600)
+    options, args = parser.parse_args(args)
+    try:
+        waited = wait_until(lambda: cloudinit_done(options.userdata,
+                                                   options.host_key,
+                                                   options.copied_key),
+                            options.timeout)
+    except Timeout:
+        sys.stderr.write('cloud-init not done after %ds\n' % options.timeout)
+        return TIMEOUT
+    json.dump({'waited': waited, 'uptime': boot_finished_uptime()},
+              sys.stdout)
+    return 0
+
+def cmd_wait(args):
+    parser = optparse.OptionParser(usage='wait --path PATH | '
+                                         '--device DEVICE | --process NAME')
+    parser.add_option('--path')
+    parser.add_option('--device')
+    parser.add_option('--process')
+    parser.add_option('--timeout', type='float', default=600)
+    options, args = parser.parse_args(args)
+    conditions = []
+    if options.path is not None:
+        conditions.append(lambda: path_exists(options.path))
+    if options.device is not None:
+        conditions.append(lambda: device_listed(options.device))
+    if options.process is not None:
+        conditions.append(lambda: process_running(options.process))
+    try:
+        waited = wait_until(lambda: all([c() for c in conditions]),
+                            options.timeout)
+    except Timeout:
+        sys.stderr.write('Still waiting after %ds\n' % options.timeout)
+        return TIMEOUT
+    json.dump({'waited': waited}, sys.stdout)
+    return 0
+
+def cmd_debugbundle(args):
+    parser = optparse.OptionParser(usage='debugbundle > BUNDLE.tar.gz')
+    options, args = parser.parse_args(args)
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    debug_bundle(out)
+    out.flush()
+    return 0
+
+COMMANDS = {
+    'fill': cmd_fill,
+    'merkle': cmd_merkle,
+    'leaves': cmd_leaves,
+    'workload': cmd_workload,
+    'blockwrite': cmd_blockwrite,
+    'blockread': cmd_blockread,
+    'stability': cmd_stability,
+    'cloudinit': cmd_cloudinit,
+    'wait': cmd_wait,
+    'debugbundle': cmd_debugbundle,
+}
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in COMMANDS:
+        sys.stderr.write('usage: %s %s [options]\n' %
+                         (argv[0], '|'.join(sorted(COMMANDS))))
+        return 2
+    return COMMANDS[argv[1]](argv[2:])
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
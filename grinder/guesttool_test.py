@@ -0,0 +1,188 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import io
+import pytest
+import subprocess
+import sys
+import tarfile
+import time
+
+import guesttool
+
+PAGE_SIZE = guesttool.PAGE_SIZE
+
+def test_fill_strategies(tmpdir):
+    path = str(tmpdir.join('balloon'))
+    pages = guesttool.CHUNK_PAGES + 3
+
+    root = guesttool.fill(path, pages, 'random', 7)
+    data = open(path, 'rb').read()
+    assert len(data) == pages * PAGE_SIZE
+    unique = set(data[i:i + PAGE_SIZE] for i in range(0, len(data), PAGE_SIZE))
+    assert len(unique) == pages
+    assert guesttool.merkle(path, pages, 256)['root'] == root
+    assert guesttool.fill(path, pages, 'random', 8) != root
+
+    guesttool.fill(path, pages, 'zero', 7)
+    assert open(path, 'rb').read() == b'\0' * pages * PAGE_SIZE
+
+    guesttool.fill(path, pages, 'dedup', 7)
+    data = open(path, 'rb').read()
+    unique = set(data[i:i + PAGE_SIZE] for i in range(0, len(data), PAGE_SIZE))
+    assert len(unique) == guesttool.DEDUP_PAGES
+
+def test_merkle(tmpdir):
+    path = str(tmpdir.join('balloon'))
+    pages = 1000
+    guesttool.fill(path, pages, 'random', 7)
+    result = guesttool.merkle(path, pages, 64)
+    # 1000 leaves, then 500, 250, 125 and 63 nodes.
+    assert result['level'] == 4
+    assert len(result['nodes']) == 63
+
+    data = open(path, 'rb').read()
+    leaves = guesttool.leaves(path, [(3, 4), (999, 999)])
+    assert sorted(leaves) == [3, 4, 999]
+    assert leaves[999] == hashlib.md5(data[999 * PAGE_SIZE:]).hexdigest()
+
+def test_ranges():
+    assert guesttool.ranges([1, 2, 3, 5, 7, 8]) == [(1, 3), (5, 5), (7, 8)]
+    text = guesttool.format_ranges([(1, 3), (5, 5)])
+    assert text == '1-3,5-5'
+    assert guesttool.parse_ranges(text) == [(1, 3), (5, 5)]
+    assert guesttool.parse_ranges('4,6-7') == [(4, 4), (6, 7)]
+
+def test_stdin_script(tmpdir):
+    # The way instances run it: the script on stdin, arguments after '-'.
+    path = str(tmpdir.join('balloon'))
+    source = open(guesttool.__file__.replace('.pyc', '.py')).read()
+    command = [sys.executable, '-', 'fill', path, '--pages', '4',
+               '--seed', '3']
+    tool = subprocess.Popen(command, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE)
+    stdout, _ = tool.communicate(source)
+    assert tool.returncode == 0
+    assert stdout.strip() == guesttool.merkle(path, 4, 256)['root']
+
+def test_access_patterns():
+    sequential = guesttool.AccessPattern('sequential', 10, 0)
+    assert sequential.batch(4) == [0, 1, 2, 3]
+    assert sequential.batch(8) == [4, 5, 6, 7, 8, 9, 0, 1]
+
+    uniform = guesttool.AccessPattern('random', 1000, 0).batch(10000)
+    assert len(set(uniform)) > 900
+    assert guesttool.AccessPattern('random', 1000, 0).batch(100) == \
+           uniform[:100]
+
+    # A zipfian hot set: the 10 hottest pages take a good share of touches.
+    zipf = guesttool.AccessPattern('zipf', 1000, 0).batch(10000)
+    counts = sorted([zipf.count(page) for page in set(zipf)], reverse=True)
+    assert sum(counts[:10]) > 4000
+    assert all(0 <= page < 1000 for page in zipf)
+
+def test_workload_rate():
+    result = guesttool.workload(100, 'random', True, 0.5, rate=2000)
+    assert 500 <= result['touched'] <= 1000 + guesttool.BATCH
+    assert result['pages_per_sec'] <= 2000 + 2 * guesttool.BATCH
+
+def test_block_io(tmpdir):
+    # tmpfs has no O_DIRECT; the data path is the same without it.
+    path = str(tmpdir.join('device'))
+    with open(path, 'wb') as device:
+        device.truncate(4 << 20)
+    offset, size = 1 << 20, (2 << 20) + 3 * PAGE_SIZE
+    wrote = guesttool.block_write(path, offset, size, 'random', 5,
+                                  direct=False)
+    data = open(path, 'rb').read()
+    assert data[:offset] == b'\0' * offset
+    assert wrote['md5'] == hashlib.md5(data[offset:offset + size]).hexdigest()
+    assert wrote['mb_per_sec'] > 0
+
+    read = guesttool.block_read(path, offset, size, 'random', 5, direct=False)
+    assert read['md5'] == wrote['md5']
+    assert read['corrupt'] == []
+
+    with open(path, 'r+b') as device:
+        device.seek(offset + 7 * PAGE_SIZE)
+        device.write(b'x')
+    read = guesttool.block_read(path, offset, size, 'random', 5, direct=False)
+    first = offset // PAGE_SIZE
+    assert read['corrupt'] == [(first + 7, first + 7)]
+
+def test_stability():
+    measured = guesttool.stability(0.1)
+    assert sorted(measured) == ['block', 'cpu', 'memory', 'metadata',
+                                'network']
+    assert all(rate > 0 for rate in measured.values())
+
+def test_cloudinit_done(tmpdir, monkeypatch):
+    monkeypatch.setattr(guesttool, 'BOOT_FINISHED',
+                        str(tmpdir.join('boot-finished')))
+    monkeypatch.setattr(guesttool, 'USER_DATA', str(tmpdir.join('user-data')))
+    assert not guesttool.cloudinit_done()
+    assert guesttool.boot_finished_uptime() is None
+    tmpdir.join('boot-finished').write('12.5 - Mon, 01 Jan 2014 - v. 0.7.5')
+    assert guesttool.cloudinit_done()
+    assert guesttool.boot_finished_uptime() == 12.5
+    assert not guesttool.cloudinit_done(userdata='uuid')
+    tmpdir.join('user-data').write('#!/bin/sh\necho uuid\n')
+    assert guesttool.cloudinit_done(userdata='uuid')
+
+    host_key = str(tmpdir.join('host_key'))
+    copied_key = str(tmpdir.join('copied_key'))
+    assert not guesttool.cloudinit_done(host_key=host_key,
+                                        copied_key=copied_key)
+    tmpdir.join('host_key').write('new key')
+    tmpdir.join('copied_key').write('old key')
+    assert not guesttool.cloudinit_done(host_key=host_key,
+                                        copied_key=copied_key)
+    tmpdir.join('copied_key').write('new key')
+    assert guesttool.cloudinit_done(host_key=host_key, copied_key=copied_key)
+
+def test_wait_until():
+    start = time.time()
+    assert guesttool.wait_until(lambda: time.time() - start > 0.2, 5) >= 0.2
+    with pytest.raises(guesttool.Timeout):
+        guesttool.wait_until(lambda: False, 0.1)
+
+def test_wait_conditions(tmpdir):
+    assert guesttool.process_running(
+        open('/proc/self/stat').read().split('(')[1].split(')')[0])
+    assert not guesttool.process_running('no-such-process')
+    assert not guesttool.device_listed('/dev/no-such-device')
+    assert not guesttool.path_exists(str(tmpdir.join('clone.log')))
+    tmpdir.join('clone.log').write('{}')
+    assert guesttool.path_exists(str(tmpdir.join('clone.log')))
+
+def test_debug_bundle(tmpdir):
+    tmpdir.join('vmsagent.log').write('started\n')
+    tmpdir.join('vmsagent.log.1').write('older\n')
+    out = io.BytesIO()
+    guesttool.debug_bundle(out,
+                           [('echo.txt', 'echo out; echo err >&2; false')],
+                           ['/proc/self/status', str(tmpdir.join('vmsagent*')),
+                            str(tmpdir.join('missing'))])
+    out.seek(0)
+    tar = tarfile.open(fileobj=out, mode='r:gz')
+    contents = dict((m.name, tar.extractfile(m).read())
+                    for m in tar.getmembers())
+    assert contents['echo.txt'] == 'out\nerr\n'
+    assert 'Pid:' in contents['proc/self/status']
+    log = str(tmpdir.join('vmsagent.log')).lstrip('/')
+    assert contents[log] == 'started\n'
+    assert contents[log + '.1'] == 'older\n'
+    assert len(contents) == 4
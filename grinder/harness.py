@@ -29,8 +29,20 @@ from . util import wait_for_status
 from . util import wait_while_exists
 from . util import install_policy
 from . util import NestedExceptionWrapper
+from . util import Deadline
+from . util import budgeted
+from . util import name_prefix
+from . util import volume_prefix
 from . client import create_client
 from . instance import InstanceFactory
+from . reaper import get_reaper
+from . teardown import TeardownGraph
+from . teardown import add_security_group
+from . teardown import add_keypair
+from . pool import get_pool
+from . pool import get_volume_pool
+from . imagecache import agent_image_config
+from . shared import shared_resources
 from . host import Host
 from . network import network_name_to_uuid
 from . requirements import INSTALL_POLICY
@@ -40,8 +52,18 @@ from . requirements import INSTALL_POLICY
 test_name = ''
 
 def boot(client, network_client, config, image_config=None,
-         flavor=None, host=None):
-    name = '%s-%s' % (config.run_name, test_name)
+         flavor=None, host=None, name=None):
+    server = create_server(client, network_client, config, image_config,
+                           flavor, host, name)
+    wait_for_active(server)
+    return server
+
+def create_server(client, network_client, config, image_config=None,
+                  flavor=None, host=None, name=None):
+    '''Creates a server the way boot() does, without waiting for it. The
+    name defaults to one after the running test.'''
+    if name is None:
+        name = '%s-%s' % (config.run_name, test_name)
 
     if image_config == None:
         finder = ImageFinder()
@@ -86,12 +108,15 @@ def boot(client, network_client, config, image_config=None,
                                    userdata=user_data_grinder_UUID)
     setattr(server, 'image_config', image_config)
     setattr(server, 'user_data_grinder_UUID', user_data_grinder_UUID)
+    return server
+
+def wait_for_active(server):
     wait_while_status(server, 'BUILD')
-    assert server.status == 'ACTIVE'
+    assert server.status == 'ACTIVE', \
+        'Server %s is %s, fault: %s' % (server.id, server.status,
+                                        getattr(server, 'fault', None))
     assert getattr(server, 'OS-EXT-STS:power_state') == 1
 
-    return server
-
 class ImageFinder(object):
 
     def __init__(self, skip_on_error=False):
@@ -184,6 +209,29 @@ def requires(*requirements):
         return fn
     return decorator
 
+def reap(harness, description, action, after=None):
+    '''
+    Runs a teardown action, in the background if background_teardown is set
+    (see Reaper.submit for after). Resources whose deletion can't start
+    until the instances using them are gone keep the default after, which
+    waits on what this harness (i.e. this test) has submitted so far.
+    '''
+    reaper = get_reaper(harness.config)
+    if reaper is None:
+        action()
+    else:
+        reaper.submit(description, action, after, group=harness)
+
+def checkout(harness, image_finder, agent, bless, **kwargs):
+    '''
+    Checks a booted master (and its blessed instance, with bless) out of
+    the warm pool. Returns None if there's no pool or nothing ready in it.
+    '''
+    pool = get_pool(harness.config)
+    if pool is None:
+        return None
+    return pool.checkout(harness, image_finder, agent, bless, **kwargs)
+
 class BootedInstance:
     def __init__(self, harness, image_finder, agent, **kwargs):
         self.harness = harness
@@ -192,6 +240,11 @@ class BootedInstance:
         self.kwargs = kwargs
 
     def __enter__(self):
+        entry = checkout(self.harness, self.image_finder, self.agent, False,
+                         **self.kwargs)
+        if entry is not None:
+            self.master, _ = entry
+            return self.master
         self.master = self.harness.boot(self.image_finder,
                                         agent=self.agent, **self.kwargs)
         return self.master
@@ -199,23 +252,33 @@ class BootedInstance:
     def __exit__(self, type, value, tb):
         if type == None:
             try:
-                self.master.get_debug_data()
-            except:
-                # Any errors generated inspecting the state of the system are
-                # irrelevant to the test being run
-                log.info("Failed to gather booted instance data on exit. Sorry.")
-            self.__assert_delete_artifacts()
+                self.master.breadcrumbs.checkpoint()
+                if not self.harness.config.skip_debug_on_pass:
+                    self.__get_debug_data()
+            finally:
+                self.__assert_delete_artifacts()
         else:
+            self.__get_debug_data()
             if not(self.harness.config.leave_on_failure):
                 with NestedExceptionWrapper() as wrapper:
                     self.__assert_delete_artifacts()
             return False
 
+    def __get_debug_data(self):
+        try:
+            self.master.get_debug_data()
+        except:
+            # Any errors generated inspecting the state of the system are
+            # irrelevant to the test being run
+            log.info("Failed to gather booted instance data on exit. Sorry.")
+
     def __assert_delete_artifacts(self):
         host = self.master.get_host()
         instance_name = getattr(self.master.server, 'OS-EXT-SRV-ATTR:instance_name', None)
-        self.master.delete(recursive=True)
-        self.master.assert_delete_artifacts(instance_name, host)
+        def delete():
+            self.master.delete(recursive=True)
+            self.master.assert_delete_artifacts(instance_name, host)
+        reap(self.harness, str(self.master), delete, after=[])
 
 
 class BlessedInstance:
@@ -226,6 +289,11 @@ class BlessedInstance:
         self.kwargs = kwargs
 
     def __enter__(self):
+        entry = checkout(self.harness, self.image_finder, self.agent, True,
+                         **self.kwargs)
+        if entry is not None:
+            self.master, self.blessed = entry
+            return self.blessed
         self.master = self.harness.boot(self.image_finder,
                                         agent=self.agent, **self.kwargs)
         try:
@@ -239,54 +307,119 @@ class BlessedInstance:
 
     def __exit__(self, type, value, tb):
         if type == None or not(self.harness.config.leave_on_failure):
-            self.blessed.discard(recursive=True)
-            self.master.delete(recursive=True)
+            try:
+                if type == None:
+                    self.master.breadcrumbs.checkpoint()
+            finally:
+                # One teardown graph: clones, then the blessed instance, then
+                # the master and its volumes.
+                reap(self.harness, str(self.master),
+                     lambda: self.master.delete(recursive=True,
+                                                blessed=[self.blessed]),
+                     after=[])
 
 class SecurityGroup:
-    def __init__(self, harness):
+    '''
+    A security group letting in ssh, the Windows Test Listener and icmp.
+    Unless private, it's shared with other tests of this process (see
+    SharedResources) and deleted at the end of the session; tests that
+    change the group itself must ask for a private one.
+    '''
+    def __init__(self, harness, private=False):
         self.harness = harness
-        self.name = str(uuid.uuid4())
+        self.private = private
+        self.name = name_prefix(harness.config.run_name) + str(uuid.uuid4())
+        self.key = ('security_group', harness.config.ssh_port,
+                    harness.config.windows_link_port)
 
     def __enter__(self):
-        self.secgroup = self.harness.nova.security_groups.create(self.name, 'Created by grinder')
+        if self.private:
+            self.secgroup = self.create()
+        else:
+            nova = self.harness.nova
+            self.secgroup = shared_resources.acquire(self.key, self.harness,
+                self.create, nova.security_groups.delete)
+        return self.secgroup
+
+    def create(self):
+        secgroup = self.harness.nova.security_groups.create(self.name, 'Created by grinder')
         # Must allow ssh, Windows Test Listener, and icmp for further use.
         ssh_port = self.harness.config.ssh_port
         win_port = self.harness.config.windows_link_port
         for port in [ssh_port, win_port]:
-            self.harness.nova.security_group_rules.create(self.secgroup.id,\
+            self.harness.nova.security_group_rules.create(secgroup.id,\
                 ip_protocol="tcp", from_port=port, to_port=port, cidr="0.0.0.0/0")
-        self.harness.nova.security_group_rules.create(self.secgroup.id,\
+        self.harness.nova.security_group_rules.create(secgroup.id,\
             ip_protocol="icmp", from_port=-1, to_port=-1, cidr="0.0.0.0/0")
-        return self.secgroup
+        return secgroup
 
     def __exit__(self, type, value, tb):
-        if type == None or not(self.harness.config.leave_on_failure):
-            self.harness.nova.security_groups.delete(self.secgroup)
+        if not self.private:
+            shared_resources.release(self.key, self.harness, self.secgroup)
+        elif type == None or not(self.harness.config.leave_on_failure):
+            reap(self.harness, 'security group %s' % self.name, self.delete)
+
+    def delete(self):
+        # Servers still using the group (e.g. being reaped) go first.
+        nova = self.harness.nova
+        graph = TeardownGraph()
+        add_security_group(graph, nova, self.secgroup,
+                           servers=nova.servers.list())
+        graph.run()
 
 class Keypair:
-    def __init__(self, harness):
+    '''
+    A keypair, shared like SecurityGroup unless private.
+    '''
+    def __init__(self, harness, private=False):
         self.harness = harness
-        self.name = str(uuid.uuid4())
+        self.private = private
+        self.name = name_prefix(harness.config.run_name) + str(uuid.uuid4())
+        self.key = ('keypair',)
 
     def __enter__(self):
-        self.keypair = self.harness.nova.keypairs.create(self.name)
+        if self.private:
+            self.keypair = self.harness.nova.keypairs.create(self.name)
+        else:
+            nova = self.harness.nova
+            self.keypair = shared_resources.acquire(self.key, self.harness,
+                lambda: nova.keypairs.create(self.name), nova.keypairs.delete)
         return self.keypair
 
     def __exit__(self, type, value, tb):
-        if type == None or not(self.harness.config.leave_on_failure):
-            self.harness.nova.keypairs.delete(self.keypair)
+        if not self.private:
+            shared_resources.release(self.key, self.harness, self.keypair)
+        elif type == None or not(self.harness.config.leave_on_failure):
+            reap(self.harness, 'keypair %s' % self.name, self.delete)
+
+    def delete(self):
+        nova = self.harness.nova
+        graph = TeardownGraph()
+        add_keypair(graph, nova, self.keypair, servers=nova.servers.list())
+        graph.run()
 
 class Volume:
     def __init__(self, harness, size=None, **kwargs):
         self.harness = harness
-        self.name = "grindervol-%s" % str(uuid.uuid4())
+        self.name = volume_prefix(harness.config.run_name) + str(uuid.uuid4())
         if size is None:
             self.size = 1
         else:
             self.size = size
         self.kwargs = kwargs
+        self.pool = None
 
     def __enter__(self):
+        if len(self.kwargs) == 0:
+            self.pool = get_volume_pool(self.harness)
+        if self.pool is not None:
+            self.volume = self.pool.checkout(self.size)
+            if self.volume is not None:
+                self.name = self.volume.display_name
+                log.debug("Checked out volume %s size %ld from the pool" %\
+                            (self.name, long(self.size)))
+                return self.volume
+            self.pool = None
         log.debug("Creating volume %s size %ld kwargs %s" %\
                     (self.name, long(self.size), str(self.kwargs)))
         self.volume = self.harness.cinder.volumes.create(
@@ -298,8 +431,13 @@ class Volume:
         if type == None or not(self.harness.config.leave_on_failure):
             log.debug("Deleting volume %s size %ld kwargs %s" %\
                 (self.name, long(self.size), str(self.kwargs)))
-            self.volume.delete()
-            wait_while_exists(self.volume)
+            def delete():
+                if self.pool is not None:
+                    self.pool.checkin(self.volume)
+                    return
+                self.volume.delete()
+                wait_while_exists(self.volume)
+            reap(self.harness, 'volume %s' % self.name, delete)
 
 class Policy:
     """
@@ -407,10 +545,18 @@ class TestHarness(Notifier):
         pass
 
     @Notifier.notify
+    @budgeted('boot')
     def boot(self, image_finder, agent=True, flavor=None, host=None):
         image_config = image_finder.find(self.nova, self.config)
+        if agent and self.config.agent_image_cache and \
+           not image_config.agent_skip:
+            image_config = agent_image_config(self, image_config)
+        return self.boot_image(image_config, agent, flavor, host)
+
+    def boot_image(self, image_config, agent=True, flavor=None, host=None):
         server = boot(self.nova, self.network, self.config,
-                      image_config, flavor, host)
+                      image_config, flavor, host,
+                      '%s-%s' % (self.config.run_name, self.test_name))
         instance = InstanceFactory.create(self, server, image_config)
         try:
             assert getattr(instance, 'id') is not None
@@ -424,8 +570,12 @@ class TestHarness(Notifier):
             raise
         if agent:
             try:
-                instance.install_agent()
-                instance.post_hook_cloudinit()
+                if image_config.agent_cached:
+                    # Installed, hooks and all, when the image was built.
+                    instance.assert_agent_running()
+                else:
+                    instance.install_agent()
+                    instance.post_hook_cloudinit()
 
             except:
                 if not(self.config.leave_on_failure):
@@ -445,11 +595,11 @@ class TestHarness(Notifier):
     def blessed(self, image_finder, agent=True, **kwargs):
         return BlessedInstance(self, image_finder, agent, **kwargs)
 
-    def security_group(self):
-        return SecurityGroup(self)
+    def security_group(self, private=False):
+        return SecurityGroup(self, private)
 
-    def keypair(self):
-        return Keypair(self)
+    def keypair(self, private=False):
+        return Keypair(self, private)
 
     def volume(self, size=None, **kwargs):
         return Volume(self, size=size, **kwargs)
@@ -472,6 +622,7 @@ class TestHarness(Notifier):
 class TestCase(object):
 
     harness = None
+    deadline = None
 
     def setup_method(self, method):
         self.config = default_config
@@ -491,6 +642,16 @@ class TestCase(object):
             if not(default_config.host_user):
                 pytest.skip('Need host user to run %s.' % method.__name__)
 
+        # Opened last: pytest doesn't call teardown_method if setup fails.
+        if self.config.test_budget is not None:
+            self.deadline = Deadline(self.config.test_budget, test_name)
+            self.deadline.__enter__()
+
     def teardown_method(self, method):
-        if self.harness:
-            self.harness.teardown()
+        try:
+            if self.harness:
+                self.harness.teardown()
+        finally:
+            if self.deadline is not None:
+                self.deadline.__exit__(None, None, None)
+                self.deadline = None
@@ -0,0 +1,115 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import copy
+import hashlib
+import os
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from tempfile import gettempdir
+
+from . logger import log
+from . util import wait_for
+from . util import Deadline
+
+# Metadata on derived images: which image they were built from, and the key
+# of the agent they carry.
+BASE_KEY = 'grinder_agent_base'
+AGENT_KEY = 'grinder_agent_key'
+
+def agent_image_key(config, image_config, base_id):
+    '''
+    Identifies the agent a derived image of image_config would carry. Any
+    change to the base image or to where and which agent gets installed
+    yields a new key, so stale derived images are never used.
+    '''
+    if image_config.platform == 'windows':
+        location = config.windows_agent_location
+        version = None
+    else:
+        location = config.agent_location
+        version = config.agent_version
+    digest = hashlib.sha1(repr((image_config.name, base_id,
+                                image_config.platform, image_config.arch,
+                                location, version)))
+    return digest.hexdigest()[:12]
+
+def agent_image_name(image_config, key):
+    return '%s-agent-%s' % (image_config.name, key)
+
+def find_image(nova, name):
+    for image in nova.images.list():
+        if image.name == name and image.status == 'ACTIVE':
+            return image
+    return None
+
+def agent_image_config(harness, image_config):
+    '''
+    Returns a copy of image_config naming a derived image that already has
+    the agent installed, building it first if needed. One worker builds a
+    given image; workers on the same machine wait on a lock file meanwhile.
+    '''
+    nova = harness.nova
+    base = nova.images.find(name=image_config.name)
+    key = agent_image_key(harness.config, image_config, base.id)
+    name = agent_image_name(image_config, key)
+
+    derived = copy.copy(image_config)
+    derived.name = name
+    derived.agent_cached = True
+    if find_image(nova, name) is not None:
+        return derived
+
+    lock_path = os.path.join(gettempdir(), 'grinder-agent-image.%s' % key)
+    lock_fp = open(lock_path, 'a')
+    try:
+        flock(lock_fp, LOCK_EX)
+        if find_image(nova, name) is None:
+            build_agent_image(harness, image_config, base, key, name)
+    finally:
+        flock(lock_fp, LOCK_UN)
+        lock_fp.close()
+    return derived
+
+def build_agent_image(harness, image_config, base, key, name):
+    # The build is not part of the budget of the boot that needed it.
+    with Deadline(harness.config.operation_budget, 'building %s' % name,
+                  detached=True):
+        log.info('Building agent image %s from %s', name, base.name)
+        instance = harness.boot_image(image_config, agent=True)
+        try:
+            instance.prepare_snapshot()
+            image_id = instance.server.create_image(
+                name, {BASE_KEY: base.id, AGENT_KEY: key})
+            def condition():
+                image = harness.nova.images.get(image_id)
+                assert image.status != 'ERROR', \
+                    'Snapshot %s of %s failed' % (name, instance)
+                return image.status == 'ACTIVE'
+            wait_for('image %s to be ACTIVE' % name, condition)
+        finally:
+            instance.delete()
+
+    # Whatever was built from the same base for another agent is stale.
+    for image in harness.nova.images.list():
+        metadata = getattr(image, 'metadata', {})
+        if metadata.get(BASE_KEY) == base.id and \
+           metadata.get(AGENT_KEY) != key:
+            log.info('Deleting stale agent image %s', image.name)
+            try:
+                harness.nova.images.delete(image)
+            except:
+                log.exception('Failed to delete stale agent image %s',
+                              image.name)
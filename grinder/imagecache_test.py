@@ -0,0 +1,40 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import imagecache
+from config import Config, Image
+
+def test_agent_image_key():
+    config = Config()
+    image = Image('precise', distro='ubuntu', arch='64')
+    key = imagecache.agent_image_key(config, image, 'base-id')
+    assert key == imagecache.agent_image_key(config, image, 'base-id')
+    assert imagecache.agent_image_name(image, key) == 'precise-agent-' + key
+
+    # A new base image, agent location or agent version invalidates it.
+    assert key != imagecache.agent_image_key(config, image, 'other-id')
+    config.agent_version = '1.2'
+    assert key != imagecache.agent_image_key(config, image, 'base-id')
+    config.agent_version = 'latest'
+    config.agent_location = 'http://example.com/agent'
+    assert key != imagecache.agent_image_key(config, image, 'base-id')
+
+    # Windows images only care about the Windows agent.
+    windows = Image('win7', distro='win7', arch='64', platform='windows')
+    key = imagecache.agent_image_key(config, windows, 'base-id')
+    config.agent_location = None
+    assert key == imagecache.agent_image_key(config, windows, 'base-id')
+    config.windows_agent_location += 'gc-agent-0.5-amd64-release.msi'
+    assert key != imagecache.agent_image_key(config, windows, 'base-id')
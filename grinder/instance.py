@@ -14,11 +14,14 @@
 #    under the License.
 
 import json
+import os
 import time
 import random
 import tempfile
 import re
 
+import pytest
+
 from . logger import log
 from . util import Notifier
 from . shell import SecureShell
@@ -29,15 +32,34 @@ from . vmsctl import Vmsctl
 from . breadcrumbs import SSHBreadcrumbs
 from . breadcrumbs import LinkBreadcrumbs
 from . util import fix_url_for_yum
+from . artifactcache import cached_location
 from . util import wait_for
-from . util import wait_for_ping
+from . util import remaining_time
 from . util import wait_while_status
 from . util import wait_for_status
 from . util import wait_while_exists
+from . util import wait_while_all_status
+from . util import wait_while_all_exist
 from . util import NestedExceptionWrapper
+from . util import budgeted
+from . util import resource_listing
+from . util import Watchdog
 from . shell import wait_for_shell
+from . shell import SSH_ERROR
+from . probe import Prober
+from . teardown import TeardownGraph
+from . merkle import balloon_tree
+from . merkle import page_ranges
+from . guesttool import format_ranges
+from . guesttool import TIMEOUT as WAIT_TIMEOUT
+from . guesttool import BOOT_FINISHED
+from . guesttool import USER_DATA
+from . guesttool import DEBUG_COMMANDS
+from . guesttool import DEBUG_FILES
 from . requirements import AVAILABILITY_ZONE, SCHEDULER_HINTS
 
+GUESTTOOL_PATH = os.path.join(os.path.dirname(__file__), 'guesttool.py')
+
 def get_addrs(server, network=None):
     log.debug('get_addrs network=%s: %s', network, server.networks)
     if network != None:
@@ -48,6 +70,93 @@ def get_addrs(server, network=None):
             ips.extend(network)
         return ips
 
+def wait_for_reachable(instances):
+    '''
+    Probes all of the instances at once until each one accepts connections
+    on its ssh (or link) port, and logs how long each took.
+    '''
+    prober = Prober()
+    for instance in instances:
+        prober.add(instance.get_address(), instance.probe_port(),
+                   icmp=instance.probe_icmp)
+    results = prober.wait()
+    for instance in instances:
+        result = results[instance.get_address()]
+        log.info('%s reachable after %.2fs (icmp: %s)', instance,
+                 result['tcp'], result['icmp'] is None and 'n/a' or
+                 '%.2fs' % result['icmp'])
+    return results
+
+def describe_fault(server):
+    fault = getattr(server, 'fault', None)
+    if not fault:
+        return None
+    return '%s (code %s)' % (fault.get('message'), fault.get('code'))
+
+class InstanceFailure(Exception):
+    pass
+
+class InstanceWatchdog(Watchdog):
+    '''
+    Fails waits on an instance as soon as it can no longer come good: the
+    server went to ERROR or was deleted, a new fault showed up in its record,
+    its qemu process died, or ssh to its compute host was lost. The server
+    record is checked every API_INTERVAL seconds through the shared listing
+    and the host every HOST_INTERVAL seconds, only while the server is
+    ACTIVE with no task in flight (i.e. not while it is being migrated).
+    '''
+    API_INTERVAL = 2.0
+    HOST_INTERVAL = 10.0
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.initial_fault = describe_fault(instance.server)
+        self.last_api_check = 0
+        self.last_host_check = time.time()
+
+    def fail(self, cause):
+        message = '%s failed: %s' % (self.instance, cause)
+        log.error(message)
+        raise InstanceFailure(message)
+
+    def check(self):
+        now = time.time()
+        if now - self.last_api_check >= self.API_INTERVAL:
+            self.last_api_check = now
+            self.check_server()
+        if now - self.last_host_check >= self.HOST_INTERVAL:
+            self.last_host_check = now
+            self.check_host()
+
+    def check_server(self, refresh=True):
+        server = self.instance.server
+        if refresh and not resource_listing.refresh(server):
+            self.fail('server no longer exists')
+        fault = describe_fault(server)
+        if server.status in ['ERROR', 'DELETED']:
+            self.fail('server went to %s, fault: %s' % (server.status, fault))
+        if fault is not None and fault != self.initial_fault:
+            self.fail('server reported fault %s' % fault)
+
+    def check_host(self):
+        server = self.instance.server
+        hostname = getattr(server, 'OS-EXT-SRV-ATTR:host', None)
+        instance_name = getattr(server, 'OS-EXT-SRV-ATTR:instance_name', None)
+        if not self.instance.harness.config.host_user or \
+           hostname is None or instance_name is None or \
+           server.status != 'ACTIVE' or \
+           getattr(server, 'OS-EXT-STS:task_state', None) is not None:
+            return
+        host = Host(hostname, self.instance.harness.config)
+        # The brackets keep pgrep from matching the shell running it.
+        _, _, rc = host.check_output('pgrep -f "[q]emu.*%s"' % instance_name,
+                                     expected_rc=None, returnrc=True)
+        if rc == SSH_ERROR:
+            self.fail('lost ssh connection to host %s' % hostname)
+        elif rc != 0:
+            self.fail('qemu process for %s is gone from host %s' %
+                      (instance_name, hostname))
+
 class InstanceFactory(object):
 
     @staticmethod
@@ -89,11 +198,22 @@ class Instance(Notifier):
         else:
             self.privkey_path = self.image_config.key_path
 
-    def wait_for_boot(self, status='ACTIVE', wait_for_cloudinit=True):
-        self.wait_while_status('BUILD')
-        assert self.get_status() == status
-        if status == 'ACTIVE':
-            self.instance_wait_for_ping()
+    def wait_for_boot(self, status='ACTIVE', wait_for_cloudinit=True,
+                      reachable=False):
+        if status != 'ACTIVE':
+            # The caller expects the server to fail (e.g. ERROR), so don't
+            # let the watchdog treat that as a lost instance.
+            self.wait_while_status('BUILD')
+            assert self.get_status() == status
+            return
+        with InstanceWatchdog(self) as watchdog:
+            self.wait_while_status('BUILD')
+            # Report why the server failed rather than just its status.
+            watchdog.check_server(refresh=False)
+            assert self.get_status() == status
+            # Skip the probe if the caller already probed a whole batch.
+            if not reachable:
+                wait_for_reachable([self])
             wait_for_shell(self.get_shell())
             if wait_for_cloudinit:
                 self.ensure_cloudinit_done()
@@ -103,13 +223,18 @@ class Instance(Notifier):
                  lambda: self.get_host().id != host.id, duration=duration)
 
     def wait_for_migrate(self, host, dest, duration, willfail=False):
-        self.wait_while_status('ACTIVE')
-        self.wait_while_status('MIGRATING')
         if willfail:
+            # A failed migration is expected to leave a fault behind.
+            self.wait_while_status('ACTIVE')
+            self.wait_while_status('MIGRATING')
             self.assert_alive(host)
         else:
+            with InstanceWatchdog(self):
+                self.wait_while_status('ACTIVE')
+                self.wait_while_status('MIGRATING')
             self.assert_alive(dest)
             self.breadcrumbs.add('post migration to %s' % dest.id)
+            self.breadcrumbs.checkpoint()
 
     def wait_while_status(self, status):
         wait_while_status(self.server, status)
@@ -131,8 +256,7 @@ class Instance(Notifier):
             assert False
 
     def wait_while_snapshots_exist(self):
-        for snapshot in self.volume_snapshots:
-            wait_while_exists(snapshot)
+        wait_while_all_exist(self.volume_snapshots)
 
     def __str__(self):
         return 'Instance(name=%s, id=%s)' % (self.server.name, self.id)
@@ -233,6 +357,8 @@ class Instance(Notifier):
     def bless(self, **kwargs):
         log.info('Blessing %s', self)
         self.breadcrumbs.add('Pre bless')
+        # Clones inherit the trail the guest has when blessed.
+        self.breadcrumbs.checkpoint()
 
         # Unconditionally set up the params script on the master. This
         # operation is idempotent, so it is safe to do this even if
@@ -280,6 +406,7 @@ class Instance(Notifier):
             instance.volume_snapshots = created_snapshots
 
             self.breadcrumbs.add('Post bless, child is %s' % instance.id)
+            self.breadcrumbs.checkpoint()
         except:
             if not(self.harness.config.leave_on_failure):
                 # Don't change the stacktrace of the original failure
@@ -290,6 +417,7 @@ class Instance(Notifier):
         return instance
 
     @Notifier.notify
+    @budgeted()
     def launch(self, target=None, guest_params=None, status='ACTIVE', name=None,
                user_data=None, security_groups=None, availability_zone=None,
                num_instances=None, keypair=None, scheduler_hints=None,
@@ -363,7 +491,11 @@ class Instance(Notifier):
                 launched_list.append(launched)
         assert len(launched_list) >= 1
 
-        clones = []
+        # Let all of the clones come out of BUILD together, polled from a
+        # single listing, before checking each one in turn.
+        wait_while_all_status(launched_list, 'BUILD')
+
+        instances = []
         for launched in launched_list:
             assert launched.id != self.id
             assert launched.status in [status, 'BUILD']
@@ -382,12 +514,25 @@ class Instance(Notifier):
             assert instance.server.metadata['launched_from'] == str(self.id)
             instance.is_clone = True
             instance.breadcrumbs = self.snapshot.instantiate(instance)
+            instances.append(instance)
+
+        # Probe all of the clones at once rather than one after the other.
+        reachable = False
+        if status == 'ACTIVE' and len(instances) > 1:
+            wait_for_reachable(instances)
+            reachable = True
+
+        clones = []
+        for instance in instances:
             # wait_for_boot has a handy side effect: It calls .get() so the client item is refreshed
-            instance.wait_for_boot(status)
+            instance.wait_for_boot(status, reachable=reachable)
+            if status == 'ACTIVE':
+                # Check the clone got the trail it was blessed with.
+                instance.breadcrumbs.checkpoint()
 
             # Make sure all volumes are here
             instance.volumes = self.harness.cinder.volumes.list(
-                search_opts={'instance_uuid': getattr(launched, 'id')})
+                search_opts={'instance_uuid': instance.id})
             # (OmgLag): Recreate this list of IDs for each launched instance
             # since we're going to be popping IDs as they're found
             snapshot_ids = [s.id for s in self.volume_snapshots]
@@ -440,21 +585,20 @@ class Instance(Notifier):
         self.wait_while_status('PAUSED')
         self.wait_for_boot(wait_for_cloudinit=False)
 
-    def instance_wait_for_ping(self):
-        wait_for_ping([self.get_address()])
-
     def assert_alive(self, host=None):
         assert self.get_status() == 'ACTIVE'
         if host != None:
             assert self.get_host().id == host.id
-        self.instance_wait_for_ping()
-        wait_for_shell(self.get_shell())
+        with InstanceWatchdog(self):
+            wait_for_reachable([self])
+            wait_for_shell(self.get_shell())
         if host != None:
             self.breadcrumbs.add('alive on host %s' % host.id)
         else:
             self.breadcrumbs.add('alive')
 
     @Notifier.notify
+    @budgeted()
     def migrate(self, host, dest, duration=None, willfail=False):
         if duration is None and 'windows' in self.image_config.platform.lower():
             duration = int(1.5 * int(self.harness.config.ops_timeout))
@@ -489,19 +633,87 @@ class Instance(Notifier):
             check_iptables_post_migrate(host, dest)
 
     @Notifier.notify
-    def delete(self, recursive=False):
+    @budgeted(detached=True)
+    def delete(self, recursive=False, blessed=None):
+        graph = TeardownGraph()
+        self.add_teardown(graph, recursive, blessed)
+        graph.run()
+
+    @Notifier.notify
+    @budgeted(detached=True)
+    def discard(self, recursive=False):
+        graph = TeardownGraph()
+        self.add_discard(graph, recursive)
+        graph.run()
+
+    def add_teardown(self, graph, recursive=False, blessed=None, after=(),
+                     action=None):
+        '''
+        Adds the steps deleting this instance to graph and returns the last
+        one, which runs action (delete_server by default). With recursive,
+        blessed children (and their clones) are discarded first; blessed can
+        hold Instances the caller already has for some of those children.
+        Volumes are detached concurrently with the discards, the server goes
+        once both are done.
+        '''
+        known = dict((instance.id, instance) for instance in blessed or [])
+        children = []
         if recursive:
             for id in self.list_blessed():
-                instance = self.__class__(
-                    self.harness,
-                    self.harness.nova.servers.get(id),
-                    self.image_config, breadcrumbs=False)
-                instance.discard(recursive=True)
+                instance = known.get(id)
+                if instance is None:
+                    instance = self.__class__(
+                        self.harness,
+                        self.harness.nova.servers.get(id),
+                        self.image_config, breadcrumbs=False)
+                children.append(instance.add_discard(graph, True, after))
+        detached = []
         if (not self.is_clone):
             for volume in self.volumes:
-                log.info('Detaching volume %s', volume.id)
-                volume.detach()
-                wait_for_status(volume, 'available')
+                detached.append(graph.add(
+                    'detach volume %s from %s' % (volume.id, self),
+                    lambda volume=volume: self.detach_for_delete(volume),
+                    after=after))
+        return graph.add('delete %s' % self, action or self.delete_server,
+                         after=list(after) + children + detached)
+
+    def add_discard(self, graph, recursive=False, after=()):
+        '''
+        Adds the steps discarding this blessed instance to graph and returns
+        the last one. With recursive, its launched clones are deleted first.
+        '''
+        clones = []
+        if recursive:
+            clones = self.add_launched_teardown(graph, after)
+        return graph.add('discard %s' % self, self.discard_server,
+                         after=list(after) + clones)
+
+    def add_launched_teardown(self, graph, after=()):
+        nodes = []
+        for id in self.list_launched():
+            instance = self.__class__(
+                self.harness,
+                self.harness.nova.servers.get(id),
+                self.image_config, breadcrumbs=False)
+            # Some tests purposefully fail the creation of an instance. So we
+            # may race here with a launched instance in BUILD status still present
+            # yet bound to make the delete fail
+            def delete_server(instance=instance, id=id):
+                try:
+                    instance.delete_server()
+                except:
+                    if id in self.list_launched():
+                        raise
+            nodes.append(instance.add_teardown(graph, True, after=after,
+                                               action=delete_server))
+        return nodes
+
+    def detach_for_delete(self, volume):
+        log.info('Detaching volume %s', volume.id)
+        volume.detach()
+        wait_for_status(volume, 'available')
+
+    def delete_server(self):
         log.info('Deleting %s', self)
         # Extra care to ensure we don't leak snapshots
         # (which later fail volume deletion)
@@ -510,18 +722,13 @@ class Instance(Notifier):
                 snapshots = self.get_volume_snapshots()
                 if snapshots == []:
                     break
-                for snap in snapshots:
-                    wait_while_exists(snap)
+                wait_while_all_exist(snapshots)
         self.server.delete()
         self.wait_while_exists()
         if (self.is_clone):
-            for volume in self.volumes:
-                wait_while_exists(volume)
+            wait_while_all_exist(self.volumes)
 
-    @Notifier.notify
-    def discard(self, recursive=False):
-        if recursive:
-            self.delete_launched()
+    def discard_server(self):
         log.info('Discarding %s', self)
         self.harness.gcapi.discard_instance(self.server)
         self.wait_while_exists()
@@ -533,21 +740,11 @@ class Instance(Notifier):
     def list_launched(self):
         return map(lambda x: x['id'], self.harness.gcapi.list_launched_instances(self.server))
 
+    @budgeted(detached=True)
     def delete_launched(self):
-        for id in self.list_launched():
-            instance = self.__class__(
-                self.harness,
-                self.harness.nova.servers.get(id),
-                self.image_config, breadcrumbs=False)
-            # Some tests purposefully fail the creation of an instance. So we
-            # may race here with a launched instance in BUILD status still present
-            # yet bound to make the delete fail
-            try:
-                instance.delete(recursive=True)
-            except:
-                if id in self.list_launched():
-                    raise
-            time.sleep(1.0) # Sleep after the delete.
+        graph = TeardownGraph()
+        self.add_launched_teardown(graph)
+        graph.run()
 
     def vmsctl(self):
         return Vmsctl(self)
@@ -578,8 +775,7 @@ class Instance(Notifier):
 
         wait_for_status(volume, 'in-use')
 
-        wait_for('volume %s to be listed' % (volume.id), \
-            lambda: device in self.list_devices())
+        self.wait_for_device(device)
 
         return device
 
@@ -594,9 +790,32 @@ class Instance(Notifier):
 
     ### Platform-specific functionality.
 
+    # Whether the guest answers ICMP echo.
+    probe_icmp = True
+
+    def probe_port(self):
+        '''
+        The port that accepts connections once the guest is reachable.
+        '''
+        raise NotImplementedError()
+
     def get_debug_data(self):
         raise NotImplementedError()
 
+    def debug_bundle_path(self, suffix='.tar.gz'):
+        '''Where this instance's debug data goes for the current test.'''
+        directory = os.path.join(
+            self.harness.config.debug_bundle_dir or
+            os.path.join(tempfile.gettempdir(), 'grinder-debug'),
+            self.harness.test_name.replace(os.sep, '_'))
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        return os.path.join(directory, '%s%s' % (self.id, suffix))
+
     def get_shell(self):
         raise NotImplementedError()
 
@@ -606,6 +825,19 @@ class Instance(Notifier):
     def ensure_cloudinit_done(self):
         raise NotImplementedError()
 
+    def wait_for_path(self, path):
+        '''Waits until path exists in the guest.'''
+        raise NotImplementedError()
+
+    def wait_for_device(self, device):
+        '''Waits until the guest lists device.'''
+        wait_for('%s to list %s' % (self, device),
+                 lambda: device in self.list_devices())
+
+    def wait_for_process(self, name):
+        '''Waits until a process called name runs in the guest.'''
+        raise NotImplementedError()
+
     def setup_params(self):
         '''
         Performs any configuration on the guest necessary for reading
@@ -636,6 +868,13 @@ class Instance(Notifier):
     def post_hook_cloudinit(self):
         raise NotImplementedError()
 
+    def prepare_snapshot(self):
+        '''
+        Gets the guest ready to be snapshotted into an image that later
+        instances boot from.
+        '''
+        raise NotImplementedError()
+
     def assert_userdata(self, userdata):
         '''
         Ensure the userdata visible from the guest matches the argument to this
@@ -651,36 +890,61 @@ class Instance(Notifier):
         '''
         raise NotImplementedError()
 
-    def assert_guest_stable(self):
+    def measure_guest_stability(self):
+        '''
+        Runs a fixed-duration workload suite in the guest and returns the
+        rate each part achieved, as a dict. Rates are only comparable
+        between measurements of the same image and flavor.
+        '''
+        raise NotImplementedError()
+
+    def assert_guest_stable(self, baseline=None):
         '''
         A more expensive but more comprehensive test to ensure the guest
         operating system is stable. This operation may touch a significant
         amount of memory (which can cause a lot of hypervisor memory related
         operations such as fetching and sharing) and should excercise kernel
         functionality to rule out driver and guest memory malfunctions.
+        Given a baseline from measure_guest_stability(), also fails if the
+        guest got more than stability_max_slowdown times slower at any
+        part. Returns the new measurements.
         '''
         raise NotImplementedError()
 
+    def check_stability(self, measured, baseline):
+        if baseline is None:
+            return
+        slowdown = self.harness.config.stability_max_slowdown
+        slow = ['%s %.1f -> %.1f' % (name, rate, measured[name])
+                for name, rate in sorted(baseline.items())
+                if measured[name] * slowdown < rate]
+        assert len(slow) == 0, '%s slowed down more than %.1fx: %s' % \
+            (self, slowdown, ', '.join(slow))
+
     def drop_caches(self):
         '''
         Cause the guest operating system to drop all cached memory.
         '''
         raise NotImplementedError()
 
-    def allocate_balloon(self, size_pages):
+    def allocate_balloon(self, size_pages, strategy='random'):
         '''
         Allocates a memory region of size 'size_pages' in the guest. Returns a
         fingerprint of the memory region which can be used with
         assert_balloon_integrity() to verify the integrity of the balloon. Only
         a single balloon may be allocated on a guest. The effects of allocating
-        a new balloon without releasing the previous are undefined.
+        a new balloon without releasing the previous are undefined. The
+        strategy is 'random' for unique pages, or 'zero' or 'dedup' for pages
+        the hypervisor can share.
         '''
         raise NotImplementedError()
 
-    def assert_balloon_integrity(self, fingerprint):
+    def assert_balloon_integrity(self, fingerprint, sample=None):
         '''
         Ensures the instance's current balloon's fingerprint matches the
-        provided fingerprint.
+        provided fingerprint. Where supported, a failure names the corrupt
+        pages, and sample checks only that many random pages instead of the
+        whole balloon.
         '''
         raise NotImplementedError()
 
@@ -699,6 +963,17 @@ class Instance(Notifier):
         is safe to call when no balloon has been allocated.
         '''
 
+    def run_memory_workload(self, wss_pages, pattern='sequential', dirty=True,
+                            rate=None, duration=10, seed=None):
+        '''
+        Touches a working set of wss_pages pages of guest memory for duration
+        seconds, in the given pattern ('sequential', 'random' or 'zipf' for a
+        hot set), writing to the pages if dirty, and at most rate pages per
+        second if given. The same seed gives the same sequence of touches.
+        Returns a dict with the achieved 'pages_per_sec', among other stats.
+        '''
+        raise NotImplementedError()
+
     def list_devices(self):
         '''
         List attached devices.
@@ -711,11 +986,12 @@ class Instance(Notifier):
         '''
         raise NotImplementedError()
 
-    def prime_volume(self, device):
+    def prime_volume(self, device, size_mb=None, offset_mb=0):
         '''
         Format and do block IO to store random bytes on a named volume.
         Returns the hash of the random bytes, which are guaranteed to
-        not be cached in RAM.
+        not be cached in RAM. size_mb defaults to the configured
+        volume_io_mb; offset_mb only applies to raw I/O.
         '''
         raise NotImplementedError()
 
@@ -723,6 +999,7 @@ class Instance(Notifier):
         '''
         Remount the named volume and verify the stored random bytes.
         Shred those bytes to test consistency of parent/sibling volumes.
+        md5 is what prime_volume() returned.
         '''
         raise NotImplementedError()
 
@@ -770,18 +1047,25 @@ open("/tmp/clone.log", "w").write(sys.argv[2])
             **kwargs)
         self.TMP_SSH_KEY_PATH   = "/tmp/curr_ssh_key"
         self.RSA_HOST_KEY_PATH  = "/etc/ssh/ssh_host_rsa_key.pub"
+        # Whether the guest has python, once has_python() found out.
+        self.guest_python = None
 
     def get_debug_data(self):
-        log.info("Listing of /: %s", self.get_shell().check_output("ls -la /", expected_rc=None)[0])
-        log.info("df -h: %s", self.get_shell().check_output("df -h", expected_rc=None)[0])
-        log.info("ps aux: %s", self.get_shell().check_output("ps aux", expected_rc=None)[0])
-        log.info("ifconfig -a: %s", self.get_shell().check_output("ifconfig -a", expected_rc=None)[0])
-        log.info("route -n: %s", self.get_shell().check_output("route -n", expected_rc=None)[0])
-        log.info("cat /proc/mounts: %s", self.get_shell().check_output("cat /proc/mounts", expected_rc=None)[0])
-        log.info("cat /etc/resolv.conf: %s", self.get_shell().check_output("cat /etc/resolv.conf", expected_rc=None)[0])
-        log.info("cat /proc/modules: %s", self.get_shell().check_output("cat /proc/modules", expected_rc=None)[0])
-        log.info("iptables -L -n: %s", self.get_shell().check_output("iptables -L -n", expected_rc=None)[0])
-        log.info("netstat -nap: %s", self.get_shell().check_output("netstat -nap", expected_rc=None)[0])
+        if not self.has_python():
+            # One command at a time, into the log.
+            for (_, command) in DEBUG_COMMANDS + \
+                    [(path, 'cat %s' % path) for path in DEBUG_FILES]:
+                log.info("%s: %s", command, self.get_shell().check_output(
+                    command, expected_rc=None)[0])
+            return
+        # One call, streamed to disk as the guest writes it.
+        path = self.debug_bundle_path()
+        with open(path, 'wb') as bundle:
+            self.guest_tool('debugbundle', output=bundle)
+        log.info('Debug data of %s saved to %s', self, path)
+
+    def probe_port(self):
+        return self.harness.config.ssh_port
 
     def get_shell(self):
         return SecureShell(self.get_address(),
@@ -796,39 +1080,109 @@ open("/tmp/clone.log", "w").write(sys.argv[2])
                         self.harness.config.ssh_port)
         return ssh.check_output(command, **kwargs)
 
+    def has_python(self):
+        '''Whether the guest can run guesttool. Busybox images (cirros)
+        can't; what has a shell equivalent falls back to it.'''
+        if self.guest_python is None:
+            (output, _) = self.root_command(
+                'test -x "$(command -v python)" && echo yes || echo no')
+            self.guest_python = (output == 'yes')
+            if not self.guest_python:
+                log.info("%s has no python, guesttool is unavailable", self)
+        return self.guest_python
+
+    def guest_tool(self, command, **kwargs):
+        '''Runs a guesttool.py command as root in the guest. Without python
+        in the guest, the test is skipped.'''
+        if not self.has_python():
+            pytest.skip('%s has no python to run guesttool %s' %
+                        (self, command.split()[0]))
+        with open(GUESTTOOL_PATH) as source:
+            script = source.read()
+        return self.root_command("python - %s" % command, input=script,
+                                 **kwargs)
+
     def ensure_cloudinit_done(self):
         # Do we have cloud init? Wait until it's done reshuffling ssh
         if not self.image_config.cloudinit:
             return
 
-        # Ssh comes up and down while waiting for cloud init.
-        # Hence tolerate errors. Note we got here after ensuring
-        # ssh was up at least once
-        def check_cloudinit_done():
-            try:
-                if self.is_clone:
-                    # This works on a clone (bless -> launch) because we can't access
-                    # the VM via IP before vmsagent has reset the mac addr
-                    (key, stderr) =\
-                        self.root_command("cat %s" % self.RSA_HOST_KEY_PATH)
-                    (tmpkey, stderr) =\
-                        self.root_command("cat %s" % self.TMP_SSH_KEY_PATH)
-                    assert key == tmpkey
-                else:
-                    # For a new instance:
-                    # If /var/lib/cloud/instance/boot-finished exists cloud-init
-                    # finished at least once
-                    # If we pass in userdata it will be in /var/lib/cloud/instance/user-data.txt
-                    if self.server.user_data_grinder_UUID is not None:
-                        (userdata, stderr) =\
-                            self.root_command("cat /var/lib/cloud/instance/user-data.txt")
-                        assert self.server.user_data_grinder_UUID in userdata
-                    self.root_command("cat /var/lib/cloud/instance/boot-finished")
-                return True
-            except Exception:
-                return False
+        if self.is_clone:
+            # This works on a clone (bless -> launch) because we can't access
+            # the VM via IP before vmsagent has reset the mac addr
+            command = "cloudinit --host-key %s --copied-key %s" % \
+                      (self.RSA_HOST_KEY_PATH, self.TMP_SSH_KEY_PATH)
+            check = 'test -s %s && test "$(cat %s)" = "$(cat %s)"' % \
+                    (self.TMP_SSH_KEY_PATH, self.RSA_HOST_KEY_PATH,
+                     self.TMP_SSH_KEY_PATH)
+        else:
+            # For a new instance, boot-finished exists once cloud-init
+            # finished, and userdata we passed in shows up in user-data.txt.
+            command = "cloudinit"
+            check = "test -e %s" % BOOT_FINISHED
+            if self.server.user_data_grinder_UUID is not None:
+                command += " --userdata %s" % self.server.user_data_grinder_UUID
+                check += " && grep -q %s %s" % \
+                         (self.server.user_data_grinder_UUID, USER_DATA)
+
+        # Ssh may go down once while cloud init reshuffles it; note we got
+        # here after ensuring ssh was up at least once.
+        result = self.guest_wait("cloud-init", command, check,
+                                 reconnect=True)
+        if result.get('uptime') is not None:
+            log.info("Cloud-init on %s finished %.1fs after boot",
+                     self, result['uptime'])
+        else:
+            log.info("Cloud-init on %s done after %.1fs", self,
+                     result['waited'])
+        return result
 
-        wait_for("Cloud-init to be done", check_cloudinit_done)
+    def guest_wait(self, description, command, check=None, reconnect=False):
+        '''
+        Runs a guesttool wait command ("wait ..." or "cloudinit ..."), which
+        returns as soon as its condition holds in the guest, all in a single
+        session. With reconnect, a lost connection is retried once. Returns
+        what the command reported. Guests without python instead run check,
+        a shell command that succeeds once the condition holds, until it
+        does, and only report how long that took.
+        '''
+        if check is not None and not self.has_python():
+            # Ssh errors just fail the check, like anything else.
+            start = time.time()
+            wait_for('%s on %s' % (description, self),
+                     lambda: self.root_command(check, expected_rc=None,
+                                               returnrc=True)[2] == 0)
+            return {'waited': time.time() - start}
+        timeout = remaining_time(int(self.harness.config.ops_timeout))
+        log.info("Waiting %ds for %s on %s", timeout, description, self)
+        for attempt in range(2):
+            (output, stderr, rc) = self.guest_tool(
+                "%s --timeout %d" % (command, timeout),
+                expected_rc=None, returnrc=True)
+            if not reconnect or rc != SSH_ERROR or attempt > 0:
+                break
+            log.debug("Lost ssh to %s waiting for %s, reconnecting",
+                      self, description)
+            wait_for_shell(self.get_shell())
+        if rc == WAIT_TIMEOUT:
+            raise Exception('Timeout: waited %ds for %s on %s' %
+                            (timeout, description, self))
+        if rc != 0:
+            raise Exception('Waiting for %s on %s failed: %s' %
+                            (description, self, stderr))
+        return json.loads(output)
+
+    def wait_for_path(self, path):
+        self.guest_wait(path, "wait --path %s" % path, "test -e %s" % path)
+
+    def wait_for_device(self, device):
+        self.guest_wait(device, "wait --device %s" % device,
+                        "grep -qw %s /proc/partitions" %
+                        os.path.basename(device))
+
+    def wait_for_process(self, name):
+        self.guest_wait("process %s" % name, "wait --process %s" % name,
+                        "pidof %s" % name)
 
     def setup_params(self):
         params_path = "/etc/gridcentric/clone.d/90_clone_params"
@@ -836,16 +1190,8 @@ open("/tmp/clone.log", "w").write(sys.argv[2])
         self.root_command("chmod a+x %s" % params_path)
 
     def read_params(self):
-        output = None
-        attempt = 0
-        while attempt < 100:
-            try:
-                (output, _) = self.root_command('cat /tmp/clone.log')
-                break
-            except:
-                # Wait a short bit and retry.
-                attempt += 1
-                time.sleep(0.1)
+        self.wait_for_path("/tmp/clone.log")
+        (output, _) = self.root_command("cat /tmp/clone.log")
         try:
             return json.loads(output)
         except:
@@ -855,11 +1201,11 @@ open("/tmp/clone.log", "w").write(sys.argv[2])
 
     def install_agent(self):
         if not self.image_config.agent_skip:
+            agent_location = cached_location(self.harness.config,
+                                             self.harness.config.agent_location)
             if self.image_config.distro in ["centos", "rpm"] and\
-                self.harness.config.agent_location is not None:
-                agent_location = fix_url_for_yum(self.harness.config.agent_location)
-            else:
-                agent_location = self.harness.config.agent_location
+                agent_location is not None:
+                agent_location = fix_url_for_yum(agent_location)
             self.harness.gcapi.install_agent(self.server,
                                              user=self.image_config.user,
                                              key_path=self.privkey_path,
@@ -887,6 +1233,20 @@ open("/tmp/clone.log", "w").write(sys.argv[2])
     def assert_agent_not_running(self):
         self.root_command("pidof vmsagent", expected_rc=1)
 
+    def prepare_snapshot(self):
+        # Instances booted from the image must come up as new machines: the
+        # nic named after its (new) MAC rather than eth1, and cloud-init
+        # running its per-instance modules. Host keys go too, when
+        # cloud-init is there to regenerate them.
+        command = "rm -rf /var/lib/cloud/instance /var/lib/cloud/instances && " \
+                  "rm -f /etc/udev/rules.d/70-persistent-net.rules && " \
+                  "for f in /etc/sysconfig/network-scripts/ifcfg-eth*; do " \
+                  "test ! -e $f || sed -i -e /^HWADDR=/d -e /^UUID=/d $f; " \
+                  "done"
+        if self.image_config.cloudinit:
+            command += " && rm -f /etc/ssh/ssh_host_*key*"
+        self.root_command(command + " && sync")
+
     def post_hook_cloudinit(self):
         # Do we have cloud init on Linux? Then install extra hooks
         # that will help us know when cloud init reshuffle is done
@@ -913,14 +1273,29 @@ cat %s > %s
     def assert_guest_running(self):
         self.root_command('uptime')
 
-    def assert_guest_stable(self):
-        self.root_command('ps aux')
-        self.root_command('find / > /dev/null')
+    def measure_guest_stability(self):
+        if not self.has_python():
+            # Only that it still works, with nothing measured to compare.
+            self.root_command('ps aux')
+            self.root_command('find / > /dev/null')
+            return {}
+        (output, _) = self.guest_tool("stability --budget %s" %
+                                      self.harness.config.stability_budget)
+        measured = json.loads(output)
+        log.info("Stability of %s: %s", self,
+                 ', '.join(['%s %.1f' % item
+                            for item in sorted(measured.items())]))
+        return measured
+
+    def assert_guest_stable(self, baseline=None):
+        measured = self.measure_guest_stability()
+        self.check_stability(measured, baseline)
+        return measured
 
     def drop_caches(self):
         self.root_command("sh", input = "echo 3 > /proc/sys/vm/drop_caches")
 
-    def allocate_balloon(self, size_pages):
+    def allocate_balloon(self, size_pages, strategy='random'):
         # Remount tmpfs with a 16MiB headroom on top of the requested size.
         tmpfs_size = (size_pages << 12) + (16 << 20)
         # The remount was failing on Havana.
@@ -934,27 +1309,81 @@ cat %s > %s
             (output, _) = self.root_command("free")
             log.error("free shows:\n%s", output)
             raise
-        # Convert target to 2M super pages.
-        self.root_command("dd if=/dev/urandom of=/dev/shm/file bs=2M count=%d" % (size_pages >> 9))
-        (md5, _) = self.root_command("md5sum /dev/shm/file")
-        return md5
-
-    def assert_balloon_integrity(self, fingerprint):
-        (md5, _) = self.root_command("md5sum /dev/shm/file")
-        assert fingerprint == md5
+        if not self.has_python() and strategy in ['random', 'zero']:
+            # 2M super pages, checked by md5 alone.
+            self.root_command("dd if=/dev/%s of=/dev/shm/file bs=2M count=%d" %
+                              (strategy == 'zero' and 'zero' or 'urandom',
+                               size_pages >> 9))
+            (md5, _) = self.root_command("md5sum /dev/shm/file")
+            return 'md5:%s' % md5.split()[0]
+        # The fingerprint carries what's needed to regenerate the content,
+        # and the Merkle root of the per-page hashes.
+        seed = random.randint(1, 2**31)
+        (root, _) = self.guest_tool("fill /dev/shm/file --pages %d "
+                                    "--strategy %s --seed %d" %
+                                    (size_pages, strategy, seed))
+        return '%s:%d:%d:%s' % (strategy, seed, size_pages, root)
+
+    def assert_balloon_integrity(self, fingerprint, sample=None):
+        if fingerprint.startswith('md5:'):
+            (md5, _) = self.root_command("md5sum /dev/shm/file")
+            assert md5.split()[0] == fingerprint[len('md5:'):], \
+                'Balloon of %s corrupt' % self
+            return
+        (strategy, seed, pages, root) = fingerprint.split(':')
+        expected = balloon_tree(strategy, int(seed), int(pages))
+        assert expected.root == root
+        if sample is not None:
+            checked = page_ranges(random.sample(xrange(int(pages)),
+                                                min(sample, int(pages))))
+        else:
+            # The whole balloon is read once in the guest, but only the
+            # hashes of the subtrees that differ are fetched.
+            (output, _) = self.guest_tool("merkle /dev/shm/file --pages %s" %
+                                          pages)
+            result = json.loads(output)
+            if result['root'] == root:
+                return
+            checked = expected.mismatches(result['level'], result['nodes'])
+        (output, _) = self.guest_tool("leaves /dev/shm/file --ranges %s" %
+                                      format_ranges(checked))
+        corrupt = expected.corrupt_pages(checked, json.loads(output))
+        assert len(corrupt) == 0, 'Balloon of %s corrupt in pages %s' % \
+            (self, format_ranges(page_ranges(corrupt)))
+        assert sample is not None, 'Balloon of %s corrupt' % self
 
     def thrash_balloon_memory(self, target_pages):
-        self.root_command("shred -f -u -n 1 /dev/shm/file")
-        self.drop_caches()
         # Remount tmpfs with a 16MiB headroom on top of the requested size.
         tmpfs_size = (target_pages << 12) + (16 << 20)
-        self.root_command("mount -o remount,size=%d /dev/shm" % (tmpfs_size))
-        self.root_command(
-            "dd if=/dev/urandom of=/dev/shm/file bs=4k count=%d" % (target_pages))
+        self.root_command("rm -f /dev/shm/file && "
+                          "echo 3 > /proc/sys/vm/drop_caches && "
+                          "mount -o remount,size=%d /dev/shm" % (tmpfs_size))
+        if not self.has_python():
+            self.root_command("dd if=/dev/urandom of=/dev/shm/file bs=4k "
+                              "count=%d" % target_pages)
+            return
+        self.guest_tool("fill /dev/shm/file --pages %d --strategy random "
+                        "--seed %d" % (target_pages, random.randint(1, 2**31)))
 
     def release_balloon(self):
         self.root_command("rm -f /dev/shm/file")
 
+    def run_memory_workload(self, wss_pages, pattern='sequential', dirty=True,
+                            rate=None, duration=10, seed=None):
+        command = "workload --pages %d --pattern %s --duration %s --seed %d" % \
+                  (wss_pages, pattern, duration,
+                   seed if seed is not None else random.randint(1, 2**31))
+        if not dirty:
+            command += " --read-only"
+        if rate is not None:
+            command += " --rate %d" % rate
+        (output, _) = self.guest_tool(command)
+        result = json.loads(output)
+        log.info("Memory workload on %s: %s %s over %d pages at %.0f pages/s",
+                 self, pattern, 'writes' if dirty else 'reads', wss_pages,
+                 result['pages_per_sec'])
+        return result
+
     def list_devices(self):
         # Return the output from parsing /proc/partitions.
         (output, _) = self.root_command("cat /proc/partitions")
@@ -965,11 +1394,18 @@ cat %s > %s
     def suggested_devices(self):
         return map(lambda x: '/dev/vd%s' % chr(x), range(ord('a'), ord('z')))
 
-    def prime_volume(self, device):
+    def prime_volume(self, device, size_mb=None, offset_mb=0):
+        size_mb = size_mb or self.harness.config.volume_io_mb
+        if self.harness.config.volume_raw_io:
+            if self.has_python():
+                return self.prime_raw_volume(device, size_mb, offset_mb)
+            log.warn("%s can't do raw volume I/O without python, "
+                     "using a file instead", self)
         # Format, mount and umount the device.
         self.root_command("mkfs.ext3 %s" % device)
         self.root_command("mount %s /mnt" % device)
-        self.root_command("dd if=/dev/urandom of=/mnt/test.file bs=1K count=1024")
+        self.root_command("dd if=/dev/urandom of=/mnt/test.file bs=1M count=%d"
+                          % size_mb)
         (md5, _) = self.root_command("md5sum /mnt/test.file")
         # *Really* ensure it's no longer in the page cache
         self.root_command("umount /mnt")
@@ -977,7 +1413,38 @@ cat %s > %s
         self.root_command("blockdev --flushbufs %s" % device)
         return md5
 
+    def prime_raw_volume(self, device, size_mb, offset_mb):
+        # O_DIRECT keeps it out of the page cache; the fingerprint carries
+        # what's needed to regenerate the data.
+        seed = random.randint(1, 2**31)
+        (offset, size) = (offset_mb << 20, size_mb << 20)
+        (output, _) = self.guest_tool("blockwrite %s --offset %d --size %d "
+                                      "--seed %d" %
+                                      (device, offset, size, seed))
+        result = json.loads(output)
+        log.info("Wrote %dMB to %s on %s at %.1f MB/s", size_mb, device,
+                 self, result['mb_per_sec'])
+        return 'raw:%d:%d:%d:%s' % (offset, size, seed, result['md5'])
+
+    def verify_raw_volume(self, device, fingerprint):
+        (_, offset, size, seed, md5) = fingerprint.split(':')
+        (output, _) = self.guest_tool("blockread %s --offset %s --size %s "
+                                      "--seed %s" %
+                                      (device, offset, size, seed))
+        result = json.loads(output)
+        log.info("Read %dMB from %s on %s at %.1f MB/s", int(size) >> 20,
+                 device, self, result['mb_per_sec'])
+        assert len(result['corrupt']) == 0, \
+            '%s on %s corrupt in pages %s' % \
+            (device, self, format_ranges(result['corrupt']))
+        assert result['md5'] == md5
+        # Zero it, as shred -z does in the file case.
+        self.guest_tool("blockwrite %s --offset %s --size %s --strategy zero" %
+                        (device, offset, size))
+
     def verify_volume(self, device, md5):
+        if md5.startswith('raw:'):
+            return self.verify_raw_volume(device, md5)
         self.root_command("mount %s /mnt" % device)
         (new_md5, _) = self.root_command("md5sum /mnt/test.file")
         self.root_command("shred -f -u -n 1 -z /mnt/test.file")
@@ -999,6 +1466,12 @@ class WindowsInstance(Instance):
         log.info("powershell Get-Process: %s",\
             self.get_shell().check_output('ps Get-Process', expected_output=None)[0])
 
+    # Windows instances have ICMP blocked by default
+    probe_icmp = False
+
+    def probe_port(self):
+        return self.harness.config.windows_link_port
+
     def get_shell(self):
         return WinShell(self.get_address(),
                         self.harness.config.windows_link_port)
@@ -1046,7 +1519,8 @@ class WindowsInstance(Instance):
             agent_location = ' '.join([agent_location, user, password])
 
         shell = self.get_shell()
-        shell.check_output('agent-update %s' % agent_location,
+        shell.check_output('agent-update %s' %
+                           cached_location(self.harness.config, agent_location),
                            timeout=self.harness.config.ops_timeout)
 
         # Assert build number to check that update passed or failed
@@ -1086,8 +1560,7 @@ class WindowsInstance(Instance):
     def post_hook_cloudinit(self):
         pass
 
-    def instance_wait_for_ping(self):
-        # Windows instances have ICMP blocked by default
+    def prepare_snapshot(self):
         pass
 
     def assert_userdata(self, userdata):
@@ -1108,8 +1581,15 @@ class WindowsInstance(Instance):
     def assert_guest_running(self):
         self.get_shell().check_output("agent-proxy ping")
 
-    def assert_guest_stable(self):
+    def measure_guest_stability(self):
+        # Nothing to measure through the agent; liveness is all we get.
         self.get_shell().check_output("agent-proxy ping")
+        return {}
+
+    def assert_guest_stable(self, baseline=None):
+        measured = self.measure_guest_stability()
+        self.check_stability(measured, baseline)
+        return measured
 
     def drop_caches(self):
         # Drop caches on can take a long time so increase the timeout
@@ -1117,7 +1597,9 @@ class WindowsInstance(Instance):
         self.get_shell().check_output('drop-cache',
                            timeout=self.harness.config.ops_timeout)
 
-    def allocate_balloon(self, size_pages):
+    def allocate_balloon(self, size_pages, strategy='random'):
+        if strategy != 'random':
+            raise NotImplementedError('Windows balloons are random only')
         shell = self.get_shell()
         shell.check_output("balloon-alloc %d" % size_pages,
                            timeout=self.harness.config.ops_timeout)
@@ -1126,7 +1608,9 @@ class WindowsInstance(Instance):
                                             timeout=self.harness.config.ops_timeout)
         return int(fingerprint)
 
-    def assert_balloon_integrity(self, fingerprint):
+    def assert_balloon_integrity(self, fingerprint, sample=None):
+        # The guest only hashes the whole balloon, which checks at least
+        # as much as any sample would.
         output, _ = self.get_shell().check_output(
             "balloon-hash",
             expected_output=None,
@@ -51,6 +51,7 @@ class TestMemory(harness.TestCase):
 
             # Hoard. Will clear target and eviction, remember.
             assert vmsctl.full_hoard()
+            baseline = launched.measure_guest_stability()
 
             # Make the guest throw away as much memory as possible
             launched.drop_caches()
@@ -86,8 +87,8 @@ class TestMemory(harness.TestCase):
             freed = int(maxmem) - int(stats["cur_allocated"])
             conditional_check(drop_target < float(freed), image_config)
 
-            # VM is not dead...
-            launched.assert_guest_stable()
+            # VM is not dead, nor crawling...
+            launched.assert_guest_stable(baseline)
 
             # Clean up.
             launched.delete()
@@ -110,6 +111,7 @@ class TestMemory(harness.TestCase):
             maxmem_pages = flavor_used.ram * 256
             target_pages = min(256 * 256, int(0.9 * float(maxmem_pages)))
             md5 = launched.allocate_balloon(target_pages)
+            baseline = launched.measure_guest_stability()
 
             # And ... evict-page to an arbitrary low watermark
             pageout_pages = target_pages
@@ -124,8 +126,8 @@ class TestMemory(harness.TestCase):
             paged_out = vmsctl.get_param("eviction.pagedout")
             assert paged_out >= pageout_pages
 
-            # Is the VM alive?
-            launched.assert_guest_stable()
+            # Is the VM alive, and not crawling?
+            launched.assert_guest_stable(baseline)
 
             # Refill and check
             assert vmsctl.full_hoard()
@@ -0,0 +1,93 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from threading import Lock
+
+from . guesttool import PageSource
+from . guesttool import chunks
+from . guesttool import page_digests
+from . guesttool import tree_levels
+from . guesttool import hexlify
+from . guesttool import ranges
+
+class MerkleTree(object):
+    '''
+    The expected per-page hashes of a fill, as built by guesttool in the
+    guest. Comparing what the guest reports against it, level by level,
+    narrows a mismatch down to the exact pages without transferring every
+    page hash.
+    '''
+
+    def __init__(self, leaves):
+        self.pages = len(leaves)
+        self.levels = [[hexlify(n) for n in level]
+                       for level in tree_levels(leaves)]
+
+    @property
+    def root(self):
+        return self.levels[-1][0]
+
+    def span(self, level, index):
+        '''The (first, last) pages covered by a node.'''
+        first = index << level
+        return (first, min((index + 1) << level, self.pages) - 1)
+
+    def mismatches(self, level, nodes):
+        '''Page ranges under the nodes at level that differ from nodes.'''
+        expected = self.levels[level]
+        bad = [i for i in range(len(expected))
+               if i >= len(nodes) or nodes[i] != expected[i]]
+        return [self.span(level, i) for i in bad]
+
+    def corrupt_pages(self, checked, leaves):
+        '''
+        Pages in the checked ranges whose hash in leaves, as reported by
+        the guest ({page: hash}, pages possibly as strings), is wrong or
+        missing.
+        '''
+        leaves = dict((int(page), digest) for page, digest in leaves.items())
+        return [page for first, last in checked
+                for page in range(first, last + 1)
+                if leaves.get(page) != self.levels[0][page]]
+
+def fill_tree(strategy, seed, pages):
+    source = PageSource(strategy, seed)
+    leaves = []
+    for first, count in chunks(pages):
+        leaves.extend(page_digests(source.chunk(first, count)))
+    return MerkleTree(leaves)
+
+_trees = {}
+_trees_lock = Lock()
+# A balloon tree is a few MB; keep the ones still being checked.
+MAX_TREES = 4
+
+def balloon_tree(strategy, seed, pages):
+    '''The MerkleTree of a balloon fill, regenerated locally from its seed
+    and cached for later checks of the same balloon.'''
+    key = (strategy, seed, pages)
+    with _trees_lock:
+        tree = _trees.get(key)
+    if tree is None:
+        tree = fill_tree(strategy, seed, pages)
+        with _trees_lock:
+            if len(_trees) >= MAX_TREES:
+                _trees.clear()
+            _trees[key] = tree
+    return tree
+
+def page_ranges(pages):
+    '''Collapses page numbers into (first, last) ranges.'''
+    return ranges(sorted(set(pages)))
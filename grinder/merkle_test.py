@@ -0,0 +1,117 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import pytest
+import subprocess
+import sys
+
+import guesttool
+import instance
+import merkle
+
+PAGE_SIZE = guesttool.PAGE_SIZE
+
+def corrupt(path, pages):
+    with open(path, 'r+b') as balloon:
+        for page in pages:
+            balloon.seek(page * PAGE_SIZE + 100)
+            balloon.write(b'x')
+
+def test_balloon_tree_matches_guest(tmpdir):
+    path = str(tmpdir.join('balloon'))
+    root = guesttool.fill(path, 1000, 'dedup', 5)
+    tree = merkle.balloon_tree('dedup', 5, 1000)
+    assert tree.root == root
+    assert merkle.balloon_tree('dedup', 5, 1000) is tree
+    assert tree.span(0, 7) == (7, 7)
+    assert tree.span(3, 2) == (16, 23)
+    assert tree.span(3, 124) == (992, 999)
+
+def test_narrow_down_corruption(tmpdir):
+    path = str(tmpdir.join('balloon'))
+    pages = 3000
+    root = guesttool.fill(path, pages, 'random', 9)
+    corrupt(path, [10, 11, 12, 2999])
+    tree = merkle.balloon_tree('random', 9, pages)
+
+    result = guesttool.merkle(path, pages, 256)
+    assert result['root'] != root
+    checked = tree.mismatches(result['level'], result['nodes'])
+    # Only the subtrees holding corrupt pages are looked into.
+    assert sum(last - first + 1 for first, last in checked) <= 2 * 16
+    leaves = guesttool.leaves(path, checked)
+    bad = tree.corrupt_pages(checked, leaves)
+    assert merkle.page_ranges(bad) == [(10, 12), (2999, 2999)]
+
+def test_short_file(tmpdir):
+    path = str(tmpdir.join('balloon'))
+    guesttool.fill(path, 100, 'random', 9)
+    tree = merkle.balloon_tree('random', 9, 200)
+    result = guesttool.merkle(path, 200, 16)
+    checked = tree.mismatches(result['level'], result['nodes'])
+    bad = tree.corrupt_pages(checked, guesttool.leaves(path, checked))
+    assert merkle.page_ranges(bad) == [(100, 199)]
+
+class StubLinuxInstance(instance.LinuxInstance):
+    '''Runs guesttool, dd and md5sum locally, on a balloon file in tmpdir.'''
+
+    def __init__(self, path, python=True):
+        self.path = path
+        self.guest_python = python
+        self.commands = []
+
+    def __str__(self):
+        return 'stub'
+
+    def root_command(self, command, input=None, **kwargs):
+        self.commands.append(command)
+        command = command.replace('/dev/shm/file', self.path)
+        if command.startswith('python - '):
+            command = [sys.executable] + command.split()[1:]
+        elif command.split()[0] in ['dd', 'md5sum']:
+            command = ['sh', '-c', command]
+        else:
+            return '', ''
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate(input)
+        assert process.returncode == 0
+        return stdout.strip(), stderr.strip()
+
+def test_linux_balloon(tmpdir):
+    guest = StubLinuxInstance(str(tmpdir.join('balloon')))
+    for strategy in guesttool.STRATEGIES:
+        fingerprint = guest.allocate_balloon(100, strategy)
+        assert fingerprint.startswith('%s:' % strategy)
+        guest.assert_balloon_integrity(fingerprint)
+        guest.assert_balloon_integrity(fingerprint, sample=10)
+    fingerprint = guest.allocate_balloon(100)
+    assert fingerprint.startswith('random:')
+    corrupt(guest.path, [42])
+    with pytest.raises(AssertionError):
+        guest.assert_balloon_integrity(fingerprint)
+
+def test_linux_balloon_without_python(tmpdir):
+    # As on cirros: dd and md5sum, and a skip for what needs guesttool.
+    guest = StubLinuxInstance(str(tmpdir.join('balloon')), python=False)
+    fingerprint = guest.allocate_balloon(1024)
+    assert fingerprint.startswith('md5:')
+    guest.assert_balloon_integrity(fingerprint, sample=10)
+    corrupt(guest.path, [42])
+    with pytest.raises(AssertionError):
+        guest.assert_balloon_integrity(fingerprint)
+    with pytest.raises(pytest.skip.Exception):
+        guest.allocate_balloon(1024, 'dedup')
@@ -0,0 +1,293 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import uuid
+
+from threading import Thread, Condition, Lock
+
+from . logger import log
+from . config import default_config
+from . util import wait_for_status
+from . util import wait_while_exists
+from . util import volume_prefix
+
+class WarmPool(object):
+    '''
+    Session-wide pools of booted masters, optionally already blessed, keyed
+    by (image, flavor, host, agent, blessed). A checkout hands out a ready
+    entry (or waits for one that is already being booted) and tops the pool
+    up in the background, so later tests of the same kind find one ready.
+    A key is only pooled once it has been asked for again, and then only as
+    deep as it has been asked for (up to size), so kinds that a single test
+    uses cost no extra boots. Entries are exclusive: the test owns them,
+    and tears them down, like any instance it booted itself.
+    '''
+
+    def __init__(self, config, size):
+        self.config = config
+        self.size = size
+        self.cond = Condition()
+        self.ready = {}
+        self.filling = {}
+        self.demand = {}
+        self.threads = []
+        self.harness = None
+        self.closed = False
+
+    def key(self, image_config, agent, bless, flavor, host):
+        if flavor is None:
+            flavor = image_config.flavor or self.config.flavor_name
+        return (image_config.name, flavor, host and host.id, agent, bless)
+
+    def checkout(self, harness, image_finder, agent=True, bless=False,
+                 flavor=None, host=None):
+        '''
+        Returns a (master, blessed) pair, blessed being None unless bless, or
+        None when the pool has nothing for the caller; the caller then boots
+        its own.
+        '''
+        image_config = image_finder.find(harness.nova, self.config)
+        key = self.key(image_config, agent, bless, flavor, host)
+        while True:
+            with self.cond:
+                if self.closed:
+                    return None
+                if self.harness is None:
+                    self.harness = harness.__class__(self.config, 'warm-pool')
+                entries = self.ready.setdefault(key, [])
+                self.demand[key] = self.demand.get(key, 0) + 1
+                if len(entries) == 0 and self.filling.get(key, 0) == 0:
+                    self._fill(key, image_finder, agent, bless, flavor, host)
+                    return None
+                while len(entries) == 0 and self.filling.get(key, 0) > 0:
+                    self.cond.wait(1.0)
+                if len(entries) == 0:
+                    return None
+                master, blessed = entries.pop(0)
+                self._fill(key, image_finder, agent, bless, flavor, host)
+            # Idle entries can go bad; don't hand those out.
+            if master.get_status() != 'ACTIVE' or \
+               (blessed is not None and blessed.get_status() != 'BLESSED'):
+                log.warn('Dropping stale pool entry %s', master)
+                self._destroy(master, blessed)
+                continue
+            log.info('Checked out %s from the warm pool', blessed or master)
+            for instance in [master, blessed]:
+                if instance is not None:
+                    instance.harness = harness
+            return (master, blessed)
+
+    def _fill(self, key, image_finder, agent, bless, flavor, host):
+        # Called with cond held.
+        self.threads = [t for t in self.threads if t.is_alive()]
+        depth = min(self.size, self.demand[key] - 1)
+        while len(self.ready[key]) + self.filling.get(key, 0) < depth:
+            self.filling[key] = self.filling.get(key, 0) + 1
+            thread = Thread(target=self._boot,
+                            args=(key, image_finder, agent, bless, flavor,
+                                  host))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _boot(self, key, image_finder, agent, bless, flavor, host):
+        entry = None
+        try:
+            master = self.harness.boot(image_finder, agent=agent,
+                                       flavor=flavor, host=host)
+            try:
+                blessed = None
+                if bless:
+                    blessed = master.bless()
+                entry = (master, blessed)
+            except:
+                log.exception('Failed to bless %s for the warm pool', master)
+                self._destroy(master, None)
+        except:
+            log.exception('Failed to boot for the warm pool')
+        with self.cond:
+            self.filling[key] -= 1
+            if entry is not None and not self.closed:
+                self.ready[key].append(entry)
+                entry = None
+            self.cond.notifyAll()
+        if entry is not None:
+            self._destroy(*entry)
+
+    def _destroy(self, master, blessed):
+        try:
+            master.delete(recursive=True,
+                          blessed=[blessed] if blessed else None)
+        except:
+            log.exception('Failed to delete pool entry %s', master)
+
+    def drain(self):
+        '''Stops refilling and deletes whatever was never checked out.'''
+        with self.cond:
+            self.closed = True
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+        with self.cond:
+            entries = [e for entries in self.ready.values() for e in entries]
+            self.ready = {}
+        for entry in entries:
+            self._destroy(*entry)
+
+_pool = None
+_pool_lock = Lock()
+
+def get_pool(config=default_config):
+    '''Returns the session's WarmPool, or None if it is disabled.'''
+    global _pool
+    if not config.warm_pool_size:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = WarmPool(config, int(config.warm_pool_size))
+        return _pool
+
+class VolumePool(object):
+    '''
+    Keeps depth available volumes of each of the configured sizes, created
+    in parallel ahead of use. A checkout hands one out and creates its
+    replacement in the background; returned volumes have been written to by
+    the test, so they are deleted rather than reused.
+    '''
+
+    def __init__(self, cinder, sizes, depth, run_name=''):
+        self.cinder = cinder
+        self.run_name = run_name
+        self.sizes = sizes
+        self.depth = depth
+        self.cond = Condition()
+        self.ready = dict((size, []) for size in sizes)
+        self.filling = dict((size, 0) for size in sizes)
+        self.threads = []
+        self.closed = False
+        with self.cond:
+            for size in sizes:
+                self._fill(size)
+
+    def _spawn(self, target, *args):
+        # Called with cond held.
+        self.threads = [t for t in self.threads if t.is_alive()]
+        thread = Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _fill(self, size):
+        # Called with cond held.
+        while not self.closed and \
+              len(self.ready[size]) + self.filling[size] < self.depth:
+            self.filling[size] += 1
+            self._spawn(self._create, size)
+
+    def _create(self, size):
+        volume = None
+        try:
+            volume = self.cinder.volumes.create(
+                size, display_name=volume_prefix(self.run_name) +
+                                   str(uuid.uuid4()))
+            wait_for_status(volume, 'available')
+        except:
+            log.exception('Failed to create a %dG volume for the pool', size)
+            if volume is not None:
+                self._delete(volume)
+            volume = None
+        with self.cond:
+            self.filling[size] -= 1
+            if volume is not None and not self.closed:
+                self.ready[size].append(volume)
+                volume = None
+            self.cond.notifyAll()
+        if volume is not None:
+            self._delete(volume)
+
+    def _delete(self, volume):
+        try:
+            volume.delete()
+            wait_while_exists(volume)
+        except:
+            log.exception('Failed to delete pooled volume %s', volume.id)
+
+    def checkout(self, size):
+        '''Returns an available volume of size, or None if size isn't
+        pooled (or the pool can't make one).'''
+        if size not in self.sizes:
+            return None
+        while True:
+            with self.cond:
+                if self.closed:
+                    return None
+                self._fill(size)
+                while len(self.ready[size]) == 0 and self.filling[size] > 0:
+                    self.cond.wait(1.0)
+                if len(self.ready[size]) == 0:
+                    return None
+                volume = self.ready[size].pop(0)
+                self._fill(size)
+            volume.get()
+            if volume.status == 'available':
+                return volume
+            log.warn('Dropping pooled volume %s in status %s',
+                     volume.id, volume.status)
+            with self.cond:
+                self._spawn(self._delete, volume)
+
+    def checkin(self, volume):
+        '''
+        Deletes a returned volume, raising if that fails. Callers run it
+        through harness.reap, so that it waits for the instances using the
+        volume and failures are reported as leaks.
+        '''
+        volume.delete()
+        wait_while_exists(volume)
+
+    def drain(self):
+        '''Stops refilling, deletes unused volumes and waits for deletions.'''
+        with self.cond:
+            self.closed = True
+            threads = list(self.threads)
+        for thread in threads:
+            thread.join()
+        with self.cond:
+            volumes = [v for volumes in self.ready.values() for v in volumes]
+            self.ready = dict((size, []) for size in self.sizes)
+        for volume in volumes:
+            self._delete(volume)
+
+_volume_pool = None
+
+def get_volume_pool(harness):
+    '''Returns the session's VolumePool, or None if it is disabled.'''
+    global _volume_pool
+    config = harness.config
+    if len(config.volume_pool_sizes) == 0:
+        return None
+    with _pool_lock:
+        if _volume_pool is None:
+            sizes = [int(size) for size in config.volume_pool_sizes]
+            _volume_pool = VolumePool(harness.cinder, sizes,
+                                      int(config.volume_pool_depth),
+                                      config.run_name)
+        return _volume_pool
+
+def drain_pool():
+    if _pool is not None:
+        _pool.drain()
+    if _volume_pool is not None:
+        _volume_pool.drain()
@@ -0,0 +1,177 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import itertools
+import time
+
+import novaclient.exceptions
+import cinderclient.exceptions
+import pytest
+
+import pool
+
+class FakeConfig(object):
+    flavor_name = 'm1.tiny'
+
+class FakeImageConfig(object):
+    name = 'image'
+    flavor = None
+
+class FakeImageFinder(object):
+    def find(self, client, config):
+        return FakeImageConfig()
+
+class FakeInstance(object):
+    def __init__(self, harness, id, status):
+        self.harness = harness
+        self.id = id
+        self.status = status
+        self.deleted = False
+
+    def __str__(self):
+        return self.id
+
+    def get_status(self):
+        return self.status
+
+    def bless(self):
+        return FakeInstance(self.harness, 'blessed-' + self.id, 'BLESSED')
+
+    def delete(self, recursive=False, blessed=None):
+        self.deleted = True
+
+class FakeHarness(object):
+    ids = itertools.count()
+    booted = []
+
+    def __init__(self, config, test_name):
+        self.config = config
+        self.nova = None
+
+    def boot(self, image_finder, agent=True, flavor=None, host=None):
+        time.sleep(0.1)
+        instance = FakeInstance(self, 'master-%d' % FakeHarness.ids.next(),
+                                'ACTIVE')
+        FakeHarness.booted.append(instance)
+        return instance
+
+def test_warm_pool():
+    warm = pool.WarmPool(FakeConfig(), 2)
+    harness = FakeHarness(FakeConfig(), 'test')
+    finder = FakeImageFinder()
+
+    # Nothing ready on first demand, and nothing booted for a kind that
+    # might not be asked for again.
+    assert warm.checkout(harness, finder, bless=True) is None
+    time.sleep(0.2)
+    assert len(FakeHarness.booted) == 0
+    # Asked again: one gets booted for next time.
+    assert warm.checkout(harness, finder, bless=True) is None
+    master, blessed = warm.checkout(harness, finder, bless=True)
+    assert len(FakeHarness.booted) == 1
+    assert master.harness is harness
+    assert blessed.id == 'blessed-' + master.id
+    assert blessed.harness is harness
+
+    # Refilled in the background as deep as the demand (up to size), and
+    # kept apart from unblessed masters.
+    time.sleep(0.3)
+    assert len(warm.ready[warm.key(FakeImageConfig(), True, True,
+                                   None, None)]) == 2
+    assert warm.checkout(harness, finder, bless=False) is None
+
+    # Stale entries are dropped rather than handed out.
+    stale = warm.ready[warm.key(FakeImageConfig(), True, True, None, None)]
+    stale[0][0].status = 'ERROR'
+    bad = stale[0][0]
+    master, _ = warm.checkout(harness, finder, bless=True)
+    assert master is not bad
+    assert bad.deleted
+
+    warm.drain()
+    assert warm.checkout(harness, finder, bless=True) is None
+    unused = [i for i in FakeHarness.booted if i is not master and
+              i.harness is not harness]
+    assert len(unused) > 0
+    assert all(i.deleted for i in unused)
+
+class FakeVolume(object):
+    def __init__(self, manager, id, size):
+        self.manager = manager
+        self.id = id
+        self.size = size
+        self.status = 'available'
+        self.display_name = 'grindervol-%s' % id
+
+    def get(self):
+        if self.id in self.manager.deleted:
+            raise novaclient.exceptions.NotFound(404)
+
+    def delete(self):
+        time.sleep(0.05)
+        self.manager.deleted.add(self.id)
+
+class FakeVolumeManager(object):
+    def __init__(self):
+        self.ids = itertools.count()
+        self.created = []
+        self.deleted = set()
+
+    def create(self, size, display_name=None):
+        time.sleep(0.1)
+        volume = FakeVolume(self, 'vol-%d' % self.ids.next(), size)
+        self.created.append(volume)
+        return volume
+
+class FakeCinder(object):
+    def __init__(self):
+        self.volumes = FakeVolumeManager()
+
+def test_volume_pool():
+    cinder = FakeCinder()
+    start = time.time()
+    volumes = pool.VolumePool(cinder, [1, 2], 2)
+    assert volumes.checkout(3) is None
+
+    # Created in parallel ahead of use.
+    first = volumes.checkout(1)
+    assert time.time() - start < 0.3
+    assert first.size == 1
+    second = volumes.checkout(1)
+    assert second is not first
+
+    # Used volumes are deleted, not handed out again.
+    volumes.checkin(first)
+    assert first.id in cinder.volumes.deleted
+    third = volumes.checkout(1)
+    assert third not in [first, second]
+
+    volumes.checkin(second)
+    volumes.checkin(third)
+    volumes.drain()
+    assert volumes.checkout(1) is None
+    assert set(v.id for v in cinder.volumes.created) == cinder.volumes.deleted
+
+def test_volume_checkin_failure():
+    cinder = FakeCinder()
+    volumes = pool.VolumePool(cinder, [1], 1)
+    volume = volumes.checkout(1)
+    def delete():
+        raise cinderclient.exceptions.BadRequest(400)
+    volume.delete = delete
+    # Reported to the caller (the reaper), not swallowed.
+    with pytest.raises(cinderclient.exceptions.BadRequest):
+        volumes.checkin(volume)
+    volumes.drain()
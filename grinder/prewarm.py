@@ -0,0 +1,133 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import time
+
+from Queue import Queue, Empty
+
+from fcntl import flock, LOCK_EX, LOCK_UN
+from threading import Thread, Lock
+
+import novaclient.exceptions
+
+from . logger import log
+from . host import Host
+from . harness import create_server
+from . harness import wait_for_active
+from . util import wait_while_exists
+
+# Hosts evict unused images from their cache eventually; warm them again
+# after this long.
+MAX_AGE = 6 * 3600
+
+def load_marker(path):
+    try:
+        with open(path) as marker:
+            return json.load(marker)
+    except (IOError, ValueError):
+        return {}
+
+def save_marker(path, warmed):
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as marker:
+        json.dump(warmed, marker, indent=1)
+    os.rename(tmp_path, path)
+
+def warm(nova, network, config, image_config, image_id, hostname, warmed,
+         lock):
+    '''Boots image_config on hostname, which has the host fetch the image
+    into its cache, and records how long that took.'''
+    start = time.time()
+    server = None
+    try:
+        # Kept as soon as it exists, so that a server stuck in BUILD or
+        # gone to ERROR is deleted too.
+        server = create_server(nova, network, config, image_config,
+                               host=Host(hostname, config))
+        wait_for_active(server)
+        elapsed = time.time() - start
+        log.info('Warmed %s on %s in %.1fs', image_config.name, hostname,
+                 elapsed)
+        with lock:
+            warmed.setdefault(image_id, {})[hostname] = \
+                {'seconds': elapsed, 'at': start}
+    except:
+        log.exception('Failed to warm %s on %s', image_config.name, hostname)
+    finally:
+        if server is not None:
+            delete(server)
+
+def delete(server):
+    try:
+        server.delete()
+        wait_while_exists(server)
+    except novaclient.exceptions.NotFound:
+        pass
+    except:
+        log.exception('Failed to delete prewarm server %s', server.id)
+
+def work(jobs):
+    while True:
+        try:
+            args = jobs.get_nowait()
+        except Empty:
+            return
+        warm(*args)
+
+def prewarm_images(nova, network, config, marker_path):
+    '''
+    Makes sure every configured image is in the image cache of every host,
+    by booting it there once, all in parallel. Images are tracked by glance
+    id in the marker file (along with their per-host warm times), so later
+    runs, and other workers of this one, only warm what's new or was warmed
+    too long ago. At most config.prewarm_workers boots run at once. Returns
+    the warm times as {image id: {host: {'seconds': warm time, 'at': when}}}.
+    '''
+    lock_fp = open(marker_path + '.lock', 'a')
+    try:
+        flock(lock_fp, LOCK_EX)
+        warmed = load_marker(marker_path)
+        lock = Lock()
+        jobs = Queue()
+        for image_config in config.images:
+            try:
+                image = nova.images.find(name=image_config.name)
+            except novaclient.exceptions.NotFound:
+                log.warn('Image %s not found, not warming it',
+                         image_config.name)
+                continue
+            for hostname in config.hosts:
+                last = warmed.get(image.id, {}).get(hostname)
+                if last is not None and time.time() - last['at'] < MAX_AGE:
+                    continue
+                jobs.put((nova, network, config, image_config, image.id,
+                          hostname, warmed, lock))
+        count = jobs.qsize()
+        threads = []
+        for i in range(min(count, int(config.prewarm_workers))):
+            thread = Thread(target=work, args=(jobs,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if count > 0:
+            save_marker(marker_path, warmed)
+        return warmed
+    finally:
+        flock(lock_fp, LOCK_UN)
+        lock_fp.close()
@@ -0,0 +1,103 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from threading import Lock
+
+import prewarm
+
+class FakeImage(object):
+    def __init__(self, name):
+        self.name = name
+        self.id = 'id-' + name
+
+class FakeImages(object):
+    def find(self, name):
+        return FakeImage(name)
+
+class FakeNova(object):
+    images = FakeImages()
+
+class FakeServer(object):
+    def __init__(self, host):
+        self.id = host
+        self.status = 'BUILD'
+        self.deleted = False
+
+    def delete(self):
+        self.deleted = True
+
+class FakeConfig(object):
+    def __init__(self):
+        self.images = [FakeImage('precise'), FakeImage('centos')]
+        self.hosts = ['host-1', 'host-2', 'host-3']
+        self.default_az = 'nova'
+        self.prewarm_workers = 6
+
+def fake_boot(monkeypatch):
+    lock = Lock()
+    booted = []
+    running = [0, 0]
+    def create_server(nova, network, config, image_config, host=None):
+        server = FakeServer(host.id)
+        with lock:
+            booted.append((image_config.name, host.id, server))
+            running[0] += 1
+            running[1] = max(running)
+        return server
+    def wait_for_active(server):
+        time.sleep(0.2)
+        with lock:
+            running[0] -= 1
+        assert server.id != 'broken'
+    monkeypatch.setattr(prewarm, 'create_server', create_server)
+    monkeypatch.setattr(prewarm, 'wait_for_active', wait_for_active)
+    monkeypatch.setattr(prewarm, 'wait_while_exists', lambda server: None)
+    return booted, running
+
+def test_prewarm_images(tmpdir, monkeypatch):
+    booted, _ = fake_boot(monkeypatch)
+
+    marker = str(tmpdir.join('marker'))
+    config = FakeConfig()
+    start = time.time()
+    warmed = prewarm.prewarm_images(FakeNova(), None, config, marker)
+    # Every image on every host, in parallel.
+    assert time.time() - start < 1.0
+    assert len(booted) == 6
+    assert sorted(warmed.keys()) == ['id-centos', 'id-precise']
+    assert warmed['id-precise']['host-2']['seconds'] >= 0.2
+
+    # Only what's new gets warmed next time.
+    config.hosts.append('host-4')
+    warmed = prewarm.prewarm_images(FakeNova(), None, config, marker)
+    assert len(booted) == 8
+    assert sorted(h for _, h, _ in booted[6:]) == ['host-4', 'host-4']
+    assert len(warmed['id-centos']) == 4
+    assert all(server.deleted for _, _, server in booted)
+
+def test_prewarm_bounded(tmpdir, monkeypatch):
+    booted, running = fake_boot(monkeypatch)
+    config = FakeConfig()
+    config.hosts.append('broken')
+    config.prewarm_workers = 2
+    warmed = prewarm.prewarm_images(FakeNova(), None, config,
+                                    str(tmpdir.join('marker')))
+    assert len(booted) == 8
+    assert running[1] == 2
+    # Servers that never went ACTIVE are deleted too, and not recorded.
+    assert all(server.deleted for _, _, server in booted)
+    assert 'broken' not in warmed['id-precise']
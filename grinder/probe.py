@@ -0,0 +1,210 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import errno
+import os
+import select
+import socket
+import struct
+import time
+
+from . logger import log
+from . util import wait_for
+
+ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+
+def icmp_checksum(data):
+    if len(data) % 2:
+        data += '\0'
+    total = sum(struct.unpack('!%dH' % (len(data) / 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+def icmp_echo_request(ident, seq):
+    payload = 'grinder'
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, ident, seq)
+    checksum = icmp_checksum(header + payload)
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, ident, seq)
+    return header + payload
+
+def open_icmp_socket():
+    '''Returns an ICMP socket, or None if we aren't permitted to open one.
+    Unprivileged ping sockets are tried first, then raw sockets.'''
+    for kind in [socket.SOCK_DGRAM, socket.SOCK_RAW]:
+        try:
+            sock = socket.socket(socket.AF_INET, kind,
+                                 socket.getprotobyname('icmp'))
+            sock.setblocking(0)
+            return sock
+        except socket.error:
+            continue
+    log.debug('Not permitted to open an ICMP socket, probing TCP only.')
+    return None
+
+class Target(object):
+
+    def __init__(self, addr, port, icmp):
+        self.addr = addr
+        self.port = port
+        self.icmp = icmp
+        self.sock = None
+        # Sequence numbers of the echo requests sent to this address.
+        self.seqs = set()
+        self.attempt_start = None
+        self.icmp_time = None
+        self.tcp_time = None
+
+    def __str__(self):
+        return '%s:%d' % (self.addr, self.port)
+
+class Prober(object):
+    '''
+    Probes many addresses for reachability at once from a single thread:
+    non-blocking TCP connects to a port (ssh, or the Windows link) and,
+    where permitted, ICMP echo. An address is reachable once its port
+    accepts a connection. Time-to-reachable is recorded per address, for
+    ICMP and TCP separately, relative to the start of the probe.
+    '''
+    CONNECT_TIMEOUT = 2.0
+    RETRY_INTERVAL = 0.5
+
+    def __init__(self):
+        self.targets = []
+        self.icmp_sock = None
+        self.ident = os.getpid() & 0xffff
+        self.seq = 0
+        self.last_ping = 0
+        self.start = None
+
+    def add(self, addr, port, icmp=True):
+        self.targets.append(Target(addr, port, icmp))
+
+    def pending(self):
+        return [t for t in self.targets if t.tcp_time is None]
+
+    def _connect(self, target, now):
+        target.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        target.sock.setblocking(0)
+        target.attempt_start = now
+        rc = target.sock.connect_ex((target.addr, target.port))
+        if rc not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+            self._close(target)
+
+    def _close(self, target):
+        if target.sock is not None:
+            target.sock.close()
+            target.sock = None
+
+    def _ping(self, now):
+        self.last_ping = now
+        self.seq = (self.seq + 1) & 0xffff
+        for target in self.pending():
+            if target.icmp and target.icmp_time is None:
+                try:
+                    self.icmp_sock.sendto(icmp_echo_request(self.ident, self.seq),
+                                          (target.addr, 0))
+                    target.seqs.add(self.seq)
+                except socket.error:
+                    pass
+
+    def _reply_ident(self):
+        # Ping sockets replace the ident with their own port (and only get
+        # their own replies); raw sockets get every reply on the host.
+        if self.icmp_sock.type == socket.SOCK_DGRAM:
+            return self.icmp_sock.getsockname()[1]
+        return self.ident
+
+    def _read_replies(self, now):
+        while True:
+            try:
+                packet, (addr, _) = self.icmp_sock.recvfrom(1024)
+            except socket.error:
+                return
+            # Raw sockets hand us the IP header too.
+            if self.icmp_sock.type == socket.SOCK_RAW:
+                packet = packet[(ord(packet[0]) & 0xf) * 4:]
+            if len(packet) < 8 or ord(packet[0]) != ICMP_ECHO_REPLY:
+                continue
+            # Only replies to our own requests count.
+            (_, _, _, ident, seq) = struct.unpack('!BBHHH', packet[:8])
+            if ident != self._reply_ident():
+                continue
+            for target in self.targets:
+                if target.addr == addr and target.icmp_time is None and \
+                   seq in target.seqs:
+                    target.icmp_time = now - self.start
+
+    def poll(self):
+        '''Makes progress without blocking. Returns True once every target
+        is reachable.'''
+        now = time.time()
+        if self.start is None:
+            self.start = now
+            if any(t.icmp for t in self.targets):
+                self.icmp_sock = open_icmp_socket()
+
+        if self.icmp_sock is not None:
+            self._read_replies(now)
+            if now - self.last_ping >= self.RETRY_INTERVAL:
+                self._ping(now)
+
+        connecting = [t for t in self.pending() if t.sock is not None]
+        if connecting:
+            _, writable, _ = select.select([], [t.sock for t in connecting],
+                                           [], 0)
+            for target in connecting:
+                if target.sock in writable:
+                    err = target.sock.getsockopt(socket.SOL_SOCKET,
+                                                 socket.SO_ERROR)
+                    if err == 0:
+                        target.tcp_time = now - self.start
+                        log.debug('%s reachable after %.2fs', target,
+                                  target.tcp_time)
+                    self._close(target)
+                elif now - target.attempt_start > self.CONNECT_TIMEOUT:
+                    self._close(target)
+
+        for target in self.pending():
+            if target.sock is None and \
+               (target.attempt_start is None or
+                now - target.attempt_start >= self.RETRY_INTERVAL):
+                self._connect(target, now)
+
+        return len(self.pending()) == 0
+
+    def close(self):
+        for target in self.targets:
+            self._close(target)
+        if self.icmp_sock is not None:
+            self.icmp_sock.close()
+            self.icmp_sock = None
+
+    def results(self):
+        return dict((t.addr, {'icmp': t.icmp_time, 'tcp': t.tcp_time})
+                    for t in self.targets)
+
+    def wait(self, duration=None):
+        '''Probes until every target is reachable and returns the results.
+        Honours deadlines and watchdogs like any other wait_for.'''
+        try:
+            wait_for('%s to be reachable' %
+                     ', '.join(str(t) for t in self.targets),
+                     self.poll, interval=0.05, duration=duration,
+                     category='probe')
+            return self.results()
+        finally:
+            self.close()
@@ -0,0 +1,111 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import socket
+import struct
+import threading
+import time
+
+import probe
+import util
+
+def listen(addr='127.0.0.1', port=0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((addr, port))
+    sock.listen(5)
+    return sock, sock.getsockname()[1]
+
+def closed_port(addr='127.0.0.1'):
+    sock, port = listen(addr)
+    sock.close()
+    return port
+
+def test_icmp_echo_request():
+    packet = probe.icmp_echo_request(0x1234, 7)
+    assert struct.unpack('!BBHHH', packet[:8])[0] == probe.ICMP_ECHO_REQUEST
+    # A packet including its checksum sums to zero.
+    assert probe.icmp_checksum(packet) == 0
+
+def test_probe_many():
+    listeners = [listen() for i in range(3)]
+    prober = probe.Prober()
+    for _, port in listeners:
+        prober.add('127.0.0.1', port, icmp=False)
+    # This one only starts listening a little later.
+    late_port = closed_port('127.0.0.2')
+    prober.add('127.0.0.2', late_port, icmp=False)
+    def listen_late():
+        time.sleep(0.6)
+        listeners.append(listen('127.0.0.2', late_port))
+    thread = threading.Thread(target=listen_late)
+    thread.start()
+    results = prober.wait(duration=10)
+    thread.join()
+    assert results['127.0.0.1']['tcp'] < 0.5
+    assert results['127.0.0.2']['tcp'] >= 0.5
+    assert results['127.0.0.1']['icmp'] is None
+    for sock, _ in listeners:
+        sock.close()
+
+def test_probe_timeout():
+    prober = probe.Prober()
+    prober.add('127.0.0.1', closed_port(), icmp=False)
+    start = time.time()
+    util.assert_raises(Exception, prober.wait, duration=1)
+    assert time.time() - start < 2
+    assert prober.icmp_sock is None
+
+class FakeICMPSocket(object):
+    def __init__(self, type, replies):
+        self.type = type
+        self.replies = replies
+
+    def getsockname(self):
+        return ('0.0.0.0', 4321)
+
+    def recvfrom(self, size):
+        if len(self.replies) == 0:
+            raise socket.error()
+        return self.replies.pop(0)
+
+def echo_reply(ident, seq):
+    return struct.pack('!BBHHH', probe.ICMP_ECHO_REPLY, 0, 0, ident, seq)
+
+def test_icmp_replies_matched():
+    prober = probe.Prober()
+    prober.ident = 1234
+    prober.add('10.0.0.1', 22)
+    prober.add('10.0.0.2', 22)
+    prober.start = 0
+    prober.targets[0].seqs.add(3)
+    prober.targets[1].seqs.add(3)
+    # Ping sockets: our ident is the socket's port. Replies to other
+    # processes, or to requests never sent to that address, don't count.
+    prober.icmp_sock = FakeICMPSocket(socket.SOCK_DGRAM, [
+        (echo_reply(prober.ident ^ 1, 3), ('10.0.0.1', 0)),
+        (echo_reply(4321 ^ 1, 3), ('10.0.0.1', 0)),
+        (echo_reply(4321, 4), ('10.0.0.1', 0)),
+        (echo_reply(4321, 3), ('10.0.0.2', 0))])
+    prober._read_replies(1.0)
+    assert prober.targets[0].icmp_time is None
+    assert prober.targets[1].icmp_time == 1.0
+    # Raw sockets: our ident is the one we sent, after the IP header.
+    ip_header = chr(0x45) + '\0' * 19
+    prober.icmp_sock = FakeICMPSocket(socket.SOCK_RAW, [
+        (ip_header + echo_reply(4321, 3), ('10.0.0.1', 0)),
+        (ip_header + echo_reply(prober.ident, 3), ('10.0.0.1', 0))])
+    prober._read_replies(2.0)
+    assert prober.targets[0].icmp_time == 2.0
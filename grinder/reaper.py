@@ -0,0 +1,148 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import Queue
+import time
+import traceback
+
+from threading import Thread, Event, Lock
+
+from . logger import log
+from . config import default_config
+
+class Job(object):
+    def __init__(self, description, action, after, group=None):
+        self.description = description
+        self.action = action
+        self.after = list(after)
+        self.group = group
+        self.done = Event()
+        self.failed = False
+
+    def __str__(self):
+        return self.description
+
+class Reaper(object):
+    '''
+    Completes teardown in the background so that tests don't sit idle while
+    their resources go away. submit() queues an action and returns at once;
+    up to max_workers actions run at a time, in submission order. An action
+    still runs when its dependencies failed; one that fails is recorded as a
+    leak (along with any failed dependencies) and reported at the end of the
+    session by drain().
+    '''
+
+    def __init__(self, max_workers):
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.jobs = []
+        self.leaks = []
+        self.workers = []
+        for i in range(max(1, max_workers)):
+            worker = Thread(target=self.work, name='reaper-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, description, action, after=None, group=None):
+        '''
+        Queues action. It runs once the jobs in after are done; after=None
+        means every unfinished job submitted so far in the same group (e.g.
+        by the same test), which suits resources (security groups, keypairs,
+        volumes) that outlive the instances using them.
+        '''
+        with self.lock:
+            if after is None:
+                after = [job for job in self.jobs
+                         if job.group is group and not job.done.is_set()]
+            job = Job(description, action, after, group)
+            self.jobs.append(job)
+        log.debug('Reaping %s in the background', job)
+        self.queue.put(job)
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            # Jobs only depend on earlier ones, which have already been
+            # picked up by a worker, so this can't deadlock.
+            for dep in job.after:
+                dep.done.wait()
+            # Try anyway: the failed dependency may not have been what was
+            # holding this resource.
+            failed = [str(dep) for dep in job.after if dep.failed]
+            if failed:
+                log.warn('Reaping %s although %s failed', job,
+                         ', '.join(failed))
+            try:
+                job.action()
+                log.debug('Reaped %s', job)
+            except:
+                log.exception('Failed to reap %s', job)
+                job.failed = True
+                reason = traceback.format_exc()
+                if failed:
+                    reason = 'Depends on %s, which failed.\n%s' % \
+                             (', '.join(failed), reason)
+                with self.lock:
+                    self.leaks.append((job.description, reason))
+            finally:
+                job.done.set()
+
+    def pending(self):
+        with self.lock:
+            return [job for job in self.jobs if not job.done.is_set()]
+
+    def drain(self, timeout=None):
+        '''
+        Waits for everything submitted so far and returns the leaks, as
+        (description, reason) pairs. Jobs still running after timeout seconds
+        are reported as leaks too.
+        '''
+        start = time.time()
+        for job in self.pending():
+            remaining = None
+            if timeout is not None:
+                remaining = max(0, timeout - (time.time() - start))
+            job.done.wait(remaining)
+        with self.lock:
+            leaks = list(self.leaks)
+            leaks.extend((job.description, 'Still being torn down.\n')
+                         for job in self.jobs if not job.done.is_set())
+            self.jobs = [job for job in self.jobs if not job.done.is_set()]
+            self.leaks = []
+        return leaks
+
+_reaper = None
+_reaper_lock = Lock()
+
+def get_reaper(config=default_config):
+    '''Returns the session's Reaper, or None when teardown is synchronous.'''
+    global _reaper
+    if not config.background_teardown:
+        return None
+    with _reaper_lock:
+        if _reaper is None:
+            _reaper = Reaper(int(config.reaper_workers))
+        return _reaper
+
+def drain_reaper(timeout=None):
+    '''Waits for background teardown; returns the leaks (see Reaper.drain).'''
+    if _reaper is None:
+        return []
+    leaks = _reaper.drain(timeout)
+    for description, reason in leaks:
+        log.error('Leaked %s: %s', description, reason)
+    return leaks
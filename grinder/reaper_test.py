@@ -0,0 +1,74 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+from threading import Lock
+
+import reaper
+
+def test_reaper():
+    lock = Lock()
+    events = []
+    running = [0, 0]
+
+    def action(name, duration=0.2, fail=False):
+        def run():
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(duration)
+            with lock:
+                running[0] -= 1
+                events.append(name)
+            if fail:
+                raise ValueError(name)
+        return run
+
+    r = reaper.Reaper(max_workers=2)
+    start = time.time()
+    for i in range(4):
+        r.submit('instance %d' % i, action('instance %d' % i), after=[],
+                 group='test')
+    bad = r.submit('bad instance', action('bad instance', 0.0, fail=True),
+                   after=[], group='other test')
+    r.submit('secgroup', action('secgroup', 0.0), group='test')
+    r.submit('keypair', action('keypair', 0.0), after=[bad])
+    r.submit('volume', action('volume', 0.0, fail=True), group='other test')
+    # Submitting doesn't wait for anything.
+    assert time.time() - start < 0.1
+
+    leaks = r.drain()
+    assert running[1] == 2
+    # The security group only waits for its own test's instances, and
+    # runs after all of them.
+    assert events.index('secgroup') > \
+           max(events.index('instance %d' % i) for i in range(4))
+    # Failed dependencies don't stop an action from being attempted, but
+    # are named when it fails too.
+    assert 'keypair' in events
+    assert 'volume' in events
+    assert sorted(description for description, _ in leaks) == \
+           ['bad instance', 'volume']
+    assert 'ValueError' in dict(leaks)['bad instance']
+    assert 'Depends on bad instance' in dict(leaks)['volume']
+    assert r.drain() == []
+
+def test_reaper_timeout():
+    r = reaper.Reaper(max_workers=1)
+    r.submit('slow', lambda: time.sleep(0.5))
+    leaks = r.drain(timeout=0.1)
+    assert [description for description, _ in leaks] == ['slow']
+    assert r.drain() == []
@@ -0,0 +1,79 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from threading import Lock
+
+from . logger import log
+
+class Entry(object):
+    def __init__(self, resource, destroy):
+        self.resource = resource
+        self.destroy = destroy
+        self.holders = []
+
+class SharedResources(object):
+    '''
+    Per-process cache of equivalent resources (security groups with the same
+    rules, keypairs) that tests can share instead of creating their own.
+    Resources are reference counted by holder: a holder acquiring the same
+    key twice gets two distinct resources, since it presumably needs them
+    to differ, but different holders share. Nothing is deleted until
+    drain(), at the end of the session.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.entries = {}
+
+    def acquire(self, key, holder, create, destroy):
+        '''Returns a resource for key, calling create() for a new one when
+        holder already holds all there are. destroy(resource) deletes it.'''
+        with self.lock:
+            for entry in self.entries.get(key, []):
+                if holder not in entry.holders:
+                    entry.holders.append(holder)
+                    return entry.resource
+        entry = Entry(create(), destroy)
+        entry.holders.append(holder)
+        with self.lock:
+            self.entries.setdefault(key, []).append(entry)
+        return entry.resource
+
+    def release(self, key, holder, resource):
+        with self.lock:
+            for entry in self.entries.get(key, []):
+                if entry.resource is resource:
+                    entry.holders.remove(holder)
+                    return
+
+    def count(self, key):
+        '''How many holders share resources for key.'''
+        with self.lock:
+            return sum(len(e.holders) for e in self.entries.get(key, []))
+
+    def drain(self):
+        with self.lock:
+            entries = [e for entries in self.entries.values() for e in entries]
+            self.entries = {}
+        for entry in entries:
+            if len(entry.holders) > 0:
+                log.warn('Deleting shared %s still held by %d holders',
+                         entry.resource, len(entry.holders))
+            try:
+                entry.destroy(entry.resource)
+            except:
+                log.exception('Failed to delete shared %s', entry.resource)
+
+shared_resources = SharedResources()
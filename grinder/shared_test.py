@@ -0,0 +1,46 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import itertools
+
+import shared
+
+def test_shared_resources():
+    resources = shared.SharedResources()
+    ids = itertools.count()
+    destroyed = []
+    create = lambda: 'group-%d' % ids.next()
+
+    first = resources.acquire('sg', 'test-1', create, destroyed.append)
+    # Another test shares it, the same test gets a second one.
+    assert resources.acquire('sg', 'test-2', create, destroyed.append) == first
+    second = resources.acquire('sg', 'test-1', create, destroyed.append)
+    assert second != first
+    # Keyed by what the resource is.
+    assert resources.acquire('kp', 'test-1', create, destroyed.append) \
+        not in [first, second]
+    assert resources.count('sg') == 3
+
+    resources.release('sg', 'test-1', first)
+    resources.release('sg', 'test-2', first)
+    resources.release('sg', 'test-1', second)
+    assert resources.count('sg') == 0
+    # Released resources are kept around for later tests.
+    assert resources.acquire('sg', 'test-3', create, destroyed.append) == first
+    assert destroyed == []
+
+    resources.drain()
+    assert sorted(destroyed) == ['group-0', 'group-1', 'group-2']
+    assert resources.count('sg') == 0
@@ -16,10 +16,16 @@
 import select
 import socket
 import subprocess
+import threading
 import time
 
 from . logger import log
 from . util import wait_for
+from . util import remaining_time
+from . util import Deadline
+
+# What ssh exits with when it couldn't connect, or lost the connection.
+SSH_ERROR = 255
 
 class SecureShell(object):
 
@@ -41,6 +47,9 @@ class SecureShell(object):
                 "-o", "PasswordAuthentication=no",
                 "-o", "TCPKeepAlive=yes",
                 "-o", "ServerAliveInterval=30"]
+        timeout = remaining_time()
+        if timeout is not None:
+            ssh_args += ["-o", "ConnectTimeout=%d" % max(1, int(timeout))]
         if self.key_path is not None:
             ssh_args += ["-i", self.key_path]
 
@@ -50,19 +59,39 @@ class SecureShell(object):
 
     def check_output(self, command, input=None,
                      expected_rc=0, expected_output=None,
-                     exc=False, extra_message=None, returnrc=False):
-        # Run the given command through a shell on the other end.
+                     exc=False, extra_message=None, returnrc=False,
+                     output=None):
+        # Run the given command through a shell on the other end. With
+        # output (a file), stdout goes straight there instead of being
+        # returned.
         command = self.ssh_args() + ['sh', '-c', "'%s'" % command]
         ssh = subprocess.Popen(command,
                                stdin=subprocess.PIPE,
-                               stdout=subprocess.PIPE,
+                               stdout=(output or subprocess.PIPE),
                                stderr=subprocess.PIPE,
                                close_fds=True)
 
         # Always execute the command in one go, we don't support
-        # running long running commands in the test framework.
-        (stdout, stderr) = ssh.communicate(input)
-        (stdout, stderr) = (stdout.strip(), stderr.strip())
+        # running long running commands in the test framework. Inside a
+        # Deadline the command is killed when the budget runs out.
+        timeout = remaining_time()
+        killed = []
+        def kill():
+            killed.append(True)
+            ssh.kill()
+        killer = None
+        if timeout is not None:
+            killer = threading.Timer(timeout, kill)
+            killer.start()
+        try:
+            (stdout, stderr) = ssh.communicate(input)
+        finally:
+            if killer is not None:
+                killer.cancel()
+        if killed:
+            raise Exception('Timeout: command %s on %s killed (%s)' %
+                            (command[-1], self.host, Deadline.current()))
+        (stdout, stderr) = ((stdout or '').strip(), stderr.strip())
         if (expected_rc != None and expected_rc != ssh.returncode) or \
            (expected_output != None and stdout != expected_output):
             errormsg = ""
@@ -123,21 +152,28 @@ class WinShell(object):
         # When attempting to connect immediately after boot, the
         # TestListener service may not yet be initialized. Until the
         # service binds the port, we'll get connection refused errors.
+        # Inside a Deadline, retries stop when the budget runs out.
         retries = 100
         while True:
             try:
                 retries -= 1
-                sock = socket.create_connection((self.host, self.port), 5)
+                sock = socket.create_connection((self.host, self.port),
+                                                max(0.1, remaining_time(5)))
                 sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 return sock
             except socket.error, exc:
                 log.debug("Failed to connect to %s: %s. Retrying." % \
                               (self.host, exc))
-                time.sleep(1)
-                if retries <= 0:
+                if retries <= 0 or remaining_time(1) <= 0:
                     raise
+                time.sleep(remaining_time(1))
 
     def check_output(self, command, expected_output="ok", timeout=60):
+        if timeout is not None:
+            timeout = remaining_time(timeout)
+            if timeout <= 0:
+                raise Exception('Timeout: link command %s on %s not sent (%s)' %
+                                (command, self.host, Deadline.current()))
         sock = self._connect()
         try:
             log.debug("Link I: %s" % command)
@@ -161,6 +197,9 @@ class WinShell(object):
                                          command +
                                      "response: %s. Expecting: %s." % \
                                          (response, expected_output))
+            elif remaining_time(1) <= 0:
+                raise Exception('Timeout: link command %s on %s killed (%s)' %
+                                (command, self.host, Deadline.current()))
             else:
                 raise RuntimeError("Link command '%s' timed out." % command)
 
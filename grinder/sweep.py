@@ -0,0 +1,187 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+'''
+Deletes what grinder runs left behind: servers named after a run (and
+everything blessed or launched from them), the run's volumes and their
+snapshots, and the run's security groups and keypairs.
+
+    python -m grinder.sweep [--run-name PREFIX] [--dry-run]
+
+Without --run-name (or RUN_NAME), every run by this user on this host is
+swept.
+'''
+
+import optparse
+import os
+import sys
+
+from getpass import getuser
+from socket import gethostname
+
+import novaclient.exceptions
+import cinderclient.exceptions
+
+from . logger import log
+from . config import default_config
+from . client import create_client
+from . teardown import TeardownGraph
+from . teardown import add_security_group
+from . teardown import add_keypair
+from . util import wait_while_all_exist
+from . util import name_prefix
+from . util import volume_prefix
+
+def parent_id(server):
+    metadata = getattr(server, 'metadata', {}) or {}
+    return metadata.get('launched_from') or metadata.get('blessed_from')
+
+def find_servers(servers, run_name):
+    '''Servers named after run_name, plus whatever descends from them.'''
+    found = dict((s.id, s) for s in servers if s.name.startswith(run_name))
+    while True:
+        children = [s for s in servers
+                    if s.id not in found and parent_id(s) in found]
+        if len(children) == 0:
+            return found.values()
+        found.update((s.id, s) for s in children)
+
+class DryRun(object):
+    '''Wraps a TeardownGraph so that its steps only say what they'd do.'''
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def add(self, description, action, after=()):
+        return self.graph.add(description,
+                              lambda: log.info('Would %s', description),
+                              after=after)
+
+class Sweeper(object):
+    '''
+    Builds a TeardownGraph of the leaked resources: clones go before the
+    blessed instances they were launched from, which go before their
+    masters; snapshots go once blessed instances are discarded, volumes
+    once their snapshots are gone and nothing can be attached to them, and
+    security groups and keypairs after every server. Each step waits for
+    its own resource to go, and those waits are served by shared listings.
+    '''
+
+    def __init__(self, nova, gcapi, cinder, run_name, dry_run=False):
+        self.nova = nova
+        self.gcapi = gcapi
+        self.cinder = cinder
+        self.run_name = run_name
+        self.dry_run = dry_run
+
+    def delete_and_wait(self, resource, delete):
+        def action():
+            try:
+                delete(resource)
+            except (novaclient.exceptions.NotFound,
+                    cinderclient.exceptions.NotFound):
+                # Went along with something deleted before it.
+                return
+            wait_while_all_exist([resource])
+        return action
+
+    def build(self, graph):
+        servers = find_servers(self.nova.servers.list(), self.run_name)
+        nodes = {}
+        def add_server(server):
+            if server.id in nodes:
+                return nodes[server.id]
+            after = [add_server(child) for child in servers
+                     if parent_id(child) == server.id]
+            if (getattr(server, 'metadata', {}) or {}).get('blessed_from'):
+                node = graph.add('discard %s (%s)' % (server.name, server.id),
+                                 self.delete_and_wait(
+                                     server, self.gcapi.discard_instance),
+                                 after=after)
+            else:
+                node = graph.add('delete %s (%s)' % (server.name, server.id),
+                                 self.delete_and_wait(server,
+                                                      lambda s: s.delete()),
+                                 after=after)
+            nodes[server.id] = node
+            return node
+        for server in servers:
+            add_server(server)
+        server_nodes = nodes.values()
+
+        # Like run_name, only prefixes of the run names to sweep.
+        prefix = name_prefix(self.run_name)[:-1]
+        volumes = [v for v in self.cinder.volumes.list()
+                   if (v.display_name or '').startswith(
+                       volume_prefix(self.run_name)[:-1])]
+        volume_ids = set(v.id for v in volumes)
+        snapshot_nodes = {}
+        for snapshot in self.cinder.volume_snapshots.list():
+            if snapshot.volume_id in volume_ids:
+                snapshot_nodes.setdefault(snapshot.volume_id, []).append(
+                    graph.add('delete snapshot %s' % snapshot.id,
+                              self.delete_and_wait(snapshot,
+                                                   lambda s: s.delete()),
+                              after=server_nodes))
+        for volume in volumes:
+            if volume.status == 'in-use':
+                log.warn('Volume %s is still attached, sweeping it once '
+                         'its server is gone', volume.display_name)
+            graph.add('delete volume %s' % volume.display_name,
+                      self.delete_and_wait(volume, lambda v: v.delete()),
+                      after=server_nodes + snapshot_nodes.get(volume.id, []))
+
+        for secgroup in self.nova.security_groups.list():
+            if secgroup.name.startswith(prefix):
+                add_security_group(graph, self.nova, secgroup,
+                                   after=server_nodes)
+        for keypair in self.nova.keypairs.list():
+            if keypair.name.startswith(prefix):
+                add_keypair(graph, self.nova, keypair, after=server_nodes)
+        return graph
+
+    def sweep(self, concurrency=None):
+        graph = TeardownGraph(concurrency)
+        self.build(DryRun(graph) if self.dry_run else graph)
+        log.info('Sweeping %d resources of %s', len(graph.nodes),
+                 self.run_name)
+        graph.run()
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.strip().split('\n')[0])
+    parser.add_option('--run-name', default=None,
+                      help='sweep runs whose run_name starts with this '
+                           '(default: this user on this host)')
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="only list what would be deleted, in order")
+    parser.add_option('--concurrency', type='int',
+                      default=default_config.teardown_concurrency,
+                      help='how many deletions to run at once')
+    options, _ = parser.parse_args(argv)
+
+    run_name = options.run_name or os.getenv('RUN_NAME') or \
+               '%s@%s-' % (getuser(), gethostname())
+    nova, gcapi, cinder, _ = create_client(default_config)
+    sweeper = Sweeper(nova, gcapi, cinder, run_name, options.dry_run)
+    try:
+        sweeper.sweep(options.concurrency)
+    except Exception, e:
+        log.error('Sweep incomplete: %s', str(e))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
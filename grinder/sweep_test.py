@@ -0,0 +1,85 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sweep
+
+class Fake(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+class FakeManager(object):
+    def __init__(self, resources):
+        self.resources = resources
+
+    def list(self):
+        return self.resources
+
+class FakeGraph(object):
+    def __init__(self):
+        self.nodes = []
+        self.after = {}
+
+    def add(self, description, action, after=()):
+        self.nodes.append(description)
+        self.after[description] = list(after)
+        return description
+
+def server(id, name, **metadata):
+    return Fake(id=id, name=name, metadata=metadata)
+
+def test_find_servers():
+    servers = [server('m', 'run-1-test'),
+               server('b', 'blessed', blessed_from='m'),
+               server('c', 'clone', launched_from='b'),
+               server('o', 'other-run-test'),
+               server('x', 'other-blessed', blessed_from='o')]
+    found = sweep.find_servers(servers, 'run-')
+    assert sorted(s.id for s in found) == ['b', 'c', 'm']
+
+def test_sweep_order():
+    nova = Fake(servers=FakeManager([server('m', 'run-1-test'),
+                                     server('b', 'blessed', blessed_from='m'),
+                                     server('c', 'clone', launched_from='b')]),
+                security_groups=FakeManager([Fake(name='run-1-abc'),
+                                             Fake(name='default')]),
+                keypairs=FakeManager([Fake(name='run-1-def')]))
+    cinder = Fake(volumes=FakeManager([Fake(id='v', status='available',
+                                            display_name='grindervol-run-1-a'),
+                                       Fake(id='w', status='available',
+                                            display_name='precious'),
+                                       # Another user's run, or older.
+                                       Fake(id='f', status='in-use',
+                                            display_name='grindervol-other-b'),
+                                       Fake(id='g', status='available',
+                                            display_name='grindervol-1')]),
+                  volume_snapshots=FakeManager([Fake(id='s', volume_id='v'),
+                                                Fake(id='t', volume_id='w'),
+                                                Fake(id='u', volume_id='f')]))
+    gcapi = Fake(discard_instance=None)
+    sweeper = sweep.Sweeper(nova, gcapi, cinder, 'run-')
+    graph = sweeper.build(FakeGraph())
+
+    assert len(graph.nodes) == 7
+    servers = ['delete run-1-test (m)', 'discard blessed (b)',
+               'delete clone (c)']
+    assert graph.after['delete clone (c)'] == []
+    assert graph.after['discard blessed (b)'] == ['delete clone (c)']
+    assert graph.after['delete run-1-test (m)'] == ['discard blessed (b)']
+    assert sorted(graph.after['delete snapshot s']) == sorted(servers)
+    assert sorted(graph.after['delete volume grindervol-run-1-a']) == \
+           sorted(servers + ['delete snapshot s'])
+    assert sorted(graph.after['delete security group run-1-abc']) == \
+           sorted(servers)
+    assert sorted(graph.after['delete keypair run-1-def']) == sorted(servers)
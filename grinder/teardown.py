@@ -0,0 +1,140 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import sys
+
+from threading import Thread, Condition
+
+from . logger import log
+from . config import default_config
+from . util import Deadline
+from . util import wait_while_exists
+
+class TeardownGraph(object):
+    '''
+    Tears resources down as a dependency graph. Each node is an action that
+    runs once all of the nodes it comes after are done; independent nodes run
+    concurrently, on up to max_workers threads which share the caller's
+    Deadline. When a node fails, the nodes depending on it are skipped, the
+    rest of the graph still runs, and the first failure is re-raised (with
+    its original traceback) once everything has settled.
+    '''
+
+    class Node(object):
+        def __init__(self, description, action, after):
+            self.description = description
+            self.action = action
+            self.after = list(after)
+
+        def __str__(self):
+            return self.description
+
+    def __init__(self, max_workers=None):
+        if max_workers is None:
+            max_workers = int(default_config.teardown_concurrency)
+        self.max_workers = max(1, max_workers)
+        self.nodes = []
+
+    def add(self, description, action, after=()):
+        node = TeardownGraph.Node(description, action, after)
+        self.nodes.append(node)
+        return node
+
+    def run(self):
+        if len(self.nodes) == 1:
+            # Nothing to overlap; keep the caller's thread and stack.
+            self.nodes[0].action()
+            return
+
+        deadline = Deadline.current()
+        cond = Condition()
+        pending = list(self.nodes)
+        done = set()
+        failed = set()
+        errors = []
+        running = [0]
+
+        def work(node):
+            try:
+                if deadline is not None:
+                    with deadline.adopted():
+                        node.action()
+                else:
+                    node.action()
+                success = True
+            except:
+                log.exception('Teardown of %s failed', node)
+                errors.append(sys.exc_info())
+                success = False
+            with cond:
+                running[0] -= 1
+                if success:
+                    done.add(node)
+                else:
+                    failed.add(node)
+                cond.notifyAll()
+
+        with cond:
+            while len(pending) > 0 or running[0] > 0:
+                for node in list(pending):
+                    if any(dep in failed for dep in node.after):
+                        log.error('Skipping teardown of %s', node)
+                        pending.remove(node)
+                        failed.add(node)
+                    elif running[0] < self.max_workers and \
+                         all(dep in done for dep in node.after):
+                        pending.remove(node)
+                        running[0] += 1
+                        thread = Thread(target=work, args=(node,))
+                        thread.daemon = True
+                        thread.start()
+                if running[0] == 0 and len(pending) > 0 and \
+                   not any(any(dep in failed for dep in node.after)
+                           for node in pending):
+                    raise Exception('Teardown graph has a cycle: %s' %
+                                    ', '.join(str(n) for n in pending))
+                cond.wait(1.0)
+
+        if len(errors) > 0:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+def add_server_waits(graph, servers, after=()):
+    '''Adds a step per server that waits for it to go; returns them.'''
+    return [graph.add('wait for %s (%s) to go' % (server.name, server.id),
+                      lambda server=server: wait_while_exists(server),
+                      after=after)
+            for server in servers]
+
+def add_security_group(graph, nova, secgroup, after=(), servers=()):
+    '''
+    Adds the deletion of secgroup to graph. It runs after the nodes in after
+    and once those of servers that use the group are gone, since nova won't
+    delete a group that's still in use.
+    '''
+    users = [server for server in servers
+             if secgroup.name in [group.get('name') for group in
+                                  getattr(server, 'security_groups', None)
+                                  or []]]
+    return graph.add('delete security group %s' % secgroup.name,
+                     lambda: nova.security_groups.delete(secgroup),
+                     after=list(after) + add_server_waits(graph, users))
+
+def add_keypair(graph, nova, keypair, after=(), servers=()):
+    '''Like add_security_group, for the servers booted with keypair.'''
+    users = [server for server in servers
+             if getattr(server, 'key_name', None) == keypair.name]
+    return graph.add('delete keypair %s' % keypair.name,
+                     lambda: nova.keypairs.delete(keypair),
+                     after=list(after) + add_server_waits(graph, users))
@@ -0,0 +1,152 @@
+# Copyright 2013 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import novaclient.exceptions
+import pytest
+import time
+
+from threading import Lock
+
+import teardown
+import util
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def action(self, name, duration=0.1, fail=False):
+        def run():
+            with self.lock:
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+                self.events.append(('start', name))
+            time.sleep(duration)
+            with self.lock:
+                self.running -= 1
+                self.events.append(('end', name))
+            if fail:
+                raise ValueError(name)
+        return run
+
+    def started(self, name):
+        return ('start', name) in self.events
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+def test_teardown_order():
+    recorder = Recorder()
+    graph = teardown.TeardownGraph(max_workers=8)
+    clones = [graph.add('clone %d' % i, recorder.action('clone %d' % i))
+              for i in range(4)]
+    blessed = graph.add('blessed', recorder.action('blessed'), after=clones)
+    volume = graph.add('volume', recorder.action('volume'))
+    master = graph.add('master', recorder.action('master'),
+                       after=[blessed, volume])
+    start = time.time()
+    graph.run()
+    elapsed = time.time() - start
+
+    # Clones and the volume overlap; blessed then master follow.
+    assert recorder.max_running == 5
+    assert elapsed < 0.6
+    for i in range(4):
+        assert recorder.index('end', 'clone %d' % i) < \
+               recorder.index('start', 'blessed')
+    assert recorder.index('end', 'blessed') < recorder.index('start', 'master')
+    assert recorder.index('end', 'volume') < recorder.index('start', 'master')
+
+def test_teardown_max_workers():
+    recorder = Recorder()
+    graph = teardown.TeardownGraph(max_workers=2)
+    for i in range(6):
+        graph.add('node %d' % i, recorder.action('node %d' % i, 0.05))
+    graph.run()
+    assert recorder.max_running == 2
+    assert len(recorder.events) == 12
+
+def test_teardown_failure():
+    recorder = Recorder()
+    graph = teardown.TeardownGraph(max_workers=4)
+    bad = graph.add('bad', recorder.action('bad', fail=True))
+    graph.add('dependent', recorder.action('dependent'), after=[bad])
+    graph.add('independent', recorder.action('independent', 0.3))
+    with pytest.raises(ValueError):
+        graph.run()
+    # The failure doesn't stop unrelated teardown, only what depends on it.
+    assert not recorder.started('dependent')
+    assert recorder.index('end', 'independent') > 0
+
+def test_teardown_deadline():
+    remaining = []
+    graph = teardown.TeardownGraph()
+    for i in range(2):
+        graph.add('node %d' % i,
+                  lambda: remaining.append(util.remaining_time(60)))
+    with util.Deadline(5, 'teardown'):
+        graph.run()
+    assert len(remaining) == 2
+    assert all(r <= 5 for r in remaining)
+
+class FakeServer(object):
+    def __init__(self, id, lifetime, security_groups=(), key_name=None):
+        self.id = id
+        self.name = 'server %d' % id
+        self.gone_at = time.time() + lifetime
+        self.security_groups = [{'name': name} for name in security_groups]
+        self.key_name = key_name
+
+    def get(self):
+        if time.time() >= self.gone_at:
+            raise novaclient.exceptions.NotFound(404)
+
+class FakeResource(object):
+    def __init__(self, name):
+        self.name = name
+
+class FakeManager(object):
+    def __init__(self, servers):
+        self.servers = servers
+        self.deleted = []
+
+    def delete(self, resource):
+        # Refuse while still in use, like nova does for security groups.
+        assert all(time.time() >= server.gone_at for server in self.servers)
+        self.deleted.append(resource.name)
+
+class FakeNova(object):
+    def __init__(self, group_users, keypair_users):
+        self.security_groups = FakeManager(group_users)
+        self.keypairs = FakeManager(keypair_users)
+
+def test_security_group_and_keypair():
+    users = [FakeServer(0, 0.3, ['sg'], 'key'), FakeServer(1, 0.6, ['sg'])]
+    others = [FakeServer(2, 60, ['default'], 'other')]
+    nova = FakeNova(users, users[:1])
+    graph = teardown.TeardownGraph(max_workers=8)
+    teardown.add_security_group(graph, nova, FakeResource('sg'),
+                                servers=users + others)
+    teardown.add_keypair(graph, nova, FakeResource('key'),
+                         servers=users + others)
+    # One wait per server using each resource; the other server's ignored.
+    assert len(graph.nodes) == 5
+    start = time.time()
+    graph.run()
+    assert time.time() - start >= 0.6
+    assert nova.security_groups.deleted == ['sg']
+    assert nova.keypairs.deleted == ['key']
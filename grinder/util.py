@@ -13,20 +13,25 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
 import copy
+import functools
 import inspect
-import os
+import itertools
+import random
+import re
 import sys
 import time
 import types
 import urllib
 import urlparse
 import traceback
+import weakref
 
 from . logger import log
 from . config import default_config
 
-from threading import Thread, Condition
+from threading import Thread, Condition, Lock, local
 
 import novaclient.exceptions
 import cinderclient.exceptions
@@ -115,24 +120,209 @@ def list_filter(l, exclude=None, include=None, only=None):
         only = l
     return [e for e in l if e not in exclude and e in only]
 
-def wait_for(message, condition, interval=1, duration=None):
+class PollingPolicy(object):
+    '''
+    Picks polling intervals for wait_for. Completion times are recorded per
+    category of wait (the wait message with ids, addresses and numbers
+    blanked out) and the intervals are scaled to the typical completion time:
+    a quick ping is polled every few hundred milliseconds while a long bless
+    backs off to a few seconds between polls. Intervals start small, grow
+    geometrically and are jittered so that parallel waiters don't poll in
+    lockstep.
+    '''
+    MIN_INTERVAL = 0.1
+    MAX_INTERVAL = 5.0
+    BACKOFF = 1.5
+    JITTER = 0.2
+    # Weight of the latest completion time in the running estimate.
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.lock = Lock()
+        self.estimates = {}
+
+    @staticmethod
+    def category(message):
+        for pattern in ['[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-'
+                        '[0-9a-fA-F]{4}-[0-9a-fA-F]{12}',
+                        '[0-9]+(\.[0-9]+){3}',
+                        '[0-9]+']:
+            message = re.sub(pattern, '#', message)
+        return message
+
+    def record(self, category, elapsed):
+        with self.lock:
+            estimate = self.estimates.get(category)
+            if estimate is None:
+                self.estimates[category] = elapsed
+            else:
+                self.estimates[category] = \
+                    (1 - self.ALPHA) * estimate + self.ALPHA * elapsed
+
+    def intervals(self, category):
+        with self.lock:
+            estimate = self.estimates.get(category)
+        if estimate is None:
+            # Nothing learned yet: back off towards the old fixed 1s interval.
+            interval, cap = self.MIN_INTERVAL, 1.0
+        else:
+            clamp = lambda x, lo, hi: max(lo, min(hi, x))
+            interval = clamp(estimate / 20, self.MIN_INTERVAL, 2.0)
+            cap = clamp(estimate / 10, interval, self.MAX_INTERVAL)
+        while True:
+            yield interval * random.uniform(1 - self.JITTER, 1 + self.JITTER)
+            interval = min(cap, interval * self.BACKOFF)
+
+polling_policy = PollingPolicy()
+
+class Deadline(object):
+    '''
+    A time budget shared by everything that runs inside it (on the same
+    thread): wait_for, ssh commands and link commands all get at most the
+    remaining time of the innermost deadline instead of their own full
+    timeout. Nested deadlines can only shorten the enclosing one. A detached
+    deadline starts a fresh budget (unless it is nested in another detached
+    one); cleanup paths use it so that they still get to run after the budget
+    that failed the test is spent.
+    '''
+    _stack = local()
+
+    def __init__(self, duration, name, detached=False):
+        self.duration = float(duration)
+        self.name = name
+        self.detached = detached
+        self.expires = None
+
+    @staticmethod
+    def stack():
+        if not hasattr(Deadline._stack, 'deadlines'):
+            Deadline._stack.deadlines = []
+        return Deadline._stack.deadlines
+
+    @staticmethod
+    def current():
+        stack = Deadline.stack()
+        if len(stack) == 0:
+            return None
+        return stack[-1]
+
+    def remaining(self):
+        return self.expires - time.time()
+
+    def __enter__(self):
+        self.expires = time.time() + self.duration
+        parent = Deadline.current()
+        if parent is not None and (parent.detached or not self.detached):
+            self.expires = min(self.expires, parent.expires)
+        Deadline.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        Deadline.stack().remove(self)
+
+    @contextlib.contextmanager
+    def adopted(self):
+        '''Shares this (already entered) deadline with another thread.'''
+        Deadline.stack().append(self)
+        try:
+            yield self
+        finally:
+            Deadline.stack().remove(self)
+
+    def __str__(self):
+        return 'deadline for %s' % self.name
+
+def remaining_time(duration=None):
+    '''
+    Returns duration capped to what is left of the current deadline, or
+    duration itself (possibly None) outside of any deadline.
+    '''
+    deadline = Deadline.current()
+    if deadline is None:
+        return duration
+    remaining = max(0, deadline.remaining())
+    if duration is None:
+        return remaining
+    return min(duration, remaining)
+
+class Watchdog(object):
+    '''
+    Fails in-flight waits early. While a watchdog is entered on a thread,
+    wait_for calls its check() before every poll; check() raises with the
+    cause when whatever is being waited on can no longer succeed.
+    Subclasses implement check() and should rate-limit expensive checks.
+    '''
+    _stack = local()
+
+    @staticmethod
+    def stack():
+        if not hasattr(Watchdog._stack, 'watchdogs'):
+            Watchdog._stack.watchdogs = []
+        return Watchdog._stack.watchdogs
+
+    @staticmethod
+    def check_all():
+        for watchdog in list(Watchdog.stack()):
+            watchdog.check()
+
+    def check(self):
+        raise NotImplementedError()
+
+    def __enter__(self):
+        Watchdog.stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        Watchdog.stack().remove(self)
+
+def budgeted(name=None, detached=False):
+    '''
+    Decorates a method so that it runs inside a Deadline of operation_budget
+    seconds, named after the operation and the object it runs on.
+    '''
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapped(self, *args, **kwargs):
+            budget = default_config.operation_budget
+            if budget is None:
+                budget = 2 * float(default_config.ops_timeout)
+            operation = name or '%s of %s' % (fn.__name__, self)
+            with Deadline(budget, operation, detached=detached):
+                return fn(self, *args, **kwargs)
+        return wrapped
+    return decorator
+
+def wait_for(message, condition, interval=None, duration=None, category=None):
+    '''
+    Polls condition() until it returns True, or raises after duration seconds
+    (default: ops_timeout, capped by the current Deadline). Polling is
+    adaptive (see PollingPolicy) unless a fixed interval is given. The
+    category used to learn completion times defaults to one derived from the
+    message.
+    '''
     if duration is None:
         duration = int(default_config.ops_timeout)
-    log.info('Waiting %ss for %s', duration, message)
+    if category is None:
+        category = PollingPolicy.category(message)
+    deadline = Deadline.current()
+    if deadline is not None and deadline.remaining() < duration:
+        duration = max(0, deadline.remaining())
+        message = '%s (%s)' % (message, deadline)
+    if interval is None:
+        intervals = polling_policy.intervals(category)
+    else:
+        intervals = itertools.repeat(interval)
+    log.info('Waiting %ds for %s', duration, message)
     start = time.time()
     while True:
+        Watchdog.check_all()
         if condition():
+            polling_policy.record(category, time.time() - start)
             return
         remaining = start + duration - time.time()
         if remaining <= 0:
-            raise Exception('Timeout: waited %ss for %s' % (duration, message))
-        time.sleep(min(interval, remaining))
-
-def wait_for_ping(addrs):
-    assert len(addrs) > 0
-    ip = addrs[0]
-    wait_for('ping %s to respond' % ip,
-             lambda: os.system('ping -n %s -c 1 -W 1 > /dev/null 2>&1' % ip) == 0)
+            raise Exception('Timeout: waited %ds for %s' % (duration, message))
+        time.sleep(min(intervals.next(), remaining))
 
 # The .get() method and id field apply to nova servers and cinder volumes. More
 # generally to all subclasses of an Openstack Resource.
@@ -168,6 +358,66 @@ def wait_while_exists(os_resource):
     wait_for('%s %s to not exist' % \
              (os_resource.__class__.__name__, str(os_resource.id)), condition)
 
+class ResourceListing(object):
+    '''
+    Serves the state of many OpenStack resources from a single list() call on
+    their manager. A listing is reused by every caller (in any thread) for
+    max_age seconds, so N resources being waited on cost one API call per
+    tick instead of N .get() calls.
+    '''
+    def __init__(self, max_age=0.5):
+        self.max_age = max_age
+        self.lock = Lock()
+        self.listings = weakref.WeakKeyDictionary()
+
+    def _list(self, manager):
+        with self.lock:
+            fetched, by_id = self.listings.get(manager, (0, None))
+            if by_id is None or time.time() - fetched > self.max_age:
+                by_id = dict((r.id, r) for r in manager.list())
+                self.listings[manager] = (time.time(), by_id)
+            return by_id
+
+    def refresh(self, os_resource):
+        '''Updates os_resource in place from the listing of its manager.
+        Returns False if the resource is no longer listed.'''
+        listed = self._list(os_resource.manager).get(os_resource.id)
+        if listed is None:
+            return False
+        os_resource._add_details(listed._info)
+        return True
+
+resource_listing = ResourceListing()
+
+def wait_for_all(os_resources, predicate, description):
+    '''
+    Waits until predicate(os_resource, exists) holds for every resource. The
+    resources are refreshed in bulk through resource_listing and each one is
+    dropped from the watch set as soon as its own predicate holds.
+    '''
+    pending = list(os_resources)
+    def condition():
+        for os_resource in list(pending):
+            exists = resource_listing.refresh(os_resource)
+            if predicate(os_resource, exists):
+                log.debug('%s ID %s done waiting for %s',
+                          os_resource.__class__.__name__,
+                          str(os_resource.id), description)
+                pending.remove(os_resource)
+        return len(pending) == 0
+    if len(pending) > 0:
+        wait_for('%d resources to %s' % (len(pending), description), condition)
+
+def wait_while_all_status(os_resources, status):
+    # A resource that vanished while in the given status is done waiting too;
+    # callers assert on the final status as they do with wait_while_status.
+    wait_for_all(os_resources,
+                 lambda r, exists: not exists or r.status.lower() != status.lower(),
+                 'finish %s' % status)
+
+def wait_while_all_exist(os_resources):
+    wait_for_all(os_resources, lambda r, exists: not exists, 'not exist')
+
 def fix_url_for_yum(url):
     # Yum's URL parser cannot deal with commas and such.
     s = urlparse.urlsplit(url)
@@ -177,6 +427,19 @@ def fix_url_for_yum(url):
         parts.append(elem)
     return urlparse.urlunsplit(parts)
 
+def name_prefix(run_name):
+    '''
+    The prefix of the names of security groups and keypairs created for
+    run_name. Keypair names only allow letters, digits, '-' and '_'.
+    '''
+    return re.sub('[^A-Za-z0-9_-]', '_', run_name) + '-'
+
+VOLUME_PREFIX = 'grindervol-'
+
+def volume_prefix(run_name):
+    '''The prefix of the names of volumes created for run_name.'''
+    return VOLUME_PREFIX + name_prefix(run_name)
+
 def mb2pages(mb):
     return mb * 256
 
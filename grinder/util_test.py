@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
 import os
 import pytest
 import sys
@@ -239,3 +240,114 @@ def test_timedelta_total_seconds():
 
 
 
+class FakeResource(object):
+    def __init__(self, manager, id, status):
+        self.manager = manager
+        self.id = id
+        self.status = status
+        self._info = {'id': id, 'status': status}
+
+    def _add_details(self, info):
+        self._info = info
+        for (k, v) in info.items():
+            setattr(self, k, v)
+
+class FakeManager(object):
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.list_calls = 0
+
+    def list(self):
+        self.list_calls += 1
+        # Every listing moves each resource one step along its status list.
+        result = []
+        for id, statuses in self.statuses.items():
+            if len(statuses) > 0:
+                result.append(FakeResource(self, id, statuses.pop(0)))
+        return result
+
+def test_wait_for_all(monkeypatch):
+    manager = FakeManager({'a': ['BUILD', 'ACTIVE'],
+                           'b': ['BUILD', 'BUILD', 'BUILD', 'ACTIVE'],
+                           'c': ['BUILD']})
+    resources = [FakeResource(manager, id, 'BUILD') for id in ['a', 'b', 'c']]
+    # Polls are at least 80ms apart, so each tick gets a fresh listing.
+    monkeypatch.setattr(util, 'resource_listing',
+                        util.ResourceListing(max_age=0.05))
+    util.wait_while_all_status(resources, 'BUILD')
+    assert [r.status for r in resources] == ['ACTIVE', 'ACTIVE', 'BUILD']
+    # One listing per tick, not one call per resource.
+    assert manager.list_calls == 4
+    util.wait_while_all_exist(resources)
+    assert manager.list_calls == 5
+
+def test_polling_policy():
+    category = util.PollingPolicy.category
+    assert category('ping 10.0.0.12 to respond') == 'ping # to respond'
+    assert category('BUILD on Server ID 8c6f1d2e-0f5c-4c2b-9d0e-'
+                    '3a4b5c6d7e8f to finish') == 'BUILD on Server ID # to finish'
+
+    policy = util.PollingPolicy()
+    # Unknown categories start fast and back off to about a second.
+    intervals = policy.intervals('unknown')
+    first = [intervals.next() for i in range(20)]
+    assert first[0] < 0.15
+    assert max(first) < 1.25
+    assert first[-1] > 0.75
+
+    # Quick operations keep being polled quickly.
+    policy.record('ping', 0.2)
+    assert max([i for i in itertools.islice(policy.intervals('ping'), 20)]) < 0.15
+
+    # Long operations start slower and back off further.
+    for i in range(10):
+        policy.record('bless', 90)
+    intervals = list(itertools.islice(policy.intervals('bless'), 20))
+    assert intervals[0] > 1.5
+    assert intervals[-1] > 4.0
+    assert max(intervals) <= util.PollingPolicy.MAX_INTERVAL * 1.2
+
+def test_deadline():
+    assert util.Deadline.current() is None
+    assert util.remaining_time() is None
+    assert util.remaining_time(5) == 5
+    with util.Deadline(10, 'outer') as outer:
+        assert util.remaining_time(60) <= 10
+        assert util.remaining_time(1) == 1
+        # Nested deadlines can't extend the budget.
+        with util.Deadline(100, 'inner') as inner:
+            assert inner.expires == outer.expires
+            assert util.Deadline.current() == inner
+        # Detached ones get their own, and nest with each other.
+        with util.Deadline(100, 'cleanup', detached=True) as cleanup:
+            assert util.remaining_time() > 10
+            with util.Deadline(1000, 'nested', detached=True) as nested:
+                assert nested.expires == cleanup.expires
+        assert util.Deadline.current() == outer
+
+    with util.Deadline(0.3, 'short'):
+        start = time.time()
+        e = util.assert_raises(Exception, util.wait_for, 'nothing',
+                               lambda: False, duration=60)
+        assert time.time() - start < 1.0
+        assert 'deadline for short' in str(e)
+    assert util.Deadline.current() is None
+
+def test_watchdog():
+    class Tripwire(util.Watchdog):
+        def __init__(self):
+            self.checks = 0
+        def check(self):
+            self.checks += 1
+            if self.checks == 3:
+                raise ValueError('tripped')
+
+    with Tripwire() as tripwire:
+        e = util.assert_raises(ValueError, util.wait_for, 'nothing',
+                               lambda: False, interval=0.01, duration=60)
+        assert str(e) == 'tripped'
+        assert tripwire.checks == 3
+    assert util.Watchdog.stack() == []
+    # Without the watchdog the wait runs its course.
+    util.wait_for('something', lambda: True)
+    assert tripwire.checks == 3